@@ -7,14 +7,19 @@ Created on Thu Aug 22 15:44:49 2024
 Collection of funcions useful for data fitting.
 """
 
+import os
 import numpy as np
 import scipy
 import math
+import functools
+import concurrent.futures
 
-def find_best_linear_fit(X, Y, fit_width, fit_section_start, fit_section_stop):
+def find_best_linear_fit(X, Y, fit_width, fit_section_start, fit_section_stop, return_profile=False):
     """
     Returns the best (highest R) linear fit of width fit_width available in the data section between
     fit_section_start and fit_section_stop.
+    Fits of all windows are calculated at once from cumulative sums of the data, giving the same results as
+    fitting each window with scipy.stats.linregress.
 
     Parameters
     ----------
@@ -28,6 +33,8 @@ def find_best_linear_fit(X, Y, fit_width, fit_section_start, fit_section_stop):
         index of first point of data range where to look for best fit.
     fit_section_stop : TYPE
         index of last point of data range where to look for best fit.
+    return_profile : bool, optional
+        if True, also return the fits of all windows. The default is False.
 
     Returns
     -------
@@ -43,33 +50,92 @@ def find_best_linear_fit(X, Y, fit_width, fit_section_start, fit_section_stop):
         intercept of best fit.
     R2 : float
         R squared of best fit.
+    fit_profile : dict
+        only returned if return_profile is True. Arrays with an element for each window:
+        'centre_indices', 'slopes', 'intercepts', 'R2'.
     """
     
-    fit_centre_points = range(fit_section_start + fit_width//2, fit_section_stop - fit_width//2 +1)   
-    fit_indices = []
-    fit_R2 = []
-    fit_slopes = []
-    fit_intercepts = []
-    for i in fit_centre_points:
-        fit_indices.append(i)
-        X_slice = X[(i-fit_width//2):(i+fit_width//2)]
-        Y_slice = Y[(i-fit_width//2):(i+fit_width//2)]
-        fit = scipy.stats.linregress(X_slice, Y_slice)
-        fit_slopes.append(fit[0])
-        fit_intercepts.append(fit[1])
-        fit_R2.append(fit[2]**2)
+    half_width = fit_width//2
+    fit_centre_points = np.arange(fit_section_start + half_width, fit_section_stop - half_width +1)
+    # windows of centre i span X[i-half_width:i+half_width], as in the original per-window fits
+    fit_slopes, fit_intercepts, fit_R2 = sliding_linear_fits(X, Y, 2*half_width,
+                                                             fit_section_start, fit_section_stop)
     
     max_R2_index = np.argmax(fit_R2)
-    best_fit_centre_index = fit_centre_points[max_R2_index]
+    best_fit_centre_index = int(fit_centre_points[max_R2_index])
     best_fit_centre_X = X[best_fit_centre_index]
-    fitted_X = X[best_fit_centre_index-fit_width//2 : best_fit_centre_index+fit_width//2 +1]
+    fitted_X = X[best_fit_centre_index-half_width : best_fit_centre_index+half_width +1]
     slope = fit_slopes[max_R2_index]
     intercept = fit_intercepts[max_R2_index]
     R2 = fit_R2[max_R2_index]
     
+    if return_profile:
+        fit_profile = {'centre_indices': fit_centre_points,
+                       'slopes': fit_slopes,
+                       'intercepts': fit_intercepts,
+                       'R2': fit_R2}
+        return (best_fit_centre_index, best_fit_centre_X, fitted_X, slope, intercept, R2, fit_profile)
     return (best_fit_centre_index, best_fit_centre_X, fitted_X, slope, intercept, R2)
 
 
+def sliding_linear_fits(X, Y, window_size, start, stop):
+    """
+    Least squares linear fits of all windows of window_size consecutive points between indices start and stop,
+    in O(N) using cumulative sums. Several curves sharing the same X data can be fitted at once.
+
+    Parameters
+    ----------
+    X : numpy array
+        X data.
+    Y : numpy array
+        Y data, same size as X, or 2D with one curve per row and X.size columns.
+    window_size : int
+        number of points of each window.
+    start : int
+        index of first point of first window.
+    stop : int
+        index after last point of last window.
+
+    Returns
+    -------
+    slopes : numpy array
+        slope of the fit of each window, 2D with one row per curve if Y is 2D.
+    intercepts : numpy array
+        intercept of the fit of each window.
+    R2 : numpy array
+        R squared of the fit of each window, 0 for windows where X or Y is constant, as for linregress.
+    """
+    X_section = np.asarray(X[start:stop], dtype=float)
+    Y_section = np.asarray(Y, dtype=float)[..., start:stop]
+    # subtract section means to reduce rounding errors of the cumulative sums
+    X_offset = X_section.mean()
+    Y_offset = Y_section.mean(axis=-1, keepdims=True)
+    X_section = X_section - X_offset
+    Y_section = Y_section - Y_offset
+    
+    def window_sums(values):
+        cumulative_sum = np.cumsum(values, axis=-1)
+        cumulative_sum = np.concatenate( (np.zeros(values.shape[:-1] + (1,)), cumulative_sum), axis=-1)
+        return cumulative_sum[..., window_size:] - cumulative_sum[..., :-window_size]
+    
+    N = window_size
+    sum_X = window_sums(X_section)
+    sum_Y = window_sums(Y_section)
+    sum_XX = window_sums(X_section**2)
+    sum_XY = window_sums(X_section*Y_section)
+    sum_YY = window_sums(Y_section**2)
+    # sums of squared deviations from window means, clipped at zero against rounding errors
+    ss_XX = np.maximum(sum_XX - sum_X**2/N, 0)
+    ss_YY = np.maximum(sum_YY - sum_Y**2/N, 0)
+    ss_XY = sum_XY - sum_X*sum_Y/N
+    with np.errstate(divide='ignore', invalid='ignore'):
+        slopes = ss_XY / ss_XX
+        R2 = np.where( (ss_XX > 0) & (ss_YY > 0), ss_XY**2 / (ss_XX*ss_YY), 0.0)
+    R2 = np.minimum(R2, 1.0)
+    intercepts = (sum_Y - slopes*sum_X)/N + Y_offset - slopes*X_offset
+    return slopes, intercepts, R2
+
+
 def fit_noise(fit_function, X_data, Y_data, **kwargs):
     """
     Returns the noise function fitted to X_data, Y_data. Uses scipy.optimize.curve_fit for fitting.
@@ -111,4 +177,172 @@ def fit_noise(fit_function, X_data, Y_data, **kwargs):
             omega = 2*math.pi * freq
             return a * np.sin(omega*x +b) + c
         
-    return fitted_func
\ No newline at end of file
+    return fitted_func
+
+def sinusoid_function(x, a, b, c, freq):
+    """ f(x) = a*sin(2*pi*freq*x +b) +c, as fitted by fit_noise """
+    return a * np.sin(2*math.pi*freq*x +b) + c
+
+
+def split_traces(X_data, Y_data):
+    """
+    Split a stack of traces into lists of X and Y arrays, one per trace.
+
+    Parameters
+    ----------
+    X_data : numpy array or list of numpy arrays
+        X data: 1D array shared by all traces, 2D array with one row per trace, or list with an array per trace.
+    Y_data : numpy array or list of numpy arrays
+        traces: 2D array with one trace per row, or list with an array per trace, e.g. for traces of different
+        length.
+
+    Returns
+    -------
+    X_traces, Y_traces : list of numpy arrays
+        X and Y data of each trace.
+    """
+    if isinstance(Y_data, (list, tuple)):
+        Y_traces = [np.asarray(Y_trace, dtype=float) for Y_trace in Y_data]
+    else:
+        Y_traces = list(np.atleast_2d(np.asarray(Y_data, dtype=float)))
+    if isinstance(X_data, (list, tuple)) and np.ndim(X_data[0]) > 0:
+        X_traces = [np.asarray(X_trace, dtype=float) for X_trace in X_data]
+    else:
+        X_data = np.asarray(X_data, dtype=float)
+        X_traces = list(X_data) if X_data.ndim == 2 else [X_data] * len(Y_traces)
+    return X_traces, Y_traces
+
+
+def evaluate_traces(function, params, x):
+    """
+    Evaluate function(x, *params) for each trace, with params arrays with an element per trace.
+    x can be a scalar or 1D array shared by all traces, giving an array with one row per trace, a 2D array with
+    one row per trace, or a list with an array per trace, giving a list of arrays.
+    """
+    if isinstance(x, (list, tuple)) and np.ndim(x[0]) > 0:
+        return [function(np.asarray(x_trace, dtype=float), *[param[index] for param in params])
+                for index, x_trace in enumerate(x)]
+    x = np.asarray(x, dtype=float)
+    if x.ndim == 2:
+        return function(x, *[param[:, None] for param in params])
+    return function(x[None, ...], *[param.reshape( (-1,) + (1,)*x.ndim ) for param in params])
+
+
+def estimate_sinusoid_params(X_data, Y_data):
+    """
+    Estimate sinusoid parameters of each trace from the peak of its Fourier transform, for use as initial
+    guess of fits. Traces are resampled on uniform grids of equal length, then processed all at once.
+
+    Parameters
+    ----------
+    X_data : numpy array or list of numpy arrays
+        X data of the traces, see split_traces. Each trace must have increasing X.
+    Y_data : numpy array or list of numpy arrays
+        traces, see split_traces.
+
+    Returns
+    -------
+    params : numpy array
+        estimated parameters a, b, c, freq of sinusoid_function, one row per trace.
+    """
+    X_traces, Y_traces = split_traces(X_data, Y_data)
+    N_points = max(len(Y_trace) for Y_trace in Y_traces)
+    X_uniform = np.array([np.linspace(X_trace[0], X_trace[-1], N_points) for X_trace in X_traces])
+    Y_uniform = np.array([np.interp(X_row, X_trace, Y_trace)
+                          for X_row, X_trace, Y_trace in zip(X_uniform, X_traces, Y_traces)])
+    c = np.array([Y_trace.mean() for Y_trace in Y_traces])
+    Y_uniform -= c[:, None]
+    magnitude = np.abs(np.fft.rfft(Y_uniform, axis=1))
+    magnitude[:, 0] = 0
+    peak = np.clip(np.argmax(magnitude, axis=1), 1, magnitude.shape[1]-2)
+    # refine peak position between frequency bins by parabolic interpolation
+    rows = np.arange(len(Y_traces))
+    m_left, m_peak, m_right = magnitude[rows, peak-1], magnitude[rows, peak], magnitude[rows, peak+1]
+    curvature = m_left - 2*m_peak + m_right
+    with np.errstate(divide='ignore', invalid='ignore'):
+        shift = np.where(curvature != 0, 0.5*(m_left - m_right)/curvature, 0)
+    sample_interval = (X_uniform[:, -1] - X_uniform[:, 0]) / (N_points-1)
+    freq = (peak + np.clip(shift, -0.5, 0.5)) / (N_points*sample_interval)
+    # amplitude and phase from projection of each trace on its estimated frequency
+    projection = (Y_uniform * np.exp(-2j*math.pi*freq[:, None]*X_uniform)).sum(axis=1) * 2/N_points
+    a = np.abs(projection)
+    b = np.angle(projection) + math.pi/2
+    return np.stack([a, b, c, freq], axis=1)
+
+
+def fit_sinusoid_trace(X_trace, Y_trace, p0, **kwargs):
+    """ fit sinusoid_function to a single trace, returns fitted parameters and whether the fit converged """
+    try:
+        params, params_covariance = scipy.optimize.curve_fit(sinusoid_function, X_trace, Y_trace, p0=p0, **kwargs)
+        return params, True
+    except RuntimeError:
+        return np.asarray(p0, dtype=float), False
+
+
+def fit_noise_batch(fit_function, X_data, Y_data, max_workers=None, min_traces_parallel=20, **kwargs):
+    """
+    Fit the noise function of fit_noise to each trace of a stack of traces. Sinusoid fits are seeded with
+    estimate_sinusoid_params, so no initial guess is needed, and run in a process pool.
+
+    Parameters
+    ----------
+    fit_function : str
+        'constant' or 'sinusoid', see fit_noise.
+    X_data : numpy array or list of numpy arrays
+        X data: 1D array shared by all traces, 2D array with one row per trace, or list with an array per trace,
+        e.g. the time datasets of several current_vs_time measurements.
+    Y_data : numpy array or list of numpy arrays
+        traces: 2D array with one trace per row, or list with an array per trace.
+    max_workers : int, optional
+        number of worker processes for sinusoid fits. The default is None, one per processor.
+    min_traces_parallel : int, optional
+        fewer traces are fitted in this process, as starting the pool would take longer. The default is 20.
+    **kwargs
+        passed to scipy.optimize.curve_fit for sinusoid fits, e.g. bounds. An initial guess p0 is used for all
+        traces instead of the estimated one.
+
+    Returns
+    -------
+    params : dict
+        fitted parameters, arrays with an element per trace: 'a' for constant fits, 'a', 'b', 'c', 'freq' for
+        sinusoid fits. 'converged' is False for traces where the fit failed and the initial guess is returned.
+    fitted_func : function
+        function that returns fitted noise of all traces given x, see evaluate_traces: an array with one row per
+        trace for a scalar or 1D x shared by all traces or a 2D x with a row per trace, a list of arrays for a
+        list of x arrays.
+    """
+    X_traces, Y_traces = split_traces(X_data, Y_data)
+    N_traces = len(Y_traces)
+    
+    if fit_function == 'constant':
+        # least squares fit of a constant is the mean
+        a = np.array([Y_trace.mean() for Y_trace in Y_traces])
+        params = {'a': a, 'converged': np.ones(N_traces, dtype=bool)}
+        def constant_func(x, a):
+            return np.ones(np.broadcast(x, a).shape) * a
+        def fitted_func(x):
+            return evaluate_traces(constant_func, [a], x)
+        
+    elif fit_function == 'sinusoid':
+        if 'p0' in kwargs:
+            initial_params = np.tile(kwargs.pop('p0'), (N_traces, 1))
+        else:
+            initial_params = estimate_sinusoid_params(X_traces, Y_traces)
+        fit_trace = functools.partial(fit_sinusoid_trace, **kwargs)
+        if N_traces < min_traces_parallel or max_workers == 1:
+            results = [fit_trace(X_trace, Y_trace, p0) for X_trace, Y_trace, p0 in zip(X_traces, Y_traces, initial_params)]
+        else:
+            if max_workers is None:
+                max_workers = os.cpu_count()
+            # send traces to workers in chunks, so inter-process communication does not dominate for short traces
+            chunksize = max(1, N_traces // (4*max_workers))
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+                results = list(executor.map(fit_trace, X_traces, Y_traces, initial_params, chunksize=chunksize))
+        fitted_params = np.array([result[0] for result in results])
+        a, b, c, freq = fitted_params.T
+        params = {'a': a, 'b': b, 'c': c, 'freq': freq,
+                  'converged': np.array([result[1] for result in results])}
+        def fitted_func(x):
+            return evaluate_traces(sinusoid_function, [a, b, c, freq], x)
+        
+    return params, fitted_func
@@ -0,0 +1,264 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 22:26:41 2026
+
+@author: deankos
+
+Maps of the photoresponse of a transistor from the laser_ON and laser_OFF transfer curves of each point of
+a transistor_laser_scan grid scan.
+"""
+
+import numpy as np
+from nanomol.analysis.fitting import sliding_linear_fits
+from nanomol.analysis.transfer_analysis import find_transfer_curves, first_sweep
+from nanomol.utils.hdf5_datafile import hdf5_datafile
+
+class photoresponse_map():
+    """
+    Photoresponse maps of a grid scan, as 2D numpy arrays aligned to the scan grid: element [i, j] is the point at
+    grid_Y_points[i], grid_X_points[j]. Points not measured, e.g. if the scan was stopped, are NaN.
+    Maps are calculated for all points at once from curves read in a single pass over the scan:
+        'delta_I_DS' : laser_ON - laser_OFF drain current at V_GS_photocurrent
+        'mobility_OFF', 'mobility_ON' : saturation mobility without and with laser
+        'mobility_change' : mobility_ON - mobility_OFF
+        'V_th_OFF', 'V_th_ON' : threshold voltage without and with laser
+        'threshold_shift' : V_th_ON - V_th_OFF
+        'X_measured', 'Y_measured' : stage position measured at each point
+    Mobility and threshold voltage are taken from the best linear fit of sqrt(|I_DS|) vs V_GS of each curve, as
+    in transfer_analysis.extract_transfer_parameters. Maps can be stored with save() and read back with load(),
+    so large scans are only analysed once, see get_photoresponse_map.
+    """
+
+    map_names = ['delta_I_DS', 'mobility_OFF', 'mobility_ON', 'mobility_change', 'V_th_OFF', 'V_th_ON',
+                 'threshold_shift', 'X_measured', 'Y_measured']
+
+    def __init__(self, scan_group, curve_index=0, V_GS_index=None, fit_width=10, channel_width=None,
+                 channel_length=None, capacitance=None, compute=True):
+        """
+        Parameters
+        scan_group : h5py group
+            scan group written by transistor_laser_scan, holding the point_* groups
+        curve_index : int, optional
+            curve of each laser_ON/laser_OFF sweep used, for sweeps with several curves. Default is 0.
+        V_GS_index : int, optional
+            index of the V_GS point where delta_I_DS is taken. Default is None, the point with the largest mean
+            laser_OFF current, i.e. the on state.
+        fit_width : int, optional
+            number of points of the mobility fits. Default is 10.
+        channel_width, channel_length, capacitance : float, optional
+            device geometry in consistent units, see transfer_analysis.extract_transfer_parameters.
+            Default is None, giving mobility per unit W*C/L.
+        compute : bool, optional
+            if True, read the scan and calculate the maps, otherwise create an empty map e.g. for load().
+            Default is True.
+        """
+        self.scan_group = scan_group
+        self.settings = {'curve_index': curve_index, 'fit_width': fit_width}
+        self.V_GS_index = V_GS_index
+        self.geometry_factor = 1.0
+        if None not in (channel_width, channel_length, capacitance):
+            self.geometry_factor = channel_length / (channel_width * capacitance)
+        self.grid_X_points = np.asarray(scan_group.attrs['grid_X_points'])
+        self.grid_Y_points = np.asarray(scan_group.attrs['grid_Y_points'])
+        self.maps = {}
+        self.N_points = count_scan_points(scan_group)
+        if compute:
+            self.compute()
+
+    def __getitem__(self, name):
+        return self.maps[name]
+
+    def keys(self):
+        return self.maps.keys()
+
+    def compute(self):
+        points = read_scan_points(self.scan_group, self.settings['curve_index'])
+        self.V_GS = points['V_GS']
+        if self.V_GS.size == 0:
+            # no complete curves measured yet
+            self.V_GS = np.full(1, np.nan)
+            points['I_DS_OFF'] = np.full( (points['I_DS_OFF'].shape[0], 1), np.nan)
+            points['I_DS_ON'] = np.full( (points['I_DS_ON'].shape[0], 1), np.nan)
+        if self.V_GS_index is None:
+            self.V_GS_index = int(np.argmax(np.nanmean(np.abs(points['I_DS_OFF']), axis=0)))
+        self.V_GS_photocurrent = self.V_GS[self.V_GS_index]
+        point_values = {}
+        point_values['delta_I_DS'] = points['I_DS_ON'][:, self.V_GS_index] - points['I_DS_OFF'][:, self.V_GS_index]
+        for laser in ['OFF', 'ON']:
+            mobility, V_th = self.fit_curves(points['I_DS_{}'.format(laser)])
+            point_values['mobility_{}'.format(laser)] = mobility
+            point_values['V_th_{}'.format(laser)] = V_th
+        point_values['mobility_change'] = point_values['mobility_ON'] - point_values['mobility_OFF']
+        point_values['threshold_shift'] = point_values['V_th_ON'] - point_values['V_th_OFF']
+        point_values['X_measured'] = points['X_measured']
+        point_values['Y_measured'] = points['Y_measured']
+        # grid position of each point, nearest grid value to the nominal position
+        column = np.argmin(np.abs(self.grid_X_points[None, :] - points['X_nominal'][:, None]), axis=1)
+        row = np.argmin(np.abs(self.grid_Y_points[None, :] - points['Y_nominal'][:, None]), axis=1)
+        for name in self.map_names:
+            grid = np.full( (self.grid_Y_points.size, self.grid_X_points.size), np.nan)
+            grid[row, column] = point_values[name]
+            self.maps[name] = grid
+
+    def fit_curves(self, I_DS):
+        """
+        saturation mobility and threshold voltage of curves sharing self.V_GS, all fitted at once
+
+        Parameters
+        I_DS : numpy array
+            2D, one curve per row
+
+        Returns
+        mobility, V_th : numpy array
+            one value per curve, NaN for curves that could not be fitted
+        """
+        V_GS, I_DS = first_sweep(self.V_GS, I_DS)
+        N_points = V_GS.size
+        window_size = 2*(min(self.settings['fit_width'], N_points)//2)
+        if I_DS.shape[0] == 0 or window_size < 2:
+            return np.full(I_DS.shape[0], np.nan), np.full(I_DS.shape[0], np.nan)
+        slopes, intercepts, R2 = sliding_linear_fits(V_GS, np.sqrt(np.abs(I_DS)), window_size, 0, N_points)
+        # curves of points not measured are NaN, their fits are NaN too
+        best_fit = np.argmax(np.nan_to_num(R2, nan=-1), axis=1)[:, None]
+        slope = np.take_along_axis(slopes, best_fit, axis=1)[:, 0]
+        intercept = np.take_along_axis(intercepts, best_fit, axis=1)[:, 0]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            mobility = np.where(slope != 0, 2 * self.geometry_factor * slope**2, np.nan)
+            V_th = np.where(slope != 0, -intercept / slope, np.nan)
+        return mobility, V_th
+
+    def save(self, group):
+        """ store maps as datasets in group """
+        for name in list(group.keys()):
+            del group[name]
+        for name, grid in self.maps.items():
+            group.create_dataset(name, data=grid)
+        group.create_dataset('V_GS', data=self.V_GS)
+        group.attrs.create('N_points', self.N_points)
+        group.attrs.create('V_GS_index', self.V_GS_index)
+        group.attrs.create('geometry_factor', self.geometry_factor)
+        group.attrs.create('scan_timestamp', self.scan_group.attrs.get('timestamp', ''))
+        for name, value in self.settings.items():
+            group.attrs.create(name, value)
+
+    @classmethod
+    def load(cls, scan_group, group, curve_index=0, V_GS_index=None, fit_width=10, channel_width=None,
+             channel_length=None, capacitance=None):
+        """
+        load maps of scan_group stored in group by save(). Returns None if group does not hold maps calculated
+        with the same settings for the current number of completed points of this scan.
+        """
+        photoresponse = cls(scan_group, curve_index=curve_index, V_GS_index=V_GS_index, fit_width=fit_width,
+                            channel_width=channel_width, channel_length=channel_length, capacitance=capacitance,
+                            compute=False)
+        if group.attrs.get('N_points', -1) != photoresponse.N_points:
+            return None
+        if group.attrs.get('scan_timestamp') != scan_group.attrs.get('timestamp', ''):
+            # maps of another scan with the same name
+            return None
+        if group.attrs.get('geometry_factor') != photoresponse.geometry_factor:
+            return None
+        for name, value in photoresponse.settings.items():
+            if group.attrs.get(name) != value:
+                return None
+        if V_GS_index is not None and group.attrs['V_GS_index'] != V_GS_index:
+            return None
+        photoresponse.V_GS = np.array(group['V_GS'])
+        photoresponse.V_GS_index = int(group.attrs['V_GS_index'])
+        photoresponse.V_GS_photocurrent = photoresponse.V_GS[photoresponse.V_GS_index]
+        for name in cls.map_names:
+            photoresponse.maps[name] = np.array(group[name])
+        return photoresponse
+
+
+def is_complete_point(name, point_group):
+    """
+    True for point groups whose measurements are completed. Point groups are created before their sweeps run,
+    X_measured is the last attribute written by transistor_laser_scan.measure_grid_point.
+    """
+    return name.startswith('point_') and 'X_measured' in point_group.attrs
+
+def count_scan_points(scan_group):
+    """ number of completed point groups in scan_group """
+    return sum(1 for name, point_group in scan_group.items() if is_complete_point(name, point_group))
+
+def read_scan_points(scan_group, curve_index=0):
+    """
+    Read nominal and measured positions and laser_OFF and laser_ON transfer curves of all completed points of
+    a scan, in a single pass over the point groups. Points still being measured are left out, so they are NaN in
+    the maps until completed.
+
+    Returns
+    points : dict
+        'X_nominal', 'Y_nominal', 'X_measured', 'Y_measured' : arrays with one value per point
+        'V_GS' : gate voltages of the curves, shared by all points
+        'I_DS_OFF', 'I_DS_ON' : 2D arrays with the drain current of one point per row. Rows of points with
+            missing or incomplete curves are NaN.
+    """
+    positions = {name: [] for name in ['X_nominal', 'Y_nominal', 'X_measured', 'Y_measured']}
+    curves = {'OFF': [], 'ON': []}
+    for name, point_group in scan_group.items():
+        if not is_complete_point(name, point_group):
+            continue
+        for position_name in positions:
+            positions[position_name].append(point_group.attrs.get(position_name, np.nan))
+        for laser in curves:
+            laser_group = point_group.get('laser_{}'.format(laser))
+            laser_curves = [] if laser_group is None else find_transfer_curves(laser_group)
+            curves[laser].append(laser_curves[curve_index] if len(laser_curves) > curve_index else None)
+    points = {name: np.array(values, dtype=float) for name, values in positions.items()}
+    measured_curves = [curve for laser in curves for curve in curves[laser] if curve is not None]
+    # V_GS of the longest curve, shorter curves are from sweeps that were stopped
+    V_GS = max([curve['V_GS'] for curve in measured_curves], key=len, default=np.empty(0))
+    points['V_GS'] = np.asarray(V_GS, dtype=float)
+    for laser, laser_curves in curves.items():
+        I_DS = np.full( (len(laser_curves), V_GS.size), np.nan)
+        for row, curve in enumerate(laser_curves):
+            if curve is not None and curve['I_DS'].size == V_GS.size:
+                I_DS[row] = curve['I_DS']
+        points['I_DS_{}'.format(laser)] = I_DS
+    return points
+
+def get_photoresponse_map(datafile, scan_group, store=True, **kwargs):
+    """
+    Get photoresponse maps of scan_group, loading them from the sidecar file of datafile if stored there,
+    otherwise calculating them. The sidecar file is next to the datafile, see hdf5_datafile.open_sidecar_file,
+    so the datafile is not modified and can be opened read only.
+
+    Parameters
+    datafile : hdf5_datafile
+        datafile holding the scan
+    scan_group : h5py group
+        scan group written by transistor_laser_scan
+    store : bool, optional
+        if True, load maps from the sidecar file if stored there, and store calculated maps in it. Otherwise
+        always calculate maps. Default is True.
+    **kwargs
+        passed to photoresponse_map, e.g. curve_index, fit_width
+
+    Returns
+    photoresponse : photoresponse_map
+    """
+    if not store:
+        return photoresponse_map(scan_group, **kwargs)
+    stored_path = scan_group.name
+    with datafile.open_sidecar_file('photoresponse_maps') as maps_file:
+        if stored_path in maps_file:
+            # stored maps are None if the scan or the settings changed since they were stored
+            photoresponse = photoresponse_map.load(scan_group, maps_file[stored_path], **kwargs)
+            if photoresponse is not None:
+                return photoresponse
+        photoresponse = photoresponse_map(scan_group, **kwargs)
+        photoresponse.save(maps_file.require_group(stored_path))
+    return photoresponse
+
+
+if __name__ == '__main__' :
+
+    datafile = hdf5_datafile(mode='r')
+    for scan_name, scan_group in datafile.items():
+        if 'grid_X_points' in scan_group.attrs:
+            photoresponse = get_photoresponse_map(datafile, scan_group)
+            print('{}: delta_I_DS at V_GS = {} V'.format(scan_name, photoresponse.V_GS_photocurrent))
+            print(photoresponse['delta_I_DS'])
+    datafile.close()
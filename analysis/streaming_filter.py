@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:48:30 2026
+
+@author: deankos
+
+Filters applied to data point by point while it is acquired.
+"""
+
+import math
+import numpy as np
+from nanomol.analysis.fitting import sinusoid_function
+
+class streaming_sinusoid_filter():
+    """
+    Remove sinusoidal noise of known frequency, e.g. mains noise, from data as it is acquired.
+    The sinusoid model of fitting.fit_noise, a*sin(2*pi*freq*t +b) +c, is fitted by least squares with
+    exponential weighting of past points: each point is added to exponentially decaying sums of the fit normal
+    equations, which are then solved, so an update takes constant time however many points were acquired.
+    Points older than time_constant are progressively discounted, so amplitude and phase follow slow changes of
+    the noise and the offset c follows the signal. The filtered value is the data minus the fitted sinusoid,
+    keeping the offset. Sampling does not need to be uniform, since the fit uses the time of each point.
+    If the noise cannot be told apart from the offset, e.g. if the sampling interval is a whole number of noise
+    periods so that the noise is aliased to a constant, the data is returned unfiltered.
+    """
+
+    # minimum ratio of smallest to largest eigenvalue of the normal equations for the fit to be used
+    min_conditioning = 1e-3
+
+    def __init__(self, freq=50, time_constant=1.0):
+        """
+        Parameters
+        freq : float, optional
+            noise frequency in Hz. Default is 50.
+        time_constant : float, optional
+            time in s over which fitted parameters are averaged. Default is 1.
+        """
+        self.freq = freq
+        self.time_constant = time_constant
+        self.reset()
+
+    def reset(self):
+        """ discard the fit, e.g. before a new measurement """
+        # weighted sums of the normal equations for coefficients of sin(omega*t), cos(omega*t) and 1
+        self.weighted_products = np.zeros((3, 3))
+        self.weighted_values = np.zeros(3)
+        self.coefficients = np.zeros(3)
+        self.first_t = None
+        self.last_t = None
+
+    @property
+    def params(self):
+        """ current fit as parameters a, b, c, freq of fitting.sinusoid_function """
+        sin_coefficient, cos_coefficient, c = self.coefficients
+        a = math.hypot(sin_coefficient, cos_coefficient)
+        b = math.atan2(cos_coefficient, sin_coefficient)
+        return a, b, c, self.freq
+
+    @property
+    def is_fitted(self):
+        """ True once points over a full noise period have been fitted and they constrain sinusoid and offset """
+        if self.last_t is None or self.last_t - self.first_t < 1/self.freq:
+            return False
+        eigenvalues = np.linalg.eigvalsh(self.weighted_products)
+        return eigenvalues[0] > self.min_conditioning * eigenvalues[-1]
+
+    def can_filter(self, sample_interval):
+        """
+        False if noise sampled at fixed sample_interval is aliased to a frequency too low to be told apart from
+        the offset within time_constant, e.g. if sample_interval is a whole number of noise periods.
+        """
+        aliased_freq = abs(self.freq - round(self.freq*sample_interval)/sample_interval)
+        return aliased_freq * self.time_constant >= 1
+
+    def noise(self, t):
+        """ fitted sinusoid without offset at times t """
+        a, b, c, freq = self.params
+        return sinusoid_function(t, a, b, 0, freq)
+
+    def update(self, t, y):
+        """
+        Update the fit with a point and return its filtered value.
+
+        Parameters
+        t : float
+            time of the point in s
+        y : float
+            value of the point
+
+        Returns
+        y_filtered : float
+            y minus the fitted sinusoid at t, or y until points over a full noise period have been fitted
+        """
+        omega_t = 2*math.pi*self.freq*t
+        regressors = np.array([math.sin(omega_t), math.cos(omega_t), 1.0])
+        if self.last_t is None:
+            self.first_t = t
+        else:
+            weight_decay = math.exp(-(t - self.last_t) / self.time_constant)
+            self.weighted_products *= weight_decay
+            self.weighted_values *= weight_decay
+        self.last_t = t
+        self.weighted_products += np.outer(regressors, regressors)
+        self.weighted_values += regressors * y
+        # small regularisation keeps the solution bounded if the points do not constrain all coefficients,
+        # the fit is then not used, see is_fitted
+        regularisation = 1e-9 * np.trace(self.weighted_products) * np.eye(3)
+        self.coefficients = np.linalg.solve(self.weighted_products + regularisation, self.weighted_values)
+        if not self.is_fitted:
+            return y
+        return y - regressors[:2] @ self.coefficients[:2]
+
+    def filter(self, t, y):
+        """ update the fit with points at times t with values y, return array of filtered values """
+        return np.array([self.update(t_point, y_point) for t_point, y_point in zip(t, y)])
@@ -0,0 +1,245 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 21:05:17 2026
+
+@author: deankos
+
+Batch extraction of transistor parameters from all transfer curves in an hdf5 datafile.
+Curves are read from the file in the main process and analysed in a process pool, results are collected in a
+table with one row per curve.
+"""
+
+import os
+import functools
+import concurrent.futures
+import numpy as np
+from nanomol.analysis.fitting import find_best_linear_fit, sliding_linear_fits
+from nanomol.utils.hdf5_datafile import hdf5_datafile, curve_table
+
+# top level groups of derived data written in datafiles by earlier versions, now kept in sidecar files, not
+# searched for curves
+derived_data_groups = ['decimation_pyramids', 'photoresponse_maps']
+
+result_fields = ['V_DS', 'mobility_sat', 'V_th_sat', 'R2_sat', 'mobility_lin', 'V_th_lin', 'R2_lin',
+                 'on_off_ratio', 'subthreshold_swing']
+
+def find_transfer_curves(datafile):
+    """
+    Find all transfer curves in datafile, saved either as curve_* groups or in compact curve tables
+    by transistor_transfer.
+
+    Parameters
+    ----------
+    datafile : hdf5_datafile or h5py group
+        file or group searched recursively.
+
+    Returns
+    -------
+    curves : list of dict
+        one dict per curve with keys 'path' (hdf5 path of the curve, with the table row for compact curves),
+        'V_GS', 'I_DS' (numpy arrays) and 'V_DS' (float).
+    """
+    curves = []
+
+    def is_transfer_sweep(sweep_group):
+        return sweep_group.attrs.get('measurement_mode', 'transfer') == 'transfer'
+
+    def visit_group(name, item):
+        if not hasattr(item, 'keys'):
+            return
+        if item.name.split('/')[1] in derived_data_groups:
+            return
+        # measurement_mode is an attribute of the sweep group, holding the curve table or the curve groups
+        if 'curve_data' in item and 'curve_attrs' in item:
+            if is_transfer_sweep(item):
+                curves.extend(read_curve_table(item))
+        elif name.split('/')[-1].startswith('curve_') and 'measured_I_DS' in item:
+            if is_transfer_sweep(item.parent):
+                curves.append(read_curve_group(item))
+
+    datafile.visititems(visit_group)
+    return curves
+
+def read_curve_group(group):
+    """ read transfer curve saved as a group with one dataset per column """
+    V_GS_name = 'calculated_V_GS' if 'calculated_V_GS' in group else 'measured_V_GS'
+    I_DS = group['measured_I_DS'][()]
+    if 'V_DS' in group.attrs:
+        V_DS = float(group.attrs['V_DS'])
+    else:
+        V_DS = float(np.mean(group['measured_V_DS'][()]))
+    return {'path': group.name, 'V_GS': group[V_GS_name][()], 'I_DS': I_DS, 'V_DS': V_DS}
+
+def read_curve_table(group):
+    """ read all transfer curves of a compact curve table, reading each table dataset once """
+    table = curve_table(group)
+    V_GS_name = 'calculated_V_GS' if 'calculated_V_GS' in table.column_names else 'measured_V_GS'
+    V_GS_column = table.get_column(V_GS_name)
+    I_DS_column = table.get_column('measured_I_DS')
+    if 'V_DS' not in table.attr_names:
+        V_DS_column = table.get_column('measured_V_DS')
+    attrs_rows = table.attrs[()]
+    curves = []
+    for index, attrs_row in enumerate(attrs_rows):
+        curve_rows = slice(attrs_row['start'], attrs_row['start'] + attrs_row['N_points'])
+        if 'V_DS' in table.attr_names:
+            V_DS = float(attrs_row['V_DS'])
+        else:
+            V_DS = float(np.mean(V_DS_column[curve_rows]))
+        curves.append({'path': '{}/curve_attrs[{}]'.format(group.name, index),
+                       'V_GS': V_GS_column[curve_rows],
+                       'I_DS': I_DS_column[curve_rows],
+                       'V_DS': V_DS})
+    return curves
+
+def first_sweep(V_GS, I_DS):
+    """
+    return the part of the curve before V_GS changes direction, i.e. the forward sweep of loops.
+    I_DS can be 2D with one curve per row, for curves sharing the same V_GS.
+    """
+    steps = np.sign(np.diff(V_GS))
+    turning_points = np.flatnonzero(steps != steps[0])
+    if turning_points.size == 0:
+        return V_GS, I_DS
+    stop = turning_points[0] +1
+    return V_GS[:stop], I_DS[..., :stop]
+
+def extract_transfer_parameters(V_GS, I_DS, V_DS, channel_width=None, channel_length=None, capacitance=None,
+                                fit_width=10, swing_fit_width=5):
+    """
+    Extract transistor parameters from a transfer curve. Only the forward sweep of loops is used.
+    Mobilities and threshold voltages are taken from the best linear fits (see fitting.find_best_linear_fit)
+    of sqrt(|I_DS|) vs V_GS for the saturation regime and I_DS vs V_GS for the linear regime. Both are
+    calculated for every curve, use the one valid for the V_DS of the curve.
+
+    Parameters
+    ----------
+    V_GS : numpy array
+        gate voltage.
+    I_DS : numpy array
+        drain current, same size as V_GS.
+    V_DS : float
+        drain voltage of the curve.
+    channel_width, channel_length, capacitance : float, optional
+        channel width, length and gate capacitance per unit area, in consistent units, e.g. cm, cm and F/cm2
+        for mobility in cm2/Vs. The default is None, giving mobility per unit W*C/L.
+    fit_width : int, optional
+        number of points of the mobility fits. The default is 10.
+    swing_fit_width : int, optional
+        number of points of the fits of log10(|I_DS|) used for the subthreshold swing. The default is 5.
+
+    Returns
+    -------
+    parameters : dict
+        values of result_fields: 'V_DS', 'mobility_sat', 'V_th_sat', 'R2_sat', 'mobility_lin', 'V_th_lin',
+        'R2_lin', 'on_off_ratio', 'subthreshold_swing' (V/decade). Values that cannot be calculated are NaN.
+    """
+    parameters = dict.fromkeys(result_fields, np.nan)
+    parameters['V_DS'] = V_DS
+    V_GS, I_DS = first_sweep(np.asarray(V_GS, dtype=float), np.asarray(I_DS, dtype=float))
+    N_points = V_GS.size
+    if N_points < 3:
+        return parameters
+    geometry_factor = 1.0
+    if None not in (channel_width, channel_length, capacitance):
+        geometry_factor = channel_length / (channel_width * capacitance)
+    abs_I_DS = np.abs(I_DS)
+    nonzero_I_DS = abs_I_DS[abs_I_DS > 0]
+    if nonzero_I_DS.size > 0:
+        parameters['on_off_ratio'] = abs_I_DS.max() / nonzero_I_DS.min()
+    fit_width = min(fit_width, N_points)
+
+    fit = find_best_linear_fit(V_GS, np.sqrt(abs_I_DS), fit_width, 0, N_points)
+    slope, intercept, R2 = fit[3:6]
+    if slope != 0:
+        parameters['mobility_sat'] = 2 * geometry_factor * slope**2
+        parameters['V_th_sat'] = -intercept / slope
+        parameters['R2_sat'] = R2
+
+    fit = find_best_linear_fit(V_GS, I_DS, fit_width, 0, N_points)
+    slope, intercept, R2 = fit[3:6]
+    if slope != 0 and V_DS != 0:
+        parameters['mobility_lin'] = geometry_factor * abs(slope / V_DS)
+        parameters['V_th_lin'] = -intercept / slope
+        parameters['R2_lin'] = R2
+
+    if nonzero_I_DS.size > 0:
+        # zero currents are replaced by the smallest measured current to avoid infinite log values
+        log_I_DS = np.log10(np.maximum(abs_I_DS, nonzero_I_DS.min()))
+        swing_fit_width = max(2, min(swing_fit_width, N_points))
+        log_slopes = sliding_linear_fits(V_GS, log_I_DS, swing_fit_width, 0, N_points)[0]
+        log_slopes = np.abs(log_slopes[np.isfinite(log_slopes)])
+        max_log_slope = log_slopes.max() if log_slopes.size > 0 else 0
+        if max_log_slope > 0:
+            parameters['subthreshold_swing'] = 1 / max_log_slope
+    return parameters
+
+def analyse_curve(curve, **kwargs):
+    """ extract parameters of a curve from find_transfer_curves, kwargs are passed to extract_transfer_parameters """
+    return extract_transfer_parameters(curve['V_GS'], curve['I_DS'], curve['V_DS'], **kwargs)
+
+def analyse_curves(curves, max_workers=None, min_curves_parallel=5000, **kwargs):
+    """
+    Extract parameters of all curves in a process pool.
+
+    Parameters
+    ----------
+    curves : list of dict
+        curves as returned by find_transfer_curves.
+    max_workers : int, optional
+        number of worker processes. The default is None, one per processor.
+    min_curves_parallel : int, optional
+        fewer curves are analysed in this process, as fitting a typical curve takes less than a millisecond
+        and starting the pool would take longer. The default is 5000.
+    **kwargs
+        passed to extract_transfer_parameters, e.g. channel_width, fit_width.
+
+    Returns
+    -------
+    results : numpy structured array
+        results table with field 'path' and the fields in result_fields, one row per curve.
+    """
+    analyse = functools.partial(analyse_curve, **kwargs)
+    if len(curves) < min_curves_parallel or max_workers == 1:
+        parameters = [analyse(curve) for curve in curves]
+    else:
+        if max_workers is None:
+            max_workers = os.cpu_count()
+        # send curves to workers in chunks, so inter-process communication does not dominate for short curves
+        chunksize = max(1, len(curves) // (4*max_workers))
+        with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers) as executor:
+            parameters = list(executor.map(analyse, curves, chunksize=chunksize))
+    path_length = max([len(curve['path']) for curve in curves], default=1)
+    results = np.empty(len(curves), dtype=[('path', 'U{}'.format(path_length))] + [(name, float) for name in result_fields])
+    for row, (curve, curve_parameters) in enumerate(zip(curves, parameters)):
+        results[row]['path'] = curve['path']
+        for name in result_fields:
+            results[row][name] = curve_parameters[name]
+    return results
+
+def analyse_datafile(datafile, max_workers=None, **kwargs):
+    """
+    Find and analyse all transfer curves in datafile, see find_transfer_curves and analyse_curves.
+
+    Returns
+    -------
+    results : numpy structured array
+        results table, one row per curve.
+    """
+    curves = find_transfer_curves(datafile)
+    return analyse_curves(curves, max_workers=max_workers, **kwargs)
+
+def save_results(results, filename):
+    """ save results table from analyse_curves as a csv file with a header row """
+    header = ','.join(results.dtype.names)
+    fmt = ['%s'] + ['%.6e'] * len(result_fields)
+    np.savetxt(filename, results, fmt=fmt, delimiter=',', header=header, comments='')
+
+
+if __name__ == '__main__' :
+
+    datafile = hdf5_datafile(mode='r')
+    results = analyse_datafile(datafile)
+    filename = '{}_transfer_analysis.csv'.format(os.path.splitext(datafile.filename)[0])
+    save_results(results, filename)
+    datafile.close()
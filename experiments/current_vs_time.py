@@ -11,9 +11,11 @@ import time
 import os
 import pyqtgraph as pg
 from PyQt5 import QtWidgets, uic
-from PyQt5.QtCore import pyqtSignal
 from nanomol.instruments.keithley_2600A import keithley_2600A, keithley_2600A_ui
 from nanomol.utils.interactive_ui import interactive_ui
+from nanomol.analysis.streaming_filter import streaming_sinusoid_filter
+from nanomol.utils.live_plot import live_plot
+from nanomol.utils.acquisition_buffer import acquisition_buffer
 from nanomol.utils.hdf5_datafile import hdf5_datafile
 from nanomol.utils.hdf5_viewer import hdf5_viewer
 
@@ -22,9 +24,21 @@ class current_vs_time(interactive_ui):
     Class to measure transistor output over time. Set V_GS and V_DS and start measurement.
     Measurements always record time and measured V and I values for both channels.
     Run measurement until the time limit, or set time limit to -1 to run indefinitely.
+    If the mains filter is enabled, mains noise is removed from I_DS while measuring, and the filtered current
+    is plotted and saved as I_DS_filtered together with the raw data.
+    Data is written to the datafile while measuring, in batches and at least every flush_interval seconds.
+    Only the last max_plot_points points are kept in memory for plotting, so memory use is bounded however long
+    the measurement runs.
     """
     
-    update_plots_signal = pyqtSignal()
+    # maximum number of recent points kept in memory and plotted
+    max_plot_points = 100000
+    # maximum time in s that acquired data is kept in memory before being written to the datafile
+    flush_interval = 10
+    # time in s added to the integration time of hardware timed samples, for ranging and triggering
+    sample_overhead = 1e-3
+    # time in s allowed beyond the duration of a hardware timed buffer segment before acquisition is aborted
+    segment_timeout_margin = 10
     
     def __init__(self, datafile, smu):
         super().__init__()
@@ -37,16 +51,37 @@ class current_vs_time(interactive_ui):
         self.stop_pushbutton.clicked.connect(self.stop_measurement)
         self.reset_plot_widgets_pushbutton.clicked.connect(self.setup_plot_widgets)
         self.shutdown_pushbutton.clicked.connect(self.shutdown)
-        self.update_plots_signal.connect(self.update_plots)
+        self.live_plot = live_plot()
         self.setup_plot_widgets()
         self.measurement_is_running = False
         
     def start_measurement(self):
         if not self.measurement_is_running:  # do nothing if measurement is already running
+            if not self.check_datafile_accepts_measurements(self.datafile):
+                return
+            self.check_mains_filter()
             self.measurement_is_running = True
-            measurement_thread = threading.Thread(target=self.run_measurement)
+            if self.hardware_timed_checkBox.isChecked():
+                measurement_thread = threading.Thread(target=self.run_timed_measurement)
+            else:
+                measurement_thread = threading.Thread(target=self.run_measurement)
             measurement_thread.start()
             
+    def check_mains_filter(self):
+        """
+        Disable the mains filter if the hardware timed sample interval aliases mains noise to a constant, e.g. if
+        it is a whole number of mains periods, since the noise could not be told apart from the current.
+        """
+        if not (self.mains_filter_checkBox.isChecked() and self.hardware_timed_checkBox.isChecked()):
+            return
+        mains_filter = streaming_sinusoid_filter(freq=self.mains_frequency, time_constant=self.mains_filter_time_constant)
+        if not mains_filter.can_filter(self.sample_interval):
+            self.mains_filter_checkBox.setChecked(False)
+            QtWidgets.QMessageBox.warning(self, 'mains filter disabled',
+                                          'Mains noise sampled every {} s cannot be told apart from the current, '
+                                          'the mains filter is disabled. Choose a sample interval that is not a '
+                                          'multiple of the mains period to filter.'.format(self.sample_interval) )
+    
     def stop_measurement(self):
         if self.measurement_is_running:
             self.measurement_is_running = False
@@ -73,44 +108,170 @@ class current_vs_time(interactive_ui):
                 self.smu.set_source_level(self.ch_DS, 'v', self.V_DS)
             measured_I_GS, measured_V_GS = self.smu.measure(self.ch_GS, 'iv')
             measured_I_DS, measured_V_DS = self.smu.measure(self.ch_DS, 'iv')
-            self.data['time'].append(t)
-            self.data['V_GS'].append(measured_V_GS)
-            self.data['I_GS'].append(measured_I_GS)
-            self.data['V_DS'].append(measured_V_DS)
-            self.data['I_DS'].append(measured_I_DS)
-            self.update_plots_signal.emit()
+            point = {'time': t,
+                     'V_GS': measured_V_GS,
+                     'I_GS': measured_I_GS,
+                     'V_DS': measured_V_DS,
+                     'I_DS': measured_I_DS}
+            if self.mains_filter is not None:
+                point['I_DS_filtered'] = self.mains_filter.update(t, measured_I_DS)
+            self.data.add_point(point)
+            self.append_data(point)
+            self.update_plots()
             t = time.time() - t0
         self.smu.set_output(self.ch_GS, 0)
         self.smu.set_output(self.ch_DS, 0)
         self.save_data()
+    
+    def run_timed_measurement(self, poll_interval=0.5):
+        """
+        Sample both channels at fixed intervals timed by the smu trigger model. Readings and timestamps are
+        stored in the smu buffers, which are read every poll_interval seconds while the measurement runs.
+        If the buffers are full before the time limit, acquisition continues in a new buffer segment.
+        If a segment is not acquired within its duration plus segment_timeout_margin seconds, e.g. if the
+        instrument stops triggering, acquisition is aborted and TimeoutError is raised.
+        """
+        self.clear_plots()
+        self.configure_measurement()
+        self.create_new_plot_lines()
+        with self.smu.batch_writes():
+            self.smu.set_source_level(self.ch_GS, 'v', self.V_GS)
+            self.smu.set_source_level(self.ch_DS, 'v', self.V_DS)
+            self.smu.set_output(self.ch_GS, 1)
+            self.smu.set_output(self.ch_DS, 1)
+        if self.t_limit == np.inf:
+            N_samples_left = np.inf
+        else:
+            N_samples_left = int(self.t_limit / self.sample_interval) +1
+        buffers = {'I_GS': 'smu{}.nvbuffer1'.format(self.ch_GS),
+                   'V_GS': 'smu{}.nvbuffer2'.format(self.ch_GS),
+                   'I_DS': 'smu{}.nvbuffer1'.format(self.ch_DS),
+                   'V_DS': 'smu{}.nvbuffer2'.format(self.ch_DS)}
+        buffer_capacity = self.smu.get_buffer_capacity(buffers['I_DS'])
+        try:
+            t0 = None
+            while self.measurement_is_running and N_samples_left > 0:
+                N_segment = int( min(N_samples_left, buffer_capacity) )
+                self.smu.write_batch(self.smu.generate_timed_iv_script(self.ch_DS, self.ch_GS, self.sample_interval, N_segment))
+                N_read = 0
+                deadline = time.time() + N_segment*self.sample_interval + self.segment_timeout_margin
+                while N_read < N_segment:
+                    time.sleep(poll_interval)
+                    if time.time() > deadline:
+                        self.smu.abort(self.ch_GS)
+                        self.smu.abort(self.ch_DS)
+                        raise TimeoutError('timed acquisition stopped after {} of {} samples of the segment'.format(
+                                           N_read, N_segment))
+                    if not self.measurement_is_running:
+                        # stop acquisition, then read the remaining readings
+                        self.smu.abort(self.ch_GS)
+                        self.smu.abort(self.ch_DS)
+                    # read only readings stored in all buffers
+                    N_available = min( [self.smu.get_buffer_size(buffer_name) for buffer_name in buffers.values()] )
+                    if N_available > N_read:
+                        if N_read == 0:
+                            # buffer timestamps are relative to the first reading of the current segment
+                            base_timestamp = self.smu.get_buffer_basetimestamp(buffers['I_DS'])
+                            if t0 is None:
+                                t0 = base_timestamp
+                            t_segment = base_timestamp - t0
+                        chunk = self.smu.read_buffer_binary(buffers['I_DS'], ['readings', 'timestamps'], N_read+1, N_available)
+                        new_data = {'time': chunk['timestamps'] + t_segment,
+                                    'I_DS': chunk['readings']}
+                        for label in ['V_DS', 'I_GS', 'V_GS']:
+                            chunk = self.smu.read_buffer_binary(buffers[label], ['readings'], N_read+1, N_available)
+                            new_data[label] = chunk['readings']
+                        if self.mains_filter is not None:
+                            new_data['I_DS_filtered'] = self.mains_filter.filter(new_data['time'], new_data['I_DS'])
+                        self.data.add_points(new_data)
+                        self.append_data(new_data)
+                        self.update_plots()
+                        N_read = N_available
+                    if not self.measurement_is_running:
+                        break
+                N_samples_left -= N_read
+        finally:
+            self.smu.set_output(self.ch_GS, 0)
+            self.smu.set_output(self.ch_DS, 0)
+            self.measurement_is_running = False
+            self.save_data()
         
     def configure_measurement(self):
-        self.smu.set_source_function('a', 1)
-        self.smu.set_source_function('b', 1)
+        with self.smu.batch_writes():
+            self.smu.set_source_function('a', 1)
+            self.smu.set_source_function('b', 1)
+        if self.hardware_timed_checkBox.isChecked():
+            self.check_sample_interval()
         self.initialise_datasets()
         if self.t_limit == -1:
             self.t_limit = np.inf
         self.timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time()) )
+        self.save_attrs()
         
+    def check_sample_interval(self):
+        """
+        Clamp the hardware timed sample interval to the time the smu needs to measure i and v on each channel,
+        from the integration time of the slowest channel, as shorter intervals would give mistimed samples.
+        """
+        nplc = max(self.smu.get_nplc(self.ch_GS), self.smu.get_nplc(self.ch_DS))
+        min_sample_interval = 2 * nplc / self.smu.get_line_frequency() + self.sample_overhead
+        if self.sample_interval < min_sample_interval:
+            print('sample interval {} s shorter than the {:.4f} s needed to measure at {} nplc, using {:.4f} s'.format(
+                  self.sample_interval, min_sample_interval, nplc, min_sample_interval) )
+            self.sample_interval = min_sample_interval
+    
     def initialise_datasets(self):
-        self.data = {'time': [],
-                     'V_GS': [],
-                     'I_GS': [],
-                     'V_DS': [],
-                     'I_DS': []  }
+        # datasets grow as data is acquired
+        labels = ['time', 'V_GS', 'I_GS', 'V_DS', 'I_DS']
+        self.mains_filter = None
+        if self.mains_filter_checkBox.isChecked():
+            mains_filter = streaming_sinusoid_filter(freq=self.mains_frequency,
+                                                     time_constant=self.mains_filter_time_constant)
+            # the sample interval may have been clamped since check_mains_filter
+            if not self.hardware_timed_checkBox.isChecked() or mains_filter.can_filter(self.sample_interval):
+                labels.append('I_DS_filtered')
+                self.mains_filter = mains_filter
+        # only the recent history is kept in memory for plotting, all data is written to the datafile
+        self.data = acquisition_buffer(labels, max_points=self.max_plot_points)
         
-    def save_data(self):
-        """ write data to hdf5 datafile """
+    def save_attrs(self):
+        """ create data group with measurement attributes, and datasets that data is appended to while measuring """
         active_group = self.datafile.get_unique_group_name(self.datafile, basename=self.description, max_N=100)
         self.active_group =  self.datafile.create_group(active_group)
         self.active_group.attrs.create('description', self.description)
         self.active_group.attrs.create('timestamp', self.timestamp)
         self.active_group.attrs.create('channel_GS', self.ch_GS)
         self.active_group.attrs.create('channel_DS', self.ch_DS)
+        self.active_group.attrs.create('hardware_timed', int(self.hardware_timed_checkBox.isChecked()) )
+        if self.hardware_timed_checkBox.isChecked():
+            self.active_group.attrs.create('sample_interval', self.sample_interval)
+        self.active_group.attrs.create('mains_filter', int(self.mains_filter is not None) )
+        if self.mains_filter is not None:
+            self.active_group.attrs.create('mains_frequency', self.mains_frequency)
+            self.active_group.attrs.create('mains_filter_time_constant', self.mains_filter_time_constant)
         for key, value in self.smu.get_settings().items():
             self.active_group.attrs.create('keithley_{}'.format(key), value)
-        for dataset_name, data in self.data.items():
-            self.active_group.create_dataset(dataset_name, data=np.array(data) )
+        self.datasets = {}
+        for dataset_name in self.data.keys():
+            self.datasets[dataset_name] = self.datafile.create_appendable_dataset(self.active_group, dataset_name,
+                                                                                  flush_interval=self.flush_interval)
+        # if the datafile was opened for SWMR access, let other processes follow the datasets as they grow.
+        # No new groups can be created afterwards, so SWMR files hold a single measurement.
+        self.datafile.start_swmr_write()
+    
+    def append_data(self, new_data):
+        """
+        write new points to the datafile, in batches. new_data is a dict of label: value for a single point or
+        label: array for several points, datasets missing from new_data are NaN.
+        """
+        N_new_points = np.size(new_data['time'])
+        for dataset_name, dataset in self.datasets.items():
+            dataset.extend(np.broadcast_to(new_data.get(dataset_name, np.nan), N_new_points))
+        
+    def save_data(self):
+        """ write remaining data to hdf5 datafile """
+        for dataset in self.datasets.values():
+            dataset.flush()
         self.datafile.flush()
     
     def setup_plot_widgets(self):
@@ -133,15 +294,23 @@ class current_vs_time(interactive_ui):
     def clear_plots(self):
         self.I_GS_vs_time.clear()
         self.I_DS_vs_time.clear()
+        self.live_plot.clear()
         
     def create_new_plot_lines(self):
         pen_I = pg.mkPen(color='r')
-        self.I_GS_vs_time_line = self.I_GS_vs_time.plot(self.data['time'], self.data['I_GS'], pen=pen_I )
-        self.I_DS_vs_time_line = self.I_DS_vs_time.plot(self.data['time'], self.data['I_DS'], pen=pen_I )
+        self.I_GS_vs_time_line = self.live_plot.add_line(self.I_GS_vs_time, pen=pen_I )
+        self.I_DS_vs_time_line = self.live_plot.add_line(self.I_DS_vs_time, pen=pen_I )
+        if self.mains_filter is not None:
+            pen_I_filtered = pg.mkPen(color='b')
+            self.I_DS_filtered_vs_time_line = self.live_plot.add_line(self.I_DS_vs_time, pen=pen_I_filtered )
     
     def update_plots(self):
-        self.I_GS_vs_time_line.setData(self.data['time'], self.data['I_GS'] )
-        self.I_DS_vs_time_line.setData(self.data['time'], self.data['I_DS'] )
+        """ plot acquired data, lines are redrawn at a limited frame rate """
+        self.I_GS_vs_time_line.set_data(self.data['time'], self.data['I_GS'] )
+        self.I_DS_vs_time_line.set_data(self.data['time'], self.data['I_DS'] )
+        if self.mains_filter is not None:
+            self.I_DS_filtered_vs_time_line.set_data(self.data['time'], self.data['I_DS_filtered'] )
+        self.live_plot.request_update()
     
     def shutdown(self):
         self.datafile.close()
@@ -11,10 +11,11 @@ import time
 import os
 import pyqtgraph as pg
 from PyQt5 import QtWidgets, uic
-from PyQt5.QtCore import pyqtSignal
 from nanomol.instruments.keithley_2600A import keithley_2600A, keithley_2600A_ui
 from nanomol.instruments.keithley_2600_LED_driver import keithley_2600_LED_driver_ui
 from nanomol.utils.interactive_ui import interactive_ui
+from nanomol.utils.live_plot import live_plot
+from nanomol.utils.acquisition_buffer import acquisition_buffer
 from nanomol.utils.hdf5_datafile import hdf5_datafile
 from nanomol.utils.hdf5_viewer import hdf5_viewer
 
@@ -23,9 +24,15 @@ class current_vs_time_LED(interactive_ui):
     Class to measure transistor output over time. Set V_GS and V_DS and start measurement.
     Measurements always record time and measured V and I values for both channels.
     Run measurement until the time limit, or set time limit to -1 to run indefinitely.
+    Data is written to the datafile while measuring, in batches and at least every flush_interval seconds.
+    Only the last max_plot_points points are kept in memory for plotting, so memory use is bounded however long
+    the measurement runs.
     """
     
-    update_plots_signal = pyqtSignal()
+    # maximum number of recent points kept in memory and plotted
+    max_plot_points = 100000
+    # maximum time in s that acquired data is kept in memory before being written to the datafile
+    flush_interval = 10
     
     def __init__(self, datafile, smu, LED):
         super().__init__()
@@ -38,12 +45,14 @@ class current_vs_time_LED(interactive_ui):
         self.start_pushbutton.clicked.connect(self.start_measurement)
         self.stop_pushbutton.clicked.connect(self.stop_measurement)
         self.shutdown_pushbutton.clicked.connect(self.shutdown)
-        self.update_plots_signal.connect(self.update_plots)
+        self.live_plot = live_plot()
         self.setup_plot_widgets()
         self.measurement_is_running = False
         
     def start_measurement(self):
         if not self.measurement_is_running:  # do nothing if measurement is already running
+            if not self.check_datafile_accepts_measurements(self.datafile):
+                return
             self.measurement_is_running = True
             measurement_thread = threading.Thread(target=self.run_measurement)
             measurement_thread.start()
@@ -74,45 +83,47 @@ class current_vs_time_LED(interactive_ui):
                 self.smu.set_source_level(self.ch_DS, 'v', self.V_DS)
             measured_I_GS, measured_V_GS = self.smu.measure(self.ch_GS, 'iv')
             measured_I_DS, measured_V_DS = self.smu.measure(self.ch_DS, 'iv')
-            if self.use_LED_checkBox.isChecked():
+            point = {'time': t,
+                     'V_GS': measured_V_GS,
+                     'I_GS': measured_I_GS,
+                     'V_DS': measured_V_DS,
+                     'I_DS': measured_I_DS}
+            # LED values are only measured if the LED datasets were created at the start of the measurement
+            if self.use_LED_checkBox.isChecked() and 'LED_output' in self.data:
                 LED_output = self.LED.smu.get_output('a')
                 measured_LED_I = self.LED.i
                 measured_LED_V = self.LED.v
-                self.data['LED_output'].append(LED_output)
-                self.data['measured_LED_current'].append(measured_LED_I)
-                self.data['measured_LED_voltage'].append(measured_LED_V)
-            self.data['time'].append(t)
-            self.data['V_GS'].append(measured_V_GS)
-            self.data['I_GS'].append(measured_I_GS)
-            self.data['V_DS'].append(measured_V_DS)
-            self.data['I_DS'].append(measured_I_DS)
-            self.update_plots_signal.emit()
+                point.update({'LED_output': LED_output,
+                              'measured_LED_current': measured_LED_I,
+                              'measured_LED_voltage': measured_LED_V})
+            self.data.add_point(point)
+            self.append_data(point)
+            self.update_plots()
             t = time.time() - t0
         self.smu.set_output(self.ch_GS, 0)
         self.smu.set_output(self.ch_DS, 0)
         self.save_data()
         
     def configure_measurement(self):
-        self.smu.set_source_function('a', 1)
-        self.smu.set_source_function('b', 1)
+        with self.smu.batch_writes():
+            self.smu.set_source_function('a', 1)
+            self.smu.set_source_function('b', 1)
         self.initialise_datasets()
         if self.t_limit == -1:
             self.t_limit = np.inf
         self.timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time()) )
+        self.save_attrs()
         
     def initialise_datasets(self):
-        self.data = {'time': [],
-                     'V_GS': [],
-                     'I_GS': [],
-                     'V_DS': [],
-                     'I_DS': []  }
+        # datasets grow as data is acquired
+        labels = ['time', 'V_GS', 'I_GS', 'V_DS', 'I_DS']
         if self.use_LED_checkBox.isChecked():
-            self.data.update({'LED_output': [],
-                              'measured_LED_current': [],
-                              'measured_LED_voltage': [] })
+            labels += ['LED_output', 'measured_LED_current', 'measured_LED_voltage']
+        # only the recent history is kept in memory for plotting, all data is written to the datafile
+        self.data = acquisition_buffer(labels, max_points=self.max_plot_points)
         
-    def save_data(self):
-        """ write data to hdf5 datafile """
+    def save_attrs(self):
+        """ create data group with measurement attributes, and datasets that data is appended to while measuring """
         active_group = self.datafile.get_unique_group_name(self.datafile, basename=self.description, max_N=100)
         self.active_group =  self.datafile.create_group(active_group)
         self.active_group.attrs.create('description', self.description)
@@ -121,8 +132,27 @@ class current_vs_time_LED(interactive_ui):
         self.active_group.attrs.create('channel_DS', self.ch_DS)
         for key, value in self.smu.get_settings().items():
             self.active_group.attrs.create('keithley_{}'.format(key), value)
-        for dataset_name, data in self.data.items():
-            self.active_group.create_dataset(dataset_name, data=np.array(data) )
+        self.datasets = {}
+        for dataset_name in self.data.keys():
+            self.datasets[dataset_name] = self.datafile.create_appendable_dataset(self.active_group, dataset_name,
+                                                                                  flush_interval=self.flush_interval)
+        # if the datafile was opened for SWMR access, let other processes follow the datasets as they grow.
+        # No new groups can be created afterwards, so SWMR files hold a single measurement.
+        self.datafile.start_swmr_write()
+    
+    def append_data(self, new_data):
+        """
+        write new points to the datafile, in batches. new_data is a dict of label: value for a single point or
+        label: array for several points, datasets missing from new_data are NaN.
+        """
+        N_new_points = np.size(new_data['time'])
+        for dataset_name, dataset in self.datasets.items():
+            dataset.extend(np.broadcast_to(new_data.get(dataset_name, np.nan), N_new_points))
+        
+    def save_data(self):
+        """ write remaining data to hdf5 datafile """
+        for dataset in self.datasets.values():
+            dataset.flush()
         self.datafile.flush()
     
     def setup_plot_widgets(self):
@@ -145,15 +175,18 @@ class current_vs_time_LED(interactive_ui):
     def clear_plots(self):
         self.I_GS_vs_time.clear()
         self.I_DS_vs_time.clear()
-        
+        self.live_plot.clear()
+
     def create_new_plot_lines(self):
         pen_I = pg.mkPen(color='r')
-        self.I_GS_vs_time_line = self.I_GS_vs_time.plot(self.data['time'], self.data['I_GS'], pen=pen_I )
-        self.I_DS_vs_time_line = self.I_DS_vs_time.plot(self.data['time'], self.data['I_DS'], pen=pen_I )
+        self.I_GS_vs_time_line = self.live_plot.add_line(self.I_GS_vs_time, pen=pen_I )
+        self.I_DS_vs_time_line = self.live_plot.add_line(self.I_DS_vs_time, pen=pen_I )
     
     def update_plots(self):
-        self.I_GS_vs_time_line.setData(self.data['time'], self.data['I_GS'] )
-        self.I_DS_vs_time_line.setData(self.data['time'], self.data['I_DS'] )
+        """ plot acquired data, lines are redrawn at a limited frame rate """
+        self.I_GS_vs_time_line.set_data(self.data['time'], self.data['I_GS'] )
+        self.I_DS_vs_time_line.set_data(self.data['time'], self.data['I_DS'] )
+        self.live_plot.request_update()
     
     def shutdown(self):
         self.datafile.close()
@@ -12,7 +12,12 @@ from nanomol.utils.hdf5_viewer import hdf5_viewer
 from nanomol.experiments.transistor_output_transfer import transistor_output_transfer
 from nanomol.experiments.current_vs_time import current_vs_time
 
-datafile = hdf5_datafile(mode='x')
+# set swmr to True to let other processes follow current vs time measurements while they run, e.g. run
+# utils/hdf5_viewer.py with follow_interval set and open the datafile. The file switches to SWMR mode when the
+# first current vs time measurement starts and then holds only that measurement: further measurements are
+# refused, restart with a new datafile.
+swmr = False
+datafile = hdf5_datafile(mode='x', swmr=swmr)
 smu = keithley_2600A('GPIB0::27::INSTR')
 
 experiment_app = QtWidgets.QApplication([])
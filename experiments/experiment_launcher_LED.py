@@ -13,7 +13,12 @@ from nanomol.instruments.keithley_2600_LED_driver import keithley_2600_LED_drive
 from nanomol.experiments.transistor_output_transfer_LED import transistor_output_transfer_LED
 from nanomol.experiments.current_vs_time_LED import current_vs_time_LED
 
-datafile = hdf5_datafile(mode='x')
+# set swmr to True to let other processes follow current vs time measurements while they run, e.g. run
+# utils/hdf5_viewer.py with follow_interval set and open the datafile. The file switches to SWMR mode when the
+# first current vs time measurement starts and then holds only that measurement: further measurements are
+# refused, restart with a new datafile.
+swmr = False
+datafile = hdf5_datafile(mode='x', swmr=swmr)
 smu = keithley_2600A('GPIB0::27::INSTR')
 LED_smu = keithley_2600A('GPIB0::26::INSTR')
 
@@ -17,6 +17,7 @@ from nanomol.instruments.thorlabs_MCLS1 import thorlabs_MCLS1, thorlabs_MCLS1_ui
 from nanomol.instruments.arduino_shutter_controller import arduino_shutter_controller, arduino_shutter_controller_ui
 from nanomol.utils.interactive_ui import interactive_ui
 from nanomol.utils.hdf5_datafile import hdf5_datafile
+from nanomol.utils.hdf5_writer import hdf5_writer
 from nanomol.utils.hdf5_viewer import hdf5_viewer
 from nanomol.experiments.transistor_transfer import transistor_transfer
 
@@ -62,22 +63,27 @@ class transistor_laser_scan(interactive_ui):
         self.save_scan_attrs()
         self.point_counter = 1
         self.t0 = time.time()
-        for self.position_primary in self.primary_axis_points:
-            self.primary_axis_stage.move_absolute(self.position_primary)
-            self.wait_for_motion_completed(self.primary_axis_stage)
-            for self.position_secondary in self.secondary_axis_points:
-                self.secondary_axis_stage.move_absolute(self.position_secondary)
-                self.wait_for_motion_completed(self.secondary_axis_stage)
-                self.measure_grid_point()
-                self.point_counter += 1
+        # single background writer for the whole scan, so points do not wait for their data to be written
+        self.writer = hdf5_writer(self.datafile)
+        try:
+            for self.position_primary in self.primary_axis_points:
+                self.primary_axis_stage.move_absolute(self.position_primary)
+                self.wait_for_motion_completed(self.primary_axis_stage)
+                for self.position_secondary in self.secondary_axis_points:
+                    self.secondary_axis_stage.move_absolute(self.position_secondary)
+                    self.wait_for_motion_completed(self.secondary_axis_stage)
+                    self.measure_grid_point()
+                    self.point_counter += 1
+                    if not self.grid_scan_is_running:
+                        break
+                    if self.delay_grid != 0:
+                        time.sleep(self.delay_grid)
                 if not self.grid_scan_is_running:
                     break
-                if self.delay_grid != 0:
-                    time.sleep(self.delay_grid)
-            if not self.grid_scan_is_running:
-                break
-        self.grid_scan_is_running = False
-        self.datafile.flush()
+        finally:
+            self.grid_scan_is_running = False
+            self.writer.flush()
+            self.writer.close()
         if not self.parameter_sweep_is_running:
             self.MCLS1.enable = 0
             self.MCLS1.system_enable = 0
@@ -183,17 +189,18 @@ class transistor_laser_scan(interactive_ui):
         self.laserOFF_group = self.active_point_group.create_group('laser_OFF')
         self.laserOFF_group.attrs.create('laser_ON', 0)
         self.laserOFF_group.attrs.create('shutter_state', self.shutter_controller.status())
-        self.transfer.start_measurement(datafile=self.datafile, path=self.laserOFF_group.name)
+        self.transfer.start_measurement(datafile=self.datafile, path=self.laserOFF_group.name, writer=self.writer)
         self.transfer.measurement_thread.join()
         self.shutter_controller.open_shutter(self.shutter_pin_635nm)
         self.laserON_group = self.active_point_group.create_group('laser_ON')
         self.laserON_group.attrs.create('laser_ON', 1)
         self.laserON_group.attrs.create('shutter_state', self.shutter_controller.status())
-        self.transfer.start_measurement(datafile=self.datafile, path=self.laserON_group.name)
+        self.transfer.start_measurement(datafile=self.datafile, path=self.laserON_group.name, writer=self.writer)
         self.transfer.measurement_thread.join()
         self.shutter_controller.close_shutter(self.shutter_pin_635nm)
-        self.active_point_group.attrs.create('X_measured', self.stage_X.position())
-        self.active_point_group.attrs.create('Y_measured', self.stage_Y.position())
+        # queued after the data of the point, X_measured marks the point as complete once its data is written
+        self.writer.set_attrs(self.active_point_group, {'Y_measured': self.stage_Y.position(),
+                                                        'X_measured': self.stage_X.position()})
         self.update_progress()
         
     def save_scan_attrs(self):
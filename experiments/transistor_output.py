@@ -11,9 +11,10 @@ import time
 import os
 import pyqtgraph as pg
 from PyQt5 import QtWidgets, uic
-from PyQt5.QtCore import pyqtSignal
 from nanomol.instruments.keithley_2600A import keithley_2600A, keithley_2600A_ui
 from nanomol.utils.interactive_ui import interactive_ui
+from nanomol.utils.live_plot import live_plot
+from nanomol.utils.acquisition_buffer import acquisition_buffer
 
 class transistor_output(interactive_ui):
     """
@@ -24,8 +25,6 @@ class transistor_output(interactive_ui):
     Data plotting and saving can be turned on/off.
     """
     
-    update_plots_signal = pyqtSignal()
-    
     def __init__(self, smu,  datafile=None):
         super().__init__()
         if datafile is not None:
@@ -48,7 +47,7 @@ class transistor_output(interactive_ui):
         self.plot_widgets_set_up = False
         self.set_measurement_mode()
         self.setup_plot_widgets()
-        self.update_plots_signal.connect(self.update_plots)
+        self.live_plot = live_plot()
         self.set_sweep_direction()  # sweep is the external loop, V1
         self.set_sweep_loop()
         self.set_curve_direction()  # curve is the internal loop, V2
@@ -79,34 +78,33 @@ class transistor_output(interactive_ui):
                     self.save_curve_attrs()
                 # reset curve datasets for new curve
                 self.initialise_datasets()
-                self.smu.set_source_level(self.V1_ch, 'v', self.V1_active)
                 self.V2_active = self.V2[0]
-                self.smu.set_source_level(self.V2_ch, 'v', self.V2_active)
                 # prepare new plot line for upcoming data
                 if self.live_plotting_checkBox.isChecked():
                     self.create_new_plot_lines()
                 self.color_index += 1
-                self.smu.set_output(self.V2_ch, 1)
+                with self.smu.batch_writes():
+                    self.smu.set_source_level(self.V1_ch, 'v', self.V1_active)
+                    self.smu.set_source_level(self.V2_ch, 'v', self.V2_active)
+                    self.smu.set_output(self.V2_ch, 1)
                 if self.first_point_delay != 0:
                     time.sleep(self.first_point_delay)
                 t0 = time.time()
                 for self.V2_active in self.V2:
                     self.smu.set_source_level(self.V2_ch, 'v', self.V2_active)
-                    measured_I1, measured_V1 = self.smu.measure(self.V1_ch, 'iv')
-                    measured_I2, measured_V2 = self.smu.measure(self.V2_ch, 'iv')
-                    compliance_V1 = self.smu.get_compliance(self.V1_ch)
-                    compliance_V2 = self.smu.get_compliance(self.V2_ch)
-                    self.data[self.dataset_labels['time']].append(time.time() - t0)
-                    self.data[self.dataset_labels['measured_V1']].append(measured_V1)
-                    self.data[self.dataset_labels['measured_I1']].append(measured_I1)
-                    self.data[self.dataset_labels['measured_V2']].append(measured_V2)
-                    self.data[self.dataset_labels['measured_I2']].append(measured_I2)
-                    self.data[self.dataset_labels['calculated_V1']].append(self.V1_active)
-                    self.data[self.dataset_labels['calculated_V2']].append(self.V2_active)
-                    self.data[self.dataset_labels['compliance_V1']].append(compliance_V1)
-                    self.data[self.dataset_labels['compliance_V2']].append(compliance_V2)
+                    (measured_I1, measured_V1, measured_I2, measured_V2,
+                     compliance_V1, compliance_V2) = self.smu.measure_iv_compliance(self.V1_ch, self.V2_ch)
+                    self.data.add_point({self.dataset_labels['time']: time.time() - t0,
+                                         self.dataset_labels['measured_V1']: measured_V1,
+                                         self.dataset_labels['measured_I1']: measured_I1,
+                                         self.dataset_labels['measured_V2']: measured_V2,
+                                         self.dataset_labels['measured_I2']: measured_I2,
+                                         self.dataset_labels['calculated_V1']: self.V1_active,
+                                         self.dataset_labels['calculated_V2']: self.V2_active,
+                                         self.dataset_labels['compliance_V1']: compliance_V1,
+                                         self.dataset_labels['compliance_V2']: compliance_V2})
                     if self.live_plotting_checkBox.isChecked():
-                        self.update_plots_signal.emit()
+                        self.update_plots()
                     if not self.measurement_is_running:
                         break
                     if self.delay_points != 0:
@@ -125,8 +123,9 @@ class transistor_output(interactive_ui):
         """
         Define voltages to apply, save instrument settings and basic attributes.
         """
-        self.smu.set_source_function('a', 1)
-        self.smu.set_source_function('b', 1)
+        with self.smu.batch_writes():
+            self.smu.set_source_function('a', 1)
+            self.smu.set_source_function('b', 1)
         self.V1_ch, self.V2_ch = self.ch_GS, self.ch_DS
         self.V1 = np.arange(self.V_GS_min_output, self.V_GS_max_output + self.V_GS_step_output, self.V_GS_step_output)
         self.V2 = np.arange(self.V_DS_min_output, self.V_DS_max_output + self.V_DS_step_output, self.V_DS_step_output)
@@ -153,10 +152,8 @@ class transistor_output(interactive_ui):
             self.save_sweep_attrs()
     
     def initialise_datasets(self):
-        # initialise all datasets with empty lists
-        self.data = {}
-        for label in self.dataset_labels.values():
-            self.data[label] = []
+        # preallocate datasets for all points of a curve
+        self.data = acquisition_buffer(self.dataset_labels.values(), capacity=len(self.V2))
             
     def save_sweep_attrs(self):
         active_sweep_name = self.datafile.get_unique_group_name(self.datafile, basename='sweep', max_N=1000)
@@ -182,9 +179,8 @@ class transistor_output(interactive_ui):
         # write data to hdf5 datafile
         for dataset_name, data in self.data.items():
             if dataset_name == 'time':  # shift time to start from zero
-                data = np.array(data)
-                data -= data[0]
-            self.active_curve_group.create_dataset(dataset_name, data=np.array(data) )
+                data = data - data[0]
+            self.datafile.create_compressed_dataset(self.active_curve_group, dataset_name, data=data)
         self.datafile.flush()
     
     def set_measurement_mode(self):
@@ -237,6 +233,7 @@ class transistor_output(interactive_ui):
     def clear_plots(self):
         self.I2_vs_V2.clear()
         self.I1_vs_V2.clear()
+        self.live_plot.clear()
     
     def set_plot_labels(self):
         # setting labels when measurement thread is already running seems to crash the program
@@ -251,18 +248,15 @@ class transistor_output(interactive_ui):
     def create_new_plot_lines(self):
         color = pg.intColor(self.color_index, hues=self.V1.size*self.N_measurements)
         pen = pg.mkPen(color=color)
-        self.I2_vs_V2_line = self.I2_vs_V2.plot(self.data[self.dataset_labels['measured_V2']],
-                                                self.data[self.dataset_labels['measured_I2']],
-                                                pen=pen, name='V_{}={}'.format(self.V1_label, self.V1_active) )
-        self.I1_vs_V2_line = self.I1_vs_V2.plot(self.data[self.dataset_labels['measured_V2']],
-                                                self.data[self.dataset_labels['measured_I1']],
-                                                pen=pen, name='V_{}={}'.format(self.V1_label, self.V1_active) )
+        self.I2_vs_V2_line = self.live_plot.add_line(self.I2_vs_V2, pen=pen, name='V_{}={}'.format(self.V1_label, self.V1_active) )
+        self.I1_vs_V2_line = self.live_plot.add_line(self.I1_vs_V2, pen=pen, name='V_{}={}'.format(self.V1_label, self.V1_active) )
         
     def update_plots(self):
-        self.I2_vs_V2_line.setData(self.data[self.dataset_labels['measured_V2']],
-                                   self.data[self.dataset_labels['measured_I2']] )
-        self.I1_vs_V2_line.setData(self.data[self.dataset_labels['measured_V2']],
-                                   self.data[self.dataset_labels['measured_I1']] )
+        """ plot measured data of current curve, lines are redrawn at a limited frame rate """
+        V2 = self.data[self.dataset_labels['measured_V2']]
+        self.I2_vs_V2_line.set_data(V2, self.data[self.dataset_labels['measured_I2']])
+        self.I1_vs_V2_line.set_data(V2, self.data[self.dataset_labels['measured_I1']])
+        self.live_plot.request_update()
     
     def shutdown(self):
         self.datafile.close()
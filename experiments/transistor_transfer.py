@@ -11,9 +11,11 @@ import time
 import os
 import pyqtgraph as pg
 from PyQt5 import QtWidgets, uic
-from PyQt5.QtCore import pyqtSignal
 from nanomol.instruments.keithley_2600A import keithley_2600A, keithley_2600A_ui
 from nanomol.utils.interactive_ui import interactive_ui
+from nanomol.utils.live_plot import live_plot
+from nanomol.utils.acquisition_buffer import acquisition_buffer
+from nanomol.utils.hdf5_writer import hdf5_writer
 
 class transistor_transfer(interactive_ui):
     """
@@ -24,8 +26,6 @@ class transistor_transfer(interactive_ui):
     Data plotting and saving can be turned on/off.
     """
     
-    update_plots_signal = pyqtSignal()
-    
     def __init__(self, smu,  datafile=None):
         super().__init__()
         if datafile is not None:
@@ -51,14 +51,14 @@ class transistor_transfer(interactive_ui):
         self.set_measurement_mode()
         self.set_smu_interaction_mode()
         self.setup_plot_widgets()
-        self.update_plots_signal.connect(self.update_plots)
+        self.live_plot = live_plot()
         self.set_sweep_direction()  # sweep is the external loop, V1
         self.set_sweep_loop()
         self.set_curve_direction()  # curve is the internal loop, V2
         self.set_curve_loop()
         self.measurement_is_running = False  # flag to start and stop a measurement
     
-    def start_measurement(self, *args, datafile=None, path=None):
+    def start_measurement(self, *args, datafile=None, path=None, writer=None):
         """
         datafile : hdf5 datafile [optional, default=None]
             hdf5 data file where data of the measurement will be saved. Useful when calling externally.
@@ -68,6 +68,11 @@ class transistor_transfer(interactive_ui):
             Path to hdf5 group within passed datafile where data is to be saved.
             Usually generated within calling environment using hdf5_group.name
             If not passed defaults to saving in root group of default_datafile.
+        
+        writer : hdf5_writer [optional, default=None]
+            background writer of datafile used to save data, e.g. shared by all measurements of a scan so that
+            each measurement ends without waiting for its data to be written. It is not closed at the end of the
+            measurement. If not passed a writer is created for the measurement and closed at its end.
         """
         # *args captures unnecessary arguments passed by qt buttons
         if datafile is not None:
@@ -81,6 +86,10 @@ class transistor_transfer(interactive_ui):
                 self.data_path = None
         if not self.measurement_is_running:  # do nothing if measurement is already running
             self.measurement_is_running = True
+            if self.data_path is not None:
+                # data is written in the background while the measurement continues
+                self.owns_writer = writer is None
+                self.writer = hdf5_writer(self.datafile) if writer is None else writer
             if self.smu_interaction_mode == 'real_time':
                 self.measurement_thread = threading.Thread(target=self.run_measurement)
             elif self.smu_interaction_mode == 'scripted':
@@ -92,6 +101,13 @@ class transistor_transfer(interactive_ui):
             self.measurement_is_running = False
             
     def run_measurement(self):
+        try:
+            self.run_sweep()
+        finally:
+            self.close_writer()
+            self.measurement_is_running = False
+    
+    def run_sweep(self):
         self.configure_measurement()
         self.clear_plots()
         # set channels to start from first point when output is turned on
@@ -105,35 +121,34 @@ class transistor_transfer(interactive_ui):
                     self.save_curve_attrs()
                 # reset curve datasets for new curve
                 self.initialise_datasets()
-                self.smu.set_source_level(self.V1_ch, 'v', self.V1_active)
                 self.V2_active = self.V2[0]
-                self.smu.set_source_level(self.V2_ch, 'v', self.V2_active)
                 # prepare new plot line for upcoming data
                 if self.live_plotting_checkBox.isChecked():
                     self.create_new_plot_lines()
                 self.color_index += 1
-                self.smu.set_output(self.V1_ch, 1)
-                self.smu.set_output(self.V2_ch, 1)
+                with self.smu.batch_writes():
+                    self.smu.set_source_level(self.V1_ch, 'v', self.V1_active)
+                    self.smu.set_source_level(self.V2_ch, 'v', self.V2_active)
+                    self.smu.set_output(self.V1_ch, 1)
+                    self.smu.set_output(self.V2_ch, 1)
                 if self.first_point_delay != 0:
                     time.sleep(self.first_point_delay)
                 t0 = time.time()
                 for self.V2_active in self.V2:
                     self.smu.set_source_level(self.V2_ch, 'v', self.V2_active)
-                    measured_I1, measured_V1 = self.smu.measure(self.V1_ch, 'iv')
-                    measured_I2, measured_V2 = self.smu.measure(self.V2_ch, 'iv')
-                    compliance_V1 = self.smu.get_compliance(self.V1_ch)
-                    compliance_V2 = self.smu.get_compliance(self.V2_ch)
-                    self.data[self.dataset_labels['time']].append(time.time() - t0)
-                    self.data[self.dataset_labels['measured_V1']].append(measured_V1)
-                    self.data[self.dataset_labels['measured_I1']].append(measured_I1)
-                    self.data[self.dataset_labels['measured_V2']].append(measured_V2)
-                    self.data[self.dataset_labels['measured_I2']].append(measured_I2)
-                    self.data[self.dataset_labels['calculated_V1']].append(self.V1_active)
-                    self.data[self.dataset_labels['calculated_V2']].append(self.V2_active)
-                    self.data[self.dataset_labels['compliance_V1']].append(compliance_V1)
-                    self.data[self.dataset_labels['compliance_V2']].append(compliance_V2)
+                    (measured_I1, measured_V1, measured_I2, measured_V2,
+                     compliance_V1, compliance_V2) = self.smu.measure_iv_compliance(self.V1_ch, self.V2_ch)
+                    self.data.add_point({self.dataset_labels['time']: time.time() - t0,
+                                         self.dataset_labels['measured_V1']: measured_V1,
+                                         self.dataset_labels['measured_I1']: measured_I1,
+                                         self.dataset_labels['measured_V2']: measured_V2,
+                                         self.dataset_labels['measured_I2']: measured_I2,
+                                         self.dataset_labels['calculated_V1']: self.V1_active,
+                                         self.dataset_labels['calculated_V2']: self.V2_active,
+                                         self.dataset_labels['compliance_V1']: compliance_V1,
+                                         self.dataset_labels['compliance_V2']: compliance_V2})
                     if self.live_plotting_checkBox.isChecked():
-                        self.update_plots_signal.emit()
+                        self.update_plots()
                     if not self.measurement_is_running:
                         break
                     if self.delay_points != 0:
@@ -148,14 +163,19 @@ class transistor_transfer(interactive_ui):
                     time.sleep(self.delay_curves)
             if not self.measurement_is_running:
                 break
-        self.measurement_is_running = False
+    
+    def close_writer(self):
+        """ write queued data and stop the writer, unless it was passed to start_measurement by the caller """
+        if self.data_path is not None and self.owns_writer:
+            self.writer.close()
             
     def configure_measurement(self):
         """
         Define voltages to apply, save instrument settings and basic attributes.
         """
-        self.smu.set_source_function('a', 1)
-        self.smu.set_source_function('b', 1)
+        with self.smu.batch_writes():
+            self.smu.set_source_function('a', 1)
+            self.smu.set_source_function('b', 1)
         self.V1_ch, self.V2_ch = self.ch_DS, self.ch_GS
         self.V1 = np.arange(self.V_DS_min_transfer, self.V_DS_max_transfer + self.V_DS_step_transfer, self.V_DS_step_transfer)
         self.V2 = np.arange(self.V_GS_min_transfer, self.V_GS_max_transfer + self.V_GS_step_transfer, self.V_GS_step_transfer)
@@ -182,61 +202,110 @@ class transistor_transfer(interactive_ui):
             self.save_sweep_attrs()
     
     def initialise_datasets(self):
-        # initialise all datasets with empty lists
-        self.data = {}
-        for label in self.dataset_labels.values():
-            self.data[label] = []
+        # preallocate datasets for all points of a curve
+        self.data = acquisition_buffer(self.dataset_labels.values(), capacity=len(self.V2))
             
     def save_sweep_attrs(self):
         active_sweep_name = self.datafile.get_unique_group_name(self.data_path, basename=self.description, max_N=1000)
         self.active_sweep_group =  self.data_path.create_group(active_sweep_name)
-        self.active_sweep_group.attrs.create('description', self.description)
-        self.active_sweep_group.attrs.create('measurement_mode', self.measurement_mode)
-        self.active_sweep_group.attrs.create('GS_channel', self.ch_GS)
-        self.active_sweep_group.attrs.create('DS_channel', self.ch_DS)
-        self.active_sweep_group.attrs.create('smu_interaction_mode', self.smu_interaction_mode)
+        sweep_attrs = {}
+        sweep_attrs['description'] = self.description
+        sweep_attrs['measurement_mode'] = self.measurement_mode
+        sweep_attrs['GS_channel'] = self.ch_GS
+        sweep_attrs['DS_channel'] = self.ch_DS
+        sweep_attrs['smu_interaction_mode'] = self.smu_interaction_mode
         for key, value in self.smu.get_settings().items():
-            self.active_sweep_group.attrs.create('keithley_{}'.format(key), value)
-        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time()) )
-        self.active_sweep_group.attrs.create('timestamp', timestamp )
+            sweep_attrs['keithley_{}'.format(key)] = value
+        sweep_attrs['timestamp'] = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time()) )
+        # compact layout saves all curves in a table in the sweep group, instead of a group per curve
+        self.compact_layout = self.compact_layout_checkBox.isChecked()
+        sweep_attrs['storage_layout'] = 'compact' if self.compact_layout else 'groups'
+        if self.compact_layout:
+            self.curve_table = self.datafile.get_curve_table(self.active_sweep_group)
+        self.writer.set_attrs(self.active_sweep_group, sweep_attrs)
     
     def save_curve_attrs(self):
+        self.curve_attrs = {}
+        self.curve_attrs['timestamp'] = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time()) )
+        self.curve_attrs['V_{}'.format(self.V1_label)] = self.V1_active
+        self.curve_attrs['measurement_counter'] = self.measurement_counter
+        if self.compact_layout:
+            # attributes are saved in the curve table together with the curve data
+            return
+        # the curve group is created by the writer, so the measurement does not wait for the datafile.
+        # Names are unique without the group existing yet, since get_unique_group_name counts names it returned
         active_curve_name = self.datafile.get_unique_group_name(self.active_sweep_group, basename='curve', max_N=10000)
-        self.active_curve_group = self.active_sweep_group.create_group(active_curve_name)
-        timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time()) )
-        self.active_curve_group.attrs.create('timestamp', timestamp )
-        self.active_curve_group.attrs.create('V_{}'.format(self.V1_label), data=self.V1_active)
-        self.active_curve_group.attrs.create('measurement_counter', data=self.measurement_counter)
+        self.active_curve_group = self.writer.create_group(self.active_sweep_group, active_curve_name)
+        self.writer.set_attrs(self.active_curve_group, self.curve_attrs)
         
     def save_data(self):
-        # write data to hdf5 datafile
+        # queue data to be written to hdf5 datafile by the background writer
+        curve_data = {}
         for dataset_name, data in self.data.items():
             if dataset_name == 'time':  # shift time to start from zero
-                data = np.array(data)
-                data -= data[0]
-            self.active_curve_group.create_dataset(dataset_name, data=np.array(data) )
-        self.data_path.file.flush()
+                data = data - data[0]
+            curve_data[dataset_name] = data
+        if self.compact_layout:
+            self.writer.submit(self.curve_table.append_curve, curve_data, self.curve_attrs)
+        else:
+            for dataset_name, data in curve_data.items():
+                # data is not modified after the curve is saved, no copy needed
+                self.writer.create_dataset(self.active_curve_group, dataset_name, data, copy=False)
+        self.writer.flush()
     
-    def run_scripted_measurement(self):
-        self.configure_scripted_measurement()
-        for self.measurement_counter in range(self.N_measurements):
-            for self.V1_active in self.V1:
-                if self.first_point_delay != 0.0:
-                    self.smu.set_source_level(self.V1_ch, 'v', self.V1_active)
-                    self.smu.set_source_level(self.V2_ch, 'v', self.V_script_start)
-                    self.smu.set_output(self.V1_ch, 1)
-                    self.smu.set_output(self.V2_ch, 1)
-                    time.sleep(self.first_point_delay)
-                self.smu.set_source_level(self.V1_ch, 'v', self.V1_active)
-                self.smu.run_script_until_operation_complete(self.transfer_script_label, timeout=60000)
-                self.save_smu_buffer_data()
+    def run_scripted_measurement(self, poll_interval=0.2):
+        """
+        Run all curves of each sweep on the instrument with a single function call, then read and save them.
+        Sweeps with more readings than the instrument buffers can hold are split into segments of whole curves,
+        each run with its own function call and saved before the next one starts.
+        While a segment runs, completion is polled every poll_interval seconds, so that stop_measurement()
+        aborts the sweep, keeping its completed curves. If a segment takes much longer than expected from the
+        number of points and their integration time, it is aborted and TimeoutError is raised.
+        """
+        try:
+            self.configure_scripted_measurement()
+            for self.measurement_counter in range(self.N_measurements):
+                for V1_segment in self.V1_segments:
+                    timeout = self.estimate_scripted_sweep_time(V1_segment.size)*2 + 10
+                    self.smu.start_function(self.transfer_function_name, *self.transfer_function_args,
+                                            V1_segment, self.first_point_delay)
+                    t_start = time.time()
+                    timed_out = False
+                    while not self.smu.wait_for_operation_complete(int(poll_interval*1000)):
+                        timed_out = time.time() - t_start > timeout
+                        if timed_out or not self.measurement_is_running:
+                            self.smu.abort_function()
+                            self.smu.abort(self.V1_ch)
+                            self.smu.abort(self.V2_ch)
+                            self.measurement_is_running = False
+                            break
+                    if self.data_path is not None:
+                        self.save_smu_buffer_data(V1_segment)
+                    if timed_out:
+                        raise TimeoutError('scripted sweep not completed after {:.0f} s'.format(timeout))
+                    if not self.measurement_is_running:
+                        break
                 if not self.measurement_is_running:
                     break
-            if not self.measurement_is_running:
-                break
-        self.measurement_is_running = False
-        self.set_to_idle(self.V1_ch)
-        self.set_to_idle(self.V2_ch)
+        finally:
+            self.close_writer()
+            self.measurement_is_running = False
+            self.set_to_idle(self.V1_ch)
+            self.set_to_idle(self.V2_ch)
+    
+    def estimate_scripted_sweep_time(self, N_curves):
+        """
+        N_curves : int
+            number of curves run by the function call
+
+        Returns
+        sweep_time : float
+            expected duration in s of a scripted sweep, from the number of points, the integration time of
+            current and voltage readings of each point and the delay before each curve
+        """
+        nplc = max(self.smu.get_nplc(self.V1_ch), self.smu.get_nplc(self.V2_ch))
+        point_time = 2 * nplc / self.smu.get_line_frequency()
+        return N_curves * (self.first_point_delay + self.N_curve_points*point_time)
     
     def configure_scripted_measurement(self):
         self.V1_ch, self.V2_ch = self.ch_DS, self.ch_GS
@@ -248,32 +317,61 @@ class transistor_transfer(interactive_ui):
             V_script_step = -self.V_GS_step_transfer
         else:
             self.V_script_start, self.V_script_end = self.V_GS_min_transfer, self.V_GS_max_transfer
-        transfer_script = self.smu.generate_linear_iv_sweep_script(self.V2_ch,
-                                                                   self.V_script_start,
-                                                                   self.V_script_end,
-                                                                   V_script_step,
-                                                                   loop=self.curve_loop,
-                                                                   secondary_ch=self.V1_ch)
-        self.transfer_script_label = 'transfer_script'
-        self.smu.load_script(transfer_script, script_name=self.transfer_script_label)
-        self.save_sweep_attrs()
+            V_script_step = self.V_GS_step_transfer
+        N_script_points = round( (self.V_script_end - self.V_script_start) / V_script_step ) +1
+        # number of points of each curve stored in the instrument buffers
+        self.N_curve_points = N_script_points
+        if self.curve_loop:
+            self.N_curve_points *= 2
+        # sweep function is only uploaded if it changed, each measurement sends a single function call
+        self.transfer_function_name = 'transfer_sweep_{}'.format('loop' if self.curve_loop else 'one_way')
+        transfer_script = self.smu.generate_nested_iv_sweep_function(self.transfer_function_name,
+                                                                     self.V2_ch,
+                                                                     self.V1_ch,
+                                                                     loop=self.curve_loop)
+        self.smu.load_function_script(transfer_script, script_name='{}_script'.format(self.transfer_function_name))
+        # all readings of a function call must fit in the buffers, longer sweeps are split into segments
+        buffer_capacity = min(self.smu.get_buffer_capacity('smu{}.nvbuffer1'.format(self.V1_ch)),
+                              self.smu.get_buffer_capacity('smu{}.nvbuffer1'.format(self.V2_ch)))
+        N_segment_curves = buffer_capacity // self.N_curve_points
+        if N_segment_curves == 0:
+            raise ValueError('curves of {} points do not fit in the instrument buffers of {} readings'.format(
+                             self.N_curve_points, buffer_capacity))
+        self.V1_segments = [self.V1[i:i+N_segment_curves] for i in range(0, self.V1.size, N_segment_curves)]
+        # arguments before the V1 values and delay of each segment
+        self.transfer_function_args = (self.V_script_start,
+                                       self.V_script_end,
+                                       N_script_points)
+        if self.data_path is not None:
+            self.save_sweep_attrs()
     
-    def save_smu_buffer_data(self):
-        self.save_curve_attrs()
+    def save_smu_buffer_data(self, V1_values):
+        """
+        Read buffers of a sweep segment at once and save each curve in its own group.
+        
+        V1_values : numpy array
+            V1 values of the curves run by the segment
+        """
         data_types = ['readings', 'sourcevalues', 'timestamps']
-        DS_I_buffer = self.smu.read_buffer('smu{}.nvbuffer1'.format(self.ch_DS), data_types)
-        GS_I_buffer = self.smu.read_buffer('smu{}.nvbuffer1'.format(self.ch_GS), data_types)
+        DS_I_buffer = self.smu.read_buffer('smu{}.nvbuffer1'.format(self.ch_DS), data_types, binary=True)
+        GS_I_buffer = self.smu.read_buffer('smu{}.nvbuffer1'.format(self.ch_GS), data_types, binary=True)
         data_types = ['readings']
-        DS_V_buffer = self.smu.read_buffer('smu{}.nvbuffer2'.format(self.ch_DS), data_types)
-        GS_V_buffer = self.smu.read_buffer('smu{}.nvbuffer2'.format(self.ch_GS), data_types)
-        self.data = {'time' : DS_I_buffer['timestamps'],
-                     'measured_I_DS' : DS_I_buffer['readings'],
-                     'measured_V_DS' : DS_V_buffer['readings'],
-                     'measured_I_GS' : GS_I_buffer['readings'],
-                     'measured_V_GS' : GS_V_buffer['readings'],
-                     'calculated_V_DS' : DS_I_buffer['sourcevalues'],
-                     'calculated_V_GS' : GS_I_buffer['sourcevalues']}
-        self.save_data()
+        DS_V_buffer = self.smu.read_buffer('smu{}.nvbuffer2'.format(self.ch_DS), data_types, binary=True)
+        GS_V_buffer = self.smu.read_buffer('smu{}.nvbuffer2'.format(self.ch_GS), data_types, binary=True)
+        # sweeps that were aborted only have their completed curves saved
+        N_stored = min([buffer['readings'].size for buffer in [DS_I_buffer, GS_I_buffer, DS_V_buffer, GS_V_buffer]])
+        N_completed_curves = N_stored // self.N_curve_points
+        for curve_index, self.V1_active in enumerate(V1_values[:N_completed_curves]):
+            curve = slice(curve_index*self.N_curve_points, (curve_index+1)*self.N_curve_points)
+            self.save_curve_attrs()
+            self.data = {'time' : DS_I_buffer['timestamps'][curve],
+                         'measured_I_DS' : DS_I_buffer['readings'][curve],
+                         'measured_V_DS' : DS_V_buffer['readings'][curve],
+                         'measured_I_GS' : GS_I_buffer['readings'][curve],
+                         'measured_V_GS' : GS_V_buffer['readings'][curve],
+                         'calculated_V_DS' : DS_I_buffer['sourcevalues'][curve],
+                         'calculated_V_GS' : GS_I_buffer['sourcevalues'][curve]}
+            self.save_data()
     
     def set_measurement_mode(self):
         self.measurement_mode = 'transfer'
@@ -331,6 +429,7 @@ class transistor_transfer(interactive_ui):
     def clear_plots(self):
         self.I2_vs_V2.clear()
         self.I1_vs_V2.clear()
+        self.live_plot.clear()
     
     def set_plot_labels(self):
         # setting labels when measurement thread is already running seems to crash the program
@@ -345,18 +444,15 @@ class transistor_transfer(interactive_ui):
     def create_new_plot_lines(self):
         color = pg.intColor(self.color_index, hues=self.V1.size*self.N_measurements)
         pen = pg.mkPen(color=color)
-        self.I2_vs_V2_line = self.I2_vs_V2.plot(self.data[self.dataset_labels['measured_V2']],
-                                                self.data[self.dataset_labels['measured_I2']],
-                                                pen=pen, name='V_{}={}'.format(self.V1_label, self.V1_active) )
-        self.I1_vs_V2_line = self.I1_vs_V2.plot(self.data[self.dataset_labels['measured_V2']],
-                                                self.data[self.dataset_labels['measured_I1']],
-                                                pen=pen, name='V_{}={}'.format(self.V1_label, self.V1_active) )
+        self.I2_vs_V2_line = self.live_plot.add_line(self.I2_vs_V2, pen=pen, name='V_{}={}'.format(self.V1_label, self.V1_active) )
+        self.I1_vs_V2_line = self.live_plot.add_line(self.I1_vs_V2, pen=pen, name='V_{}={}'.format(self.V1_label, self.V1_active) )
         
     def update_plots(self):
-        self.I2_vs_V2_line.setData(self.data[self.dataset_labels['measured_V2']],
-                                   self.data[self.dataset_labels['measured_I2']] )
-        self.I1_vs_V2_line.setData(self.data[self.dataset_labels['measured_V2']],
-                                   self.data[self.dataset_labels['measured_I1']] )
+        """ plot measured data of current curve, lines are redrawn at a limited frame rate """
+        V2 = self.data[self.dataset_labels['measured_V2']]
+        self.I2_vs_V2_line.set_data(V2, self.data[self.dataset_labels['measured_I2']])
+        self.I1_vs_V2_line.set_data(V2, self.data[self.dataset_labels['measured_I1']])
+        self.live_plot.request_update()
     
     def set_to_idle(self, ch):
         """
@@ -6,6 +6,8 @@ Created on Wed Aug 16 14:47:39 2023
 """
 
 import os
+import time
+import hashlib
 import numpy as np
 import pyvisa
 from PyQt5 import QtWidgets, uic
@@ -13,10 +15,92 @@ from nanomol.instruments.visa_instrument import visa_instrument
 
 class keithley_2600A(visa_instrument):
     
-    def __init__(self, address=''):
+    def __init__(self, address='', state_cache=False):
+        """
+        address : str
+            instrument VISA address
+        state_cache : bool, optional
+            if True, keep a write-through cache of source/measure settings, skipping writes that would not change
+            the instrument state and serving getters from the cache. The default is False.
+        """
         super().__init__(address)
+        self.state_cache_enabled = state_cache
+        self.state_cache = {}
+        self.state_cache_counters = {'writes_avoided': 0, 'queries_avoided': 0}
+        self.loaded_scripts = {}  # script name: hash of script commands, to avoid reloading identical scripts
         self.reset()
     
+    def enable_state_cache(self, enabled=True):
+        """
+        enabled : bool, optional
+            turn the settings cache on or off. The cache and its counters are cleared in both cases.
+        """
+        self.state_cache_enabled = enabled
+        self.clear_state_cache()
+        self.state_cache_counters = {'writes_avoided': 0, 'queries_avoided': 0}
+    
+    def clear_state_cache(self):
+        """
+        Forget all cached settings, e.g. after the instrument state was changed by a script or a reset.
+        The next getter call of each setting will query the instrument.
+        """
+        self.state_cache = {}
+    
+    def write_setting(self, setting, command, value, value_type=float, coerced=False):
+        """
+        Write command that sets an instrument setting, skipping the write if the cached value is unchanged.
+        
+        setting : str
+            cache key of the setting, for example 'a_source_levelv'
+        command : str
+            TSP command that sets the setting
+        value : int, float or str
+            value of the setting sent with command
+        value_type : type, optional
+            type of the value as returned by the corresponding getter. The default is float.
+        coerced : bool, optional
+            True for settings that the instrument may apply with a different value than written, e.g. ranges
+            and limits rounded to the available ones. The written value is then not cached, and the next getter
+            call queries the applied value. The default is False.
+        """
+        try:
+            value = value_type(value)
+        except (ValueError, TypeError):
+            # e.g. non numeric range settings, never cached
+            value = None
+        if self.state_cache_enabled and value is not None and self.state_cache.get(setting) == value:
+            self.state_cache_counters['writes_avoided'] += 1
+            return
+        self.write(command)
+        if self.state_cache_enabled:
+            if value is None or coerced:
+                self.state_cache.pop(setting, None)
+            else:
+                self.state_cache[setting] = value
+    
+    def query_setting(self, setting, command, value_type=float):
+        """
+        Query an instrument setting, or return it from the cache if available.
+        
+        setting : str
+            cache key of the setting, for example 'a_source_levelv'
+        command : str
+            TSP command that prints the setting
+        value_type : type, optional
+            type of the returned value. The default is float.
+
+        Returns
+        value : value_type
+            value of the setting
+        """
+        if self.state_cache_enabled and setting in self.state_cache:
+            self.state_cache_counters['queries_avoided'] += 1
+            return self.state_cache[setting]
+        value = value_type( float( self.query(command) ) )
+        if self.state_cache_enabled:
+            self.state_cache[setting] = value
+        return value
+    
     def get_source_function(self, ch):
         """
         ch : str
@@ -26,7 +110,7 @@ class keithley_2600A(visa_instrument):
         function : int
             source function type, 0 for current source, 1 for voltage source
         """
-        return int( float( self.query('print(smu{}.source.func)'.format(ch)) ) )
+        return self.query_setting('{}_source_func'.format(ch), 'print(smu{}.source.func)'.format(ch), int)
     
     def set_source_function(self, ch, function):
         """
@@ -35,7 +119,7 @@ class keithley_2600A(visa_instrument):
         function : int
             0 for current source, 1 for voltage source
         """
-        self.write('smu{}.source.func = {}'.format(ch, function))
+        self.write_setting('{}_source_func'.format(ch), 'smu{}.source.func = {}'.format(ch, function), function, int)
     
     def get_source_level(self, ch, Y):
         """
@@ -48,7 +132,7 @@ class keithley_2600A(visa_instrument):
         level : float
             source output level
         """
-        return float( self.query('print(smu{}.source.level{})'.format(ch, Y) ) )
+        return self.query_setting('{}_source_level{}'.format(ch, Y), 'print(smu{}.source.level{})'.format(ch, Y))
     
     def set_source_level(self, ch, Y, level):
         """
@@ -59,8 +143,7 @@ class keithley_2600A(visa_instrument):
         level : float
             voltage in V or current in A
         """
-        
-        self.write('smu{}.source.level{} = {}'.format(ch, Y, level) )
+        self.write_setting('{}_source_level{}'.format(ch, Y), 'smu{}.source.level{} = {}'.format(ch, Y, level), level)
         
     def get_source_limit(self, ch, Y):
         """
@@ -73,7 +156,7 @@ class keithley_2600A(visa_instrument):
         limit : float
             source compliance limit
         """
-        return float( self.query('print(smu{}.source.limit{})'.format(ch, Y)) )
+        return self.query_setting('{}_source_limit{}'.format(ch, Y), 'print(smu{}.source.limit{})'.format(ch, Y))
         
     def set_source_limit(self, ch, Y, limit):
         """       
@@ -84,7 +167,8 @@ class keithley_2600A(visa_instrument):
         limit : float
             compliance limit; voltage in V or current in A
         """
-        self.write('smu{}.source.limit{} = {}'.format(ch, Y, limit) )
+        self.write_setting('{}_source_limit{}'.format(ch, Y), 'smu{}.source.limit{} = {}'.format(ch, Y, limit), limit,
+                           coerced=True)
         
     def get_source_range(self, ch, Y):
         """
@@ -97,7 +181,7 @@ class keithley_2600A(visa_instrument):
         range : float
             source range setting
         """
-        return float( self.query('print(smu{}.source.range{})'.format(ch, Y)) )
+        return self.query_setting('{}_source_range{}'.format(ch, Y), 'print(smu{}.source.range{})'.format(ch, Y))
         
     def set_source_range(self, ch, Y, range_value):
         """       
@@ -108,7 +192,8 @@ class keithley_2600A(visa_instrument):
         range_value : float
             source range; voltage in V or current in A
         """
-        self.write('smu{}.source.range{} = {}'.format(ch, Y, range_value) )
+        self.write_setting('{}_source_range{}'.format(ch, Y), 'smu{}.source.range{} = {}'.format(ch, Y, range_value),
+                           range_value, coerced=True)
         
     def measure(self, ch, Y):
         """
@@ -127,7 +212,29 @@ class keithley_2600A(visa_instrument):
             return [float(i) for i in measurement]
         else:
             return self.query('print(smu{}.measure.{}())'.format(ch, Y))
-        
+
+    def measure_iv_compliance(self, ch1, ch2):
+        """
+        Measure current and voltage on two channels and read both compliance states with a single query.
+
+        ch1 : str
+            first channel, 'a' or 'b'
+        ch2 : str
+            second channel, 'a' or 'b'
+
+        Returns
+        measurement : [float, float, float, float, int, int]
+            I and V measured on ch1, I and V measured on ch2, compliance state of ch1 and of ch2.
+            Compliance is 0 if source not in compliance, 1 if source in compliance.
+        """
+        command = ('i1, v1 = smu{0}.measure.iv() '
+                   'i2, v2 = smu{1}.measure.iv() '
+                   'print(i1, v1, i2, v2, smu{0}.source.compliance, smu{1}.source.compliance)'.format(ch1, ch2))
+        reply = self.query(command).split('\t')
+        measurement = [float(value) for value in reply[:4]]
+        measurement.extend( [int(state == 'true') for state in reply[4:6]] )
+        return measurement
+
     def get_measure_range(self, ch, Y):
         """
         ch : str
@@ -139,7 +246,7 @@ class keithley_2600A(visa_instrument):
         range : float
             measurement range setting
         """
-        return float( self.query('print(smu{}.measure.range{})'.format(ch, Y)) )
+        return self.query_setting('{}_measure_range{}'.format(ch, Y), 'print(smu{}.measure.range{})'.format(ch, Y))
         
     def set_measure_range(self, ch, Y, range_value):
         """       
@@ -150,7 +257,8 @@ class keithley_2600A(visa_instrument):
         range_value : float
             measurement range; voltage in V or current in A
         """
-        self.write('smu{}.measure.range{} = {}'.format(ch, Y, range_value) )
+        self.write_setting('{}_measure_range{}'.format(ch, Y), 'smu{}.measure.range{} = {}'.format(ch, Y, range_value),
+                           range_value, coerced=True)
         
     def get_nplc(self, ch):
         """
@@ -161,7 +269,7 @@ class keithley_2600A(visa_instrument):
         nplc : float
             measurement integration time in number of power line cycles (nplc)
         """
-        return float( self.query('print(smu{}.measure.nplc)'.format(ch)) )
+        return self.query_setting('{}_nplc'.format(ch), 'print(smu{}.measure.nplc)'.format(ch))
     
     def set_nplc(self, ch, nplc):
         """
@@ -170,7 +278,7 @@ class keithley_2600A(visa_instrument):
         nplc : float
             measurement integration time in number of power line cycles (nplc)
         """
-        self.write('smu{}.measure.nplc = {}'.format(ch, nplc))
+        self.write_setting('{}_nplc'.format(ch), 'smu{}.measure.nplc = {}'.format(ch, nplc), nplc, coerced=True)
         
     def get_compliance(self, ch):
         """
@@ -194,7 +302,7 @@ class keithley_2600A(visa_instrument):
         output : int
             output state, 0 for OFF, 1 for ON, 2 for OFF in HIGH Z mode
         """
-        return int( float( self.query('print(smu{}.source.output)'.format(ch)) ) )
+        return self.query_setting('{}_source_output'.format(ch), 'print(smu{}.source.output)'.format(ch), int)
     
     def set_output(self, ch, output):
         """       
@@ -203,48 +311,171 @@ class keithley_2600A(visa_instrument):
         output : int
             output state: 0 for OFF, 1 for ON, 2 for OFF in HIGH Z mode
         """
-        self.write('smu{}.source.output = {}'.format(ch, output) )
+        self.write_setting('{}_source_output'.format(ch), 'smu{}.source.output = {}'.format(ch, output), output, int)
+    
+    def write_batch(self, commands):
+        """
+        Send TSP commands joined into as few messages as possible, see visa_instrument.write_batch.
+        Commands sent directly, e.g. generated scripts, can change any setting, so the settings cache is cleared.
+        """
+        self.clear_state_cache()
+        super().write_batch(commands)
     
     def reset(self):
         self.write('reset()')
+        self.clear_state_cache()
+        self.loaded_scripts = {}
         
+    def get_line_frequency(self):
+        """
+        Returns
+        line_frequency : float
+            power line frequency in Hz, which sets the integration time of one nplc
+        """
+        return float( self.query('print(localnode.linefreq)') )
+    
     def get_settings(self):
-        settings = {'a_function': self.get_source_function('a'),
-                    'b_function': self.get_source_function('b'),
-                    'a_V_source_limit': self.get_source_limit('a', 'v'),
-                    'b_V_source_limit': self.get_source_limit('b', 'v'),
-                    'a_I_source_limit': self.get_source_limit('a', 'i'),
-                    'b_I_source_limit': self.get_source_limit('b', 'i'),
-                    'a_V_source_range': self.get_source_range('a', 'v'),
-                    'b_V_source_range': self.get_source_range('b', 'v'),
-                    'a_I_source_range': self.get_source_range('a', 'i'),
-                    'b_I_source_range': self.get_source_range('b', 'i'),
-                    'a_V_measure_range': self.get_measure_range('a', 'v'),
-                    'b_V_measure_range': self.get_measure_range('b', 'v'),
-                    'a_I_measure_range': self.get_measure_range('a', 'i'),
-                    'b_I_measure_range': self.get_measure_range('b', 'i'),
-                    'a_nplc': self.get_nplc('a'),
-                    'b_nplc': self.get_nplc('b')
-                    }
+        """
+        Read source and measure settings of both channels with a single query.
+
+        Returns
+        settings : dict
+            source function, source limits and ranges, measure ranges and nplc of channels 'a' and 'b'
+        """
+        settings_commands = {}
+        for ch in ['a', 'b']:
+            settings_commands.update({
+                '{}_function'.format(ch): 'smu{}.source.func'.format(ch),
+                '{}_V_source_limit'.format(ch): 'smu{}.source.limitv'.format(ch),
+                '{}_I_source_limit'.format(ch): 'smu{}.source.limiti'.format(ch),
+                '{}_V_source_range'.format(ch): 'smu{}.source.rangev'.format(ch),
+                '{}_I_source_range'.format(ch): 'smu{}.source.rangei'.format(ch),
+                '{}_V_measure_range'.format(ch): 'smu{}.measure.rangev'.format(ch),
+                '{}_I_measure_range'.format(ch): 'smu{}.measure.rangei'.format(ch),
+                '{}_nplc'.format(ch): 'smu{}.measure.nplc'.format(ch)
+                })
+        reply = self.query('print({})'.format(', '.join(settings_commands.values()) )).split('\t')
+        settings = {}
+        for key, value in zip(settings_commands.keys(), reply):
+            if key.endswith('_function'):
+                settings[key] = int(float(value))
+            else:
+                settings[key] = float(value)
         return settings
 
-    def load_script(self, script, script_name=''):
+    def load_script(self, script, script_name='', batch=True):
         """
+        Load script into the instrument. If a script with the same name and identical commands was already
+        loaded since the last reset(), it is not sent again.
+        
         script : list of str
             List of commands making up the script. Each list item is one valid command.
         script_name : str, optional
             Name assigned to script in instrument runtime environment. If script_name='' set as anonymous script.
+        batch : bool, optional
+            if True, join commands into as few messages as possible, see write_batch(). Otherwise send each
+            command as a separate message. The default is True.
+
+        Returns
+        script_loaded : bool
+            True if the script was sent to the instrument, False if the loaded script was already up to date.
+        """
+        script_hash = hashlib.sha1('\n'.join(script).encode()).hexdigest()
+        if self.loaded_scripts.get(script_name) == script_hash:
+            return False
+        commands = ['loadscript {}'.format(script_name)] + script + ['endscript']
+        if batch:
+            self.write_batch(commands)
+        else:
+            for command in commands:
+                self.write(command)
+        self.loaded_scripts[script_name] = script_hash
+        return True
+    
+    def load_function_script(self, script, script_name):
         """
-        self.write('loadscript {}'.format(script_name))
-        for command in script:
-            self.write(command)
-        self.write('endscript')
+        Load a script defining TSP functions, e.g. from generate_nested_iv_sweep_function, and run it so that
+        the functions are defined in the instrument runtime environment. Nothing is sent if the script is
+        already loaded.
+        
+        script : list of str
+            List of commands making up the script.
+        script_name : str
+            Name assigned to script in instrument runtime environment.
+        """
+        if self.load_script(script, script_name=script_name):
+            self.write('{}.run()'.format(script_name))
+    
+    def run_function_until_operation_complete(self, function_name, *args, timeout=60000):
+        """
+        Call a TSP function defined with load_function_script and wait until operation is completed,
+        as in run_script_until_operation_complete.
+        
+        function_name : str
+            name of the TSP function
+        *args : int, float, list or numpy array
+            function arguments, formatted with format_tsp_value
+        timeout : int, optional
+            timeout time in ms. The default is 60000.
+        """
+        self.start_function(function_name, *args)
+        if not self.wait_for_operation_complete(timeout):
+            self.instrument.disable_event(self.visa_event_type, self.visa_event_mech)
+    
+    def start_function(self, function_name, *args):
+        """
+        Call a TSP function defined with load_function_script without waiting for it to complete. Use
+        wait_for_operation_complete() to wait for the service request sent when the function calls opc(), and
+        abort_function() to stop it. The instrument does not process other commands until the function ends.
+        
+        function_name : str
+            name of the TSP function
+        *args : int, float, list or numpy array
+            function arguments, formatted with format_tsp_value
+        """
+        function_call = '{}({})'.format(function_name, ', '.join([self.format_tsp_value(arg) for arg in args]) )
+        # functions can change any setting, cached values are no longer reliable
+        self.clear_state_cache()
+        self.visa_event_type = pyvisa.constants.EventType.service_request
+        self.visa_event_mech = pyvisa.constants.EventMechanism.queue
+        self.instrument.enable_event(self.visa_event_type, self.visa_event_mech)
+        self.write(function_call)
+        self.flush_write_queue()
+    
+    def wait_for_operation_complete(self, timeout):
+        """
+        Wait for the service request of a function started with start_function(). Call repeatedly with a
+        short timeout to poll, e.g. to check whether the measurement should stop in between.
+        
+        timeout : int
+            timeout time in ms
+        
+        Returns
+        completed : bool
+            True if the service request was received, False if timeout has passed before.
+        """
+        response = self.instrument.wait_on_event(self.visa_event_type, timeout, capture_timeout=True)
+        if response.timed_out:
+            return False
+        self.instrument.disable_event(self.visa_event_type, self.visa_event_mech)
+        return True
+    
+    def abort_function(self):
+        """
+        Stop a function started with start_function(), or any running script, with a device clear. Sweeps
+        started by the function keep running, stop them with abort() on each channel.
+        """
+        self.instrument.clear()
+        self.instrument.disable_event(self.visa_event_type, self.visa_event_mech)
+        self.clear_state_cache()
         
     def run_script(self, script_name=None):
         """
         script_name : str, optional
             Name assigned to script in instrument runtime environment. If None, run the anonymous script.
         """
+        # scripts can change any setting, cached values are no longer reliable
+        self.clear_state_cache()
         if script_name is not None:
             self.write('{}.run()'.format(script_name))
         else:
@@ -267,6 +498,7 @@ class keithley_2600A(visa_instrument):
         self.visa_event_mech = pyvisa.constants.EventMechanism.queue
         self.instrument.enable_event(self.visa_event_type, self.visa_event_mech)
         self.run_script(script_name)
+        self.flush_write_queue()
         self.instrument.wait_on_event(self.visa_event_type, timeout)
         self.instrument.disable_event(self.visa_event_type, self.visa_event_mech)
         
@@ -297,33 +529,18 @@ class keithley_2600A(visa_instrument):
                  # enables use of the Standard Event Status Register bit triggered by opc()
                  'status.standard.enable = status.standard.OPERATION_COMPLETE',
                  # sends a service request when an event occurs in the Standard Event Status Register
-                 'status.request_enable = status.EVENT_SUMMARY_BIT',
-                 'smu{}.nvbuffer1.clear()'.format(sweep_ch),
-                 'smu{}.nvbuffer2.clear()'.format(sweep_ch),
-                 'smu{}.nvbuffer1.appendmode = 1'.format(sweep_ch),
-                 'smu{}.nvbuffer2.appendmode = 1'.format(sweep_ch),
-                 'smu{}.nvbuffer1.collectsourcevalues = 1'.format(sweep_ch),
-                 'smu{}.nvbuffer2.collectsourcevalues = 1'.format(sweep_ch),
-                 'smu{}.nvbuffer1.collecttimestamps = 1'.format(sweep_ch),
-                 'smu{}.nvbuffer2.collecttimestamps = 1'.format(sweep_ch),
-                 'smu{}.trigger.measure.iv(smu{}.nvbuffer1, smu{}.nvbuffer2)'.format(sweep_ch, sweep_ch, sweep_ch),
-                 'smu{}.trigger.source.linearv({}, {}, {})'.format(sweep_ch, start_V, end_V, N_points),
+                 'status.request_enable = status.EVENT_SUMMARY_BIT'])
+        script.extend(self.generate_buffer_setup_script(sweep_ch))
+        script.extend(
+                ['smu{}.trigger.source.linearv({}, {}, {})'.format(sweep_ch, start_V, end_V, N_points),
                  'smu{}.trigger.source.action = 1'.format(sweep_ch),
                  'smu{}.trigger.measure.action = 1'.format(sweep_ch),
                  'smu{}.trigger.count = {}'.format(sweep_ch, N_points)
                  ])
         if secondary_ch:
+            script.extend(self.generate_buffer_setup_script(secondary_ch))
             script.extend(
-                ['smu{}.nvbuffer1.clear()'.format(secondary_ch),
-                 'smu{}.nvbuffer2.clear()'.format(secondary_ch),
-                 'smu{}.nvbuffer1.appendmode = 1'.format(secondary_ch),
-                 'smu{}.nvbuffer2.appendmode = 1'.format(secondary_ch),
-                 'smu{}.nvbuffer1.collectsourcevalues = 1'.format(secondary_ch),
-                 'smu{}.nvbuffer2.collectsourcevalues = 1'.format(secondary_ch),
-                 'smu{}.nvbuffer1.collecttimestamps = 1'.format(secondary_ch),
-                 'smu{}.nvbuffer2.collecttimestamps = 1'.format(secondary_ch),
-                 'smu{}.trigger.measure.iv(smu{}.nvbuffer1, smu{}.nvbuffer2)'.format(secondary_ch, secondary_ch, secondary_ch),
-                 'smu{}.trigger.measure.action = 1'.format(secondary_ch),
+                ['smu{}.trigger.measure.action = 1'.format(secondary_ch),
                  'smu{}.trigger.measure.stimulus = smu{}.trigger.SOURCE_COMPLETE_EVENT_ID'.format(secondary_ch, sweep_ch),
                  'smu{}.trigger.count = {}'.format(secondary_ch, N_points)
                  ])
@@ -361,7 +578,219 @@ class keithley_2600A(visa_instrument):
             script.append('smu{}.source.output = 0'.format(secondary_ch))
         return script
     
-    def read_buffer(self, buffer_name, data_types):
+    def generate_nested_iv_sweep_script(self, sweep_ch, start_V, end_V, step_V, outer_ch, outer_V, loop=False,
+                                        curve_delay=0):
+        """
+        Generate a script running a full two-dimensional sweep on the instrument: for each voltage in outer_V,
+        set outer_ch to that voltage and run a linear i-v sweep on sweep_ch, as in generate_linear_iv_sweep_script.
+        i and v are recorded on both channels, and all curves are appended to the nvbuffers of each channel.
+        A single service request is sent when all curves are completed.
+        Each curve contains N_points = round((end_V - start_V) / step_V) +1 readings, or 2*N_points if loop is True.
+        
+        sweep_ch : str
+            channel, 'a' or 'b', where the inner sweep runs
+        start_V : float
+            sweep start voltage in V
+        end_V : float
+            sweep end voltage in V
+        step_V : float
+            sweep step in V
+        outer_ch : str
+            channel, 'a' or 'b', stepped through outer_V values. Should be different from sweep_ch.
+        outer_V : list or numpy array of float
+            voltages applied to outer_ch, one inner sweep for each value
+        loop : bool, optional
+            if True, each inner sweep also runs the inverse sweep to do a loop sweep. The default is False.
+        curve_delay : float, optional
+            delay in s after setting outer_ch voltage and sweep_ch start voltage, before each inner sweep.
+            The default is 0.
+
+        Returns
+        script : list of str
+            List of TSP commands for the two-dimensional sweep.
+        """
+        N_points = round( (end_V - start_V) / step_V ) +1
+        outer_V_values = self.format_tsp_value(outer_V)
+        return self.generate_nested_iv_sweep_body(sweep_ch, outer_ch, start_V, end_V, N_points, outer_V_values,
+                                                  loop=loop, curve_delay=curve_delay)
+    
+    def generate_nested_iv_sweep_function(self, function_name, sweep_ch, outer_ch, loop=False):
+        """
+        Generate a script defining a TSP function that runs the two-dimensional sweep of
+        generate_nested_iv_sweep_script. Once the script is loaded and run, each measurement only needs a short
+        function call, see run_function_until_operation_complete. The function arguments are
+        (start_V, end_V, N_points, outer_V_values, curve_delay), with outer_V_values a TSP table of voltages.
+        
+        function_name : str
+            name of the TSP function
+        sweep_ch : str
+            channel, 'a' or 'b', where the inner sweep runs
+        outer_ch : str
+            channel, 'a' or 'b', stepped through outer_V_values. Should be different from sweep_ch.
+        loop : bool, optional
+            if True, each inner sweep also runs the inverse sweep to do a loop sweep. The default is False.
+
+        Returns
+        script : list of str
+            List of TSP commands defining the function.
+        """
+        script = ['function {}(start_V, end_V, N_points, outer_V_values, curve_delay)'.format(function_name)]
+        script.extend(self.generate_nested_iv_sweep_body(sweep_ch, outer_ch, 'start_V', 'end_V', 'N_points',
+                                                         'outer_V_values', loop=loop, curve_delay='curve_delay'))
+        script.append('end')
+        return script
+    
+    def generate_nested_iv_sweep_body(self, sweep_ch, outer_ch, start_V, end_V, N_points, outer_V_values,
+                                      loop=False, curve_delay=0):
+        """
+        TSP commands of the two-dimensional sweep. Sweep parameters are inserted as given, so they can be
+        either values or names of TSP variables.
+        
+        N_points : int or str
+            number of points of each inner sweep
+        outer_V_values : str
+            TSP table of voltages applied to outer_ch, or name of a variable holding it
+        curve_delay : float or str
+            delay in s before each inner sweep. If a str, name of a TSP variable holding the delay.
+        Other arguments as in generate_nested_iv_sweep_script.
+
+        Returns
+        script : list of str
+            List of TSP commands for the two-dimensional sweep.
+        """
+        script = []
+        script.extend(
+                ['status.reset()',
+                 'status.standard.enable = status.standard.OPERATION_COMPLETE',
+                 'status.request_enable = status.EVENT_SUMMARY_BIT'])
+        script.extend(self.generate_buffer_setup_script(sweep_ch))
+        script.extend(
+                ['smu{}.trigger.source.action = 1'.format(sweep_ch),
+                 'smu{}.trigger.measure.action = 1'.format(sweep_ch),
+                 'smu{}.trigger.count = {}'.format(sweep_ch, N_points),
+                 'smu{}.trigger.endsweep.action = smu{}.SOURCE_HOLD'.format(sweep_ch, sweep_ch)
+                 ])
+        script.extend(self.generate_buffer_setup_script(outer_ch))
+        script.extend(
+                ['smu{}.trigger.measure.action = 1'.format(outer_ch),
+                 'smu{}.trigger.measure.stimulus = smu{}.trigger.SOURCE_COMPLETE_EVENT_ID'.format(outer_ch, sweep_ch),
+                 'smu{}.trigger.count = {}'.format(outer_ch, N_points),
+                 'local V_outer_values = {}'.format(outer_V_values),
+                 'smu{}.source.levelv = V_outer_values[1]'.format(outer_ch),
+                 'smu{}.source.levelv = {}'.format(sweep_ch, start_V),
+                 'smu{}.source.output = 1'.format(outer_ch),
+                 'smu{}.source.output = 1'.format(sweep_ch),
+                 'for index, V_outer in ipairs(V_outer_values) do',
+                 'smu{}.source.levelv = V_outer'.format(outer_ch),
+                 'smu{}.source.levelv = {}'.format(sweep_ch, start_V)
+                 ])
+        if isinstance(curve_delay, str):
+            script.append('if {0} > 0 then delay({0}) end'.format(curve_delay))
+        elif curve_delay != 0:
+            script.append('delay({})'.format(curve_delay))
+        script.extend(
+                ['smu{}.trigger.source.linearv({}, {}, {})'.format(sweep_ch, start_V, end_V, N_points),
+                 'smu{}.trigger.initiate()'.format(outer_ch),
+                 'smu{}.trigger.initiate()'.format(sweep_ch),
+                 'waitcomplete()'
+                 ])
+        if loop:
+            script.extend(
+                ['smu{}.trigger.source.linearv({}, {}, {})'.format(sweep_ch, end_V, start_V, N_points),
+                 'smu{}.trigger.initiate()'.format(outer_ch),
+                 'smu{}.trigger.initiate()'.format(sweep_ch),
+                 'waitcomplete()'
+                 ])
+        script.extend(
+                ['end',
+                 'smu{}.source.output = 0'.format(sweep_ch),
+                 'smu{}.source.output = 0'.format(outer_ch),
+                 # single service request once all curves are completed
+                 'opc()',
+                 'waitcomplete()'
+                 ])
+        return script
+    
+    def format_tsp_value(self, value):
+        """
+        value : int, float, list or numpy array
+
+        Returns
+        tsp_value : str
+            value formatted as TSP literal, lists and arrays are formatted as TSP tables
+        """
+        if isinstance(value, (list, tuple, np.ndarray)):
+            return '{{{}}}'.format(', '.join([self.format_tsp_value(item) for item in value]) )
+        return str(value)
+    
+    def generate_timed_iv_script(self, ch1, ch2, interval, N_samples):
+        """
+        Generate a script measuring i and v on both channels at fixed time intervals, timed by the instrument
+        trigger timer. Readings are stored in nvbuffer1 (i) and nvbuffer2 (v) of each channel with timestamps.
+        Source levels and outputs are not changed, set them before running the script.
+        Commands are not blocking, buffers can be read while the measurement runs, e.g. with iterate_buffer().
+        
+        ch1 : str
+            first channel, 'a' or 'b'
+        ch2 : str
+            second channel, 'a' or 'b'
+        interval : float
+            time between consecutive samples in s
+        N_samples : int
+            number of samples to acquire on each channel. Must not exceed the buffer capacity.
+
+        Returns
+        script : list of str
+            List of TSP commands for the timed measurement.
+        """
+        script = []
+        script.extend(self.generate_buffer_setup_script(ch1))
+        script.extend(self.generate_buffer_setup_script(ch2))
+        script.extend(
+                ['trigger.timer[1].reset()',
+                 'trigger.timer[1].delay = {}'.format(interval),
+                 'trigger.timer[1].count = {}'.format(max(N_samples - 1, 1)),
+                 # first sample is taken as soon as ch1 is armed, following ones after each timer delay
+                 'trigger.timer[1].passthrough = true',
+                 'trigger.timer[1].stimulus = smu{}.trigger.ARMED_EVENT_ID'.format(ch1)
+                 ])
+        for ch in [ch1, ch2]:
+            script.extend(
+                ['smu{}.trigger.source.action = 0'.format(ch),
+                 'smu{}.trigger.measure.action = 1'.format(ch),
+                 'smu{}.trigger.measure.stimulus = trigger.timer[1].EVENT_ID'.format(ch),
+                 'smu{}.trigger.endsweep.action = smu{}.SOURCE_HOLD'.format(ch, ch),
+                 'smu{}.trigger.count = {}'.format(ch, N_samples)
+                 ])
+        # ch2 must be armed before ch1 starts the timer
+        script.extend(
+                ['smu{}.trigger.initiate()'.format(ch2),
+                 'smu{}.trigger.initiate()'.format(ch1)
+                 ])
+        return script
+    
+    def generate_buffer_setup_script(self, ch):
+        """
+        ch : str
+            channel, 'a' or 'b'
+
+        Returns
+        script : list of str
+            List of TSP commands clearing nvbuffer1 and nvbuffer2 of ch and setting them to store i and v
+            measurements, with source values and timestamps, appending readings from consecutive sweeps.
+        """
+        return ['smu{}.nvbuffer1.clear()'.format(ch),
+                'smu{}.nvbuffer2.clear()'.format(ch),
+                'smu{}.nvbuffer1.appendmode = 1'.format(ch),
+                'smu{}.nvbuffer2.appendmode = 1'.format(ch),
+                'smu{}.nvbuffer1.collectsourcevalues = 1'.format(ch),
+                'smu{}.nvbuffer2.collectsourcevalues = 1'.format(ch),
+                'smu{}.nvbuffer1.collecttimestamps = 1'.format(ch),
+                'smu{}.nvbuffer2.collecttimestamps = 1'.format(ch),
+                'smu{}.trigger.measure.iv(smu{}.nvbuffer1, smu{}.nvbuffer2)'.format(ch, ch, ch)
+                ]
+    
+    def read_buffer(self, buffer_name, data_types, binary=False):
         """
         buffer_name : str
             name of the buffer to be read, for example smua.nvbuffer1
@@ -371,15 +800,42 @@ class keithley_2600A(visa_instrument):
                 'statuses' : equipment status for each reading
                 'sourcevalues' : source value being output when readings were acquired
                 'timestamps' : timestamp for each reading, relative to time of first reading
+        binary : bool, optional
+            if True, transfer buffer as binary REAL64 data, falling back to ASCII transfer if the binary read fails.
+            The default is False.
                 
         Returns
         data_dict : dict
             dictionary keys are the data_types
         """
+        if binary:
+            # hold the lock until the ASCII read completes, so that other threads cannot write between
+            # the failed binary read, the device clear and the format change
+            with self.lock:
+                try:
+                    return self.read_buffer_binary(buffer_name, data_types)
+                except (pyvisa.errors.VisaIOError, ValueError):
+                    # discard any partially transferred data before reading again as ASCII
+                    self.instrument.clear()
+                    self.write('format.data = format.ASCII')
+                    return self.read_buffer_ascii(buffer_name, data_types)
+        return self.read_buffer_ascii(buffer_name, data_types)
+    
+    def read_buffer_ascii(self, buffer_name, data_types, start_index=1, stop_index=None):
+        """
+        Read buffer as ASCII text. Arguments and returned dict as for read_buffer.
+        
+        start_index : int, optional
+            index of first reading to transfer, starting from 1. The default is 1.
+        stop_index : int, optional
+            index of last reading to transfer. The default is None, to read until the end of the buffer.
+        """
+        if stop_index is None:
+            stop_index = '{}.n'.format(buffer_name)
         data_size = len(data_types)
         data_buffers = ['{}.'.format(buffer_name) + d_type for d_type in data_types]
         data_buffers = ', '.join(data_buffers)
-        buffer_content = self.query('printbuffer(1, {}.n, {})'.format(buffer_name, data_buffers) )
+        buffer_content = self.query('printbuffer({}, {}, {})'.format(start_index, stop_index, data_buffers) )
         # split instrument reply into list of str values
         buffer_content = buffer_content.split(', ')
         # instrument returns consecutive list of all data, with metadata immediately following each reading value
@@ -390,6 +846,124 @@ class keithley_2600A(visa_instrument):
             data_dict[d_type] = np.array(data, dtype=float)
         return data_dict
     
+    def read_buffer_binary(self, buffer_name, data_types, start_index=1, stop_index=None):
+        """
+        Read buffer as binary block of 64-bit floats. Much faster than ASCII transfer for long buffers.
+        Arguments and returned dict as for read_buffer_ascii.
+        """
+        data_size = len(data_types)
+        if stop_index is None:
+            stop_index = self.get_buffer_size(buffer_name)
+        N_readings = stop_index - start_index + 1
+        if N_readings <= 0:
+            return {d_type: np.array([], dtype=float) for d_type in data_types}
+        data_buffers = ['{}.'.format(buffer_name) + d_type for d_type in data_types]
+        data_buffers = ', '.join(data_buffers)
+        # other threads must not send commands between the request and the read of the binary data
+        with self.lock:
+            self.write('format.data = format.REAL64')
+            self.write('format.byteorder = format.LITTLEENDIAN')
+            try:
+                self.write('printbuffer({}, {}, {})'.format(start_index, stop_index, data_buffers) )
+                self.flush_write_queue()
+                # instrument sends a '#0' header followed by the raw values and a termination character
+                buffer_content = self.instrument.read_binary_values(datatype='d', is_big_endian=False,
+                                                                    container=np.array, header_fmt='ieee',
+                                                                    data_points=N_readings*data_size)
+            finally:
+                self.write('format.data = format.ASCII')
+        # values are interleaved as in ASCII transfer, strided views avoid copying
+        data_dict = {}
+        for i, d_type in enumerate(data_types):
+            data_dict[d_type] = buffer_content[i::data_size]
+        return data_dict
+    
+    def get_buffer_size(self, buffer_name):
+        """
+        buffer_name : str
+            name of the buffer, for example smua.nvbuffer1
+
+        Returns
+        N_readings : int
+            number of readings currently stored in the buffer
+        """
+        return int( float( self.query('print({}.n)'.format(buffer_name)) ) )
+    
+    def get_buffer_capacity(self, buffer_name):
+        """
+        buffer_name : str
+            name of the buffer, for example smua.nvbuffer1
+
+        Returns
+        capacity : int
+            maximum number of readings that can be stored in the buffer
+        """
+        return int( float( self.query('print({}.capacity)'.format(buffer_name)) ) )
+    
+    def get_buffer_basetimestamp(self, buffer_name):
+        """
+        buffer_name : str
+            name of the buffer, for example smua.nvbuffer1
+
+        Returns
+        basetimestamp : float
+            time in s of the first reading stored in the buffer, to which buffer timestamps are relative
+        """
+        return float( self.query('print({}.basetimestamp)'.format(buffer_name)) )
+    
+    def iterate_buffer(self, buffer_name, data_types, chunk_size=1000, N_expected=None, binary=True,
+                       poll_interval=0.1, timeout=60):
+        """
+        Generator reading a buffer in windows of at most chunk_size readings, so that long buffers are never
+        transferred in a single reply. Each chunk is a dict as returned by read_buffer, and can be appended
+        directly to datasets.
+        If N_expected is given the buffer is followed while it is being filled, e.g. by an overlapped sweep
+        started with trigger.initiate(), yielding only new readings as they become available.
+        The instrument must be able to process commands while filling the buffer, i.e. the script running the
+        sweep must not block on waitcomplete().
+        
+        buffer_name : str
+            name of the buffer to be read, for example smua.nvbuffer1
+        data_types : list of str
+            reading buffer subtables to be read, see read_buffer
+        chunk_size : int, optional
+            maximum number of readings transferred per query. The default is 1000.
+        N_expected : int, optional
+            total number of readings expected in the buffer. If None, read the readings currently stored
+            and stop. The default is None.
+        binary : bool, optional
+            transfer data in binary REAL64 format, see read_buffer. The default is True.
+        poll_interval : float, optional
+            time in s between checks for new readings when following the buffer. The default is 0.1.
+        timeout : float, optional
+            time in s after which to stop following the buffer if no new readings are stored, raising
+            TimeoutError if fewer than N_expected readings were read. The default is 60.
+
+        Yields
+        data_dict : dict
+            dictionary keys are the data_types, values are arrays of the readings in the current window
+        """
+        N_read = 0
+        last_reading_time = time.time()
+        while True:
+            N_available = self.get_buffer_size(buffer_name)
+            if N_available > N_read:
+                stop_index = min(N_read + chunk_size, N_available)
+                if binary:
+                    chunk = self.read_buffer_binary(buffer_name, data_types, N_read+1, stop_index)
+                else:
+                    chunk = self.read_buffer_ascii(buffer_name, data_types, N_read+1, stop_index)
+                N_read = stop_index
+                last_reading_time = time.time()
+                yield chunk
+            elif N_expected is None or N_read >= N_expected:
+                return
+            elif time.time() - last_reading_time > timeout:
+                raise TimeoutError('no new readings in {} for {} s, read {} of {} expected readings'.format(
+                                   buffer_name, timeout, N_read, N_expected))
+            else:
+                time.sleep(poll_interval)
+    
     def abort(self, ch):
         """
         Abort all overlapped operations, for example a sweep.
@@ -398,6 +972,7 @@ class keithley_2600A(visa_instrument):
             channel, 'a' or 'b'
         """
         self.write('smu{}.abort()'.format(ch))
+        self.clear_state_cache()
 
 
 class keithley_2600A_ui(QtWidgets.QWidget):
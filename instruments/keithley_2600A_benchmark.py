@@ -0,0 +1,57 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 10:15:31 2026
+
+@author: deankos
+
+Benchmark of script upload time to a Keithley 2600A, sending one message per command or batched messages.
+Requires a connected instrument.
+"""
+
+import time
+import numpy as np
+from nanomol.instruments.keithley_2600A import keithley_2600A
+
+def benchmark_load_script(smu, script, N_repeats=10):
+    """
+    Time upload of script with and without batched writes.
+
+    Parameters
+    ----------
+    smu : keithley_2600A
+        connected instrument.
+    script : list of str
+        script commands to upload.
+    N_repeats : int, optional
+        number of uploads timed for each mode. The default is 10.
+
+    Returns
+    -------
+    upload_times : dict
+        mean upload time in s for each mode, keys 'single_writes' and 'batched_writes'.
+    """
+    upload_times = {}
+    for mode, batch in [('single_writes', False), ('batched_writes', True)]:
+        times = []
+        for i in range(N_repeats):
+            # forget loaded scripts, otherwise identical scripts are not uploaded again
+            smu.loaded_scripts = {}
+            t0 = time.perf_counter()
+            smu.load_script(script, script_name='benchmark_script', batch=batch)
+            # query waits until the instrument has processed all commands
+            smu.query('print(1)')
+            times.append(time.perf_counter() - t0)
+        upload_times[mode] = np.mean(times)
+    return upload_times
+
+
+if __name__ == '__main__' :
+
+    smu = keithley_2600A('GPIB0::27::INSTR')
+    script = smu.generate_linear_iv_sweep_script('b', 0, -60, -1, loop=True, secondary_ch='a')
+    upload_times = benchmark_load_script(smu, script)
+    print('script of {} commands'.format(len(script)))
+    for mode, upload_time in upload_times.items():
+        print('{}: {:.1f} ms'.format(mode, upload_time*1e3))
+    print('speed-up: {:.1f}x'.format(upload_times['single_writes'] / upload_times['batched_writes']))
+    smu.close()
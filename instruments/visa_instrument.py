@@ -6,33 +6,126 @@ Created on Wed Aug 16 12:10:44 2023
 """
 
 import pyvisa
+import threading
+from contextlib import contextmanager
 
 class visa_instrument():
     """
     Instrument using the VISA communication protocol.
     
     address: str; instrument address obtained e.g. from pyvisa ResourceManager or NI MAX
+    
+    Instruments can be used from several threads, e.g. the GUI and a measurement thread. Communication is
+    guarded by lock, so messages of different threads are not interleaved, and each thread has its own write
+    queue, so batch_writes() in one thread does not hold back or send the writes of another.
+    Hold lock to keep a sequence of commands together, e.g. a write followed by its read.
     """
     
+    # maximum length of a single message accepted by the instrument input buffer, used to batch writes
+    max_message_length = 1024
+    # separator between commands joined in a single message
+    command_separator = '\n'
+    
     def __init__(self, address = None, remove_termination = True):
         self.remove_termination = remove_termination
         resource_manager = pyvisa.ResourceManager()
         self.instrument = resource_manager.open_resource(address)
+        self.lock = threading.RLock()
+        self.thread_state = threading.local()
+    
+    @property
+    def write_queue(self):
+        """ list of commands queued by the current thread while batching writes, see batch_writes(), or None """
+        return getattr(self.thread_state, 'write_queue', None)
+    
+    @write_queue.setter
+    def write_queue(self, write_queue):
+        self.thread_state.write_queue = write_queue
         
     def write(self, *args, **kwargs):
-        self.instrument.write(*args, **kwargs)
+        if self.write_queue is not None and len(args) == 1 and not kwargs:
+            self.write_queue.append(args[0])
+        else:
+            with self.lock:
+                self.flush_write_queue()
+                self.instrument.write(*args, **kwargs)
+    
+    def write_batch(self, commands):
+        """
+        Send commands joined into as few messages as possible, each no longer than max_message_length.
+        Commands longer than max_message_length are sent on their own.
+        
+        commands : list of str
+        """
+        if self.write_queue is not None:
+            # batching writes, keep command order and send with the rest of the queue
+            self.write_queue.extend(commands)
+            return
+        self.send_batch(commands)
+    
+    def send_batch(self, commands):
+        """ send commands joined into as few messages as possible, see write_batch() """
+        messages = []
+        message = ''
+        for command in commands:
+            if message and len(message) + len(self.command_separator) + len(command) > self.max_message_length:
+                messages.append(message)
+                message = ''
+            if message:
+                message += self.command_separator + command
+            else:
+                message = command
+        if message:
+            messages.append(message)
+        with self.lock:
+            for message in messages:
+                self.instrument.write(message)
+    
+    @contextmanager
+    def batch_writes(self):
+        """
+        Context manager queueing all write() calls and sending them with write_batch() on exit.
+        Reads and queries within the context send the queued commands first, to preserve command order.
+        Only writes of the calling thread are queued.
+        
+        Example:
+            with instrument.batch_writes():
+                instrument.write('command_1')
+                instrument.write('command_2')
+        """
+        if self.write_queue is not None:
+            # already batching, nested contexts are sent by the outermost one
+            yield
+            return
+        self.write_queue = []
+        try:
+            yield
+        finally:
+            self.flush_write_queue()
+            self.write_queue = None
+    
+    def flush_write_queue(self):
+        """ send commands queued by batch_writes() """
+        if self.write_queue:
+            commands = self.write_queue
+            self.write_queue = []
+            self.send_batch(commands)
         
     def read(self, *args, **kwargs):
-        if self.remove_termination:
-            return self.instrument.read(*args, **kwargs).rstrip()
-        else:
-            return self.instrument.read(*args, **kwargs)
+        with self.lock:
+            self.flush_write_queue()
+            if self.remove_termination:
+                return self.instrument.read(*args, **kwargs).rstrip()
+            else:
+                return self.instrument.read(*args, **kwargs)
         
     def query(self, *args, **kwargs):
-        if self.remove_termination:
-            return self.instrument.query(*args, **kwargs).rstrip()
-        else:
-            return self.instrument.query(*args, **kwargs)
+        with self.lock:
+            self.flush_write_queue()
+            if self.remove_termination:
+                return self.instrument.query(*args, **kwargs).rstrip()
+            else:
+                return self.instrument.query(*args, **kwargs)
     
     def close(self):
         self.instrument.close()
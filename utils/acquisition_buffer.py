@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 19:20:38 2026
+
+@author: deankos
+"""
+
+import numpy as np
+
+class acquisition_buffer():
+    """
+    Columnar buffer for data acquired point by point, with a preallocated numpy array per dataset.
+    Points are written by index into all columns at once, columns missing from a point are set to NaN.
+    If the buffer is full the arrays double in size, so buffers for sweeps can be sized to the number of points
+    and buffers for time series can grow. Indexing by label returns a view of the data written so far, which can
+    be written to hdf5 or plotted without copying. Views keep the data of the arrays they were taken from when
+    the buffer grows, and points are only changed if they are written again with write() at their index.
+    Behaves as a read-only dict of datasets: keys(), values(), items() and iteration work as for a dict.
+    For time series of unknown length, max_points bounds memory use: once max_points are stored, the oldest
+    points are discarded, so the buffer holds between max_points/2 and max_points of the most recent points.
+    Indices passed to write() then count from the oldest point kept, N_discarded is the number of points discarded.
+    """
+
+    def __init__(self, labels, capacity=1000, dtype=float, max_points=None):
+        """
+        Parameters
+        labels : list of str
+            dataset labels, one column per label
+        capacity : int, optional
+            number of points allocated initially, e.g. number of points of a sweep. Default is 1000.
+        dtype : numpy dtype, optional
+            data type of all columns. Default is float.
+        max_points : int, optional
+            maximum number of points kept, e.g. for plotting the recent history of a long measurement whose data
+            is written to a file as it is acquired. Default is None, all points are kept.
+        """
+        if max_points is not None:
+            capacity = min(capacity, max_points)
+        self.columns = {label: np.empty(max(capacity, 1), dtype=dtype) for label in labels}
+        self.N_points = 0
+        self.max_points = max_points
+        self.N_discarded = 0
+
+    def __len__(self):
+        return self.N_points
+
+    def __getitem__(self, label):
+        return self.columns[label][:self.N_points]
+
+    def __contains__(self, label):
+        return label in self.columns
+
+    def __iter__(self):
+        return iter(self.columns)
+
+    def keys(self):
+        return self.columns.keys()
+
+    def values(self):
+        return [self[label] for label in self.columns]
+
+    def items(self):
+        return [(label, self[label]) for label in self.columns]
+
+    @property
+    def capacity(self):
+        return len(next(iter(self.columns.values())))
+
+    def reserve(self, N_points):
+        """
+        make sure there is space for N_points in total, doubling capacity as needed.
+        If this exceeds max_points, the oldest points are discarded to make space, up to half of max_points more
+        than needed, so points are only discarded every max_points/2 points. Returns the number of points discarded.
+        """
+        N_to_discard = 0
+        if self.max_points is not None and N_points > self.max_points:
+            N_to_discard = min(self.N_points, N_points - self.max_points//2)
+            N_points -= N_to_discard
+        if N_points <= self.capacity and N_to_discard == 0:
+            return 0
+        capacity = max(2*self.capacity, N_points)
+        if self.max_points is not None:
+            capacity = max(min(capacity, self.max_points), N_points)
+        # new arrays are allocated, so views taken before keep their data
+        N_kept = self.N_points - N_to_discard
+        for label, column in self.columns.items():
+            new_column = np.empty(capacity, dtype=column.dtype)
+            new_column[:N_kept] = column[N_to_discard:self.N_points]
+            self.columns[label] = new_column
+        self.N_points = N_kept
+        self.N_discarded += N_to_discard
+        return N_to_discard
+
+    def write(self, index, values):
+        """
+        Write a point at index.
+
+        Parameters
+        index : int
+            index of the point, points after the last written point extend the buffer
+        values : dict
+            label: value pairs, columns without a value are set to NaN
+        """
+        index -= self.reserve(index + 1)
+        for label, column in self.columns.items():
+            column[index] = values.get(label, np.nan)
+        # length is updated after all columns are written, so views always contain complete points
+        self.N_points = max(self.N_points, index + 1)
+
+    def add_point(self, values):
+        """ write a point after the last written point, returns its index """
+        self.write(self.N_points, values)
+        return self.N_points - 1
+
+    def add_points(self, values):
+        """
+        write points from dict of label: sequence pairs, with sequences of equal length.
+        Columns without values are set to NaN.
+        """
+        N_new_points = len(next(iter(values.values())))
+        N_skipped = 0
+        if self.max_points is not None and N_new_points > self.max_points:
+            # only the most recent points would be kept
+            N_skipped = N_new_points - self.max_points
+            self.N_discarded += self.N_points + N_skipped
+            self.N_points = 0
+            N_new_points = self.max_points
+        self.reserve(self.N_points + N_new_points)
+        for label, column in self.columns.items():
+            value = values.get(label, np.nan)
+            column[self.N_points:self.N_points+N_new_points] = value if np.ndim(value) == 0 else value[N_skipped:]
+        self.N_points += N_new_points
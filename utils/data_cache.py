@@ -0,0 +1,68 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:06:47 2026
+
+@author: deankos
+"""
+
+import threading
+from collections import OrderedDict
+
+class data_cache():
+    """
+    Size-bounded least recently used cache for loaded data, safe to use from several threads.
+    The size of an item is its nbytes attribute (e.g. numpy arrays), items without nbytes have size 0.
+    When the cache is full, least recently used items are removed.
+    """
+
+    def __init__(self, max_size=256e6):
+        """
+        Parameters
+        max_size : float, optional
+            maximum total size of cached items in bytes. Default is 256e6.
+        """
+        self.max_size = max_size
+        self.items = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, key, default=None):
+        """ get cached item, marking it as most recently used. Returns default if key is not cached. """
+        with self.lock:
+            if key not in self.items:
+                return default
+            self.items.move_to_end(key)
+            return self.items[key]
+
+    def put(self, key, value):
+        """ cache value, removing least recently used items if the cache is full """
+        with self.lock:
+            if key in self.items:
+                self.size -= self.get_size(self.items.pop(key))
+            self.items[key] = value
+            self.size += self.get_size(value)
+            # always keep the new item, even if larger than max_size
+            while self.size > self.max_size and len(self.items) > 1:
+                _, removed_value = self.items.popitem(last=False)
+                self.size -= self.get_size(removed_value)
+
+    def remove_if(self, condition):
+        """ remove items whose key satisfies condition(key) """
+        with self.lock:
+            for key in [key for key in self.items if condition(key)]:
+                self.size -= self.get_size(self.items.pop(key))
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.size = 0
+
+    def get_size(self, value):
+        return getattr(value, 'nbytes', 0)
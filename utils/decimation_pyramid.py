@@ -0,0 +1,236 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 17:24:05 2026
+
+@author: deankos
+"""
+
+import numpy as np
+
+class decimation_pyramid():
+    """
+    Min/max decimation pyramid of a 1D hdf5 dataset, for plotting long datasets with a limited number of points.
+    Each level stores the minimum and maximum of the dataset in blocks of block_size points, with block_size
+    increasing by factor between levels. Plotting the min and max of each block preserves spikes and the envelope
+    of the data, which plain subsampling would lose.
+    The pyramid is computed reading the dataset in chunks, so the full dataset is never loaded in memory.
+    A modifier, e.g. abs or log10, is applied to the data before decimation, so that the envelope of the modified
+    data is correct, e.g. for abs of data crossing zero. NaN values, e.g. log10 of negative values, are ignored
+    in block min and max.
+    """
+
+    def __init__(self, dataset, factor=8, chunk_size=2**20, min_level_size=1000, modifier=None):
+        """
+        Parameters
+        dataset : h5py dataset
+            1D dataset to decimate
+        factor : int, optional
+            ratio of block sizes of consecutive levels, also block size of the finest level. Default is 8.
+        chunk_size : int, optional
+            number of points read from the dataset at a time when computing the finest level. Default is 2**20.
+        min_level_size : int, optional
+            levels are added until the coarsest level has fewer than min_level_size blocks. Default is 1000.
+        modifier : function, optional
+            function applied to arrays of dataset values before decimation. Default is None, no modifier.
+        """
+        self.dataset = dataset
+        self.modifier = modifier
+        self.factor = factor
+        self.chunk_size = chunk_size
+        self.min_level_size = min_level_size
+        self.source_length = len(dataset)
+        self.block_sizes = []
+        self.min_levels = []
+        self.max_levels = []
+        if chunk_size is not None:
+            self.compute(chunk_size, min_level_size)
+
+    def __len__(self):
+        return self.source_length
+
+    @property
+    def nbytes(self):
+        """ memory used by pyramid levels """
+        return sum(level.nbytes for level in self.min_levels + self.max_levels)
+
+    def compute(self, chunk_size, min_level_size):
+        """ compute pyramid levels from the dataset """
+        if self.source_length == 0:
+            return
+        block_size = self.factor
+        chunk_size = max(chunk_size//block_size, 1) * block_size    # read whole blocks only
+        min_values = []
+        max_values = []
+        for chunk_start in range(0, self.source_length, chunk_size):
+            chunk = self.read(chunk_start, chunk_start+chunk_size)
+            block_min, block_max = self.reduce_blocks(chunk, chunk, block_size)
+            min_values.append(block_min)
+            max_values.append(block_max)
+        self.add_level(block_size, np.concatenate(min_values), np.concatenate(max_values))
+        # coarser levels are computed from the previous level
+        while len(self.min_levels[-1]) >= min_level_size:
+            block_size = block_size * self.factor
+            block_min, block_max = self.reduce_blocks(self.min_levels[-1], self.max_levels[-1], self.factor)
+            self.add_level(block_size, block_min, block_max)
+
+    def extend(self, dataset=None):
+        """
+        Update the pyramid after data was appended to the dataset, e.g. a dataset followed while it is written.
+        Only blocks from the last, possibly incomplete, block of each level are computed again, so the cost
+        depends on the number of new points rather than on the dataset length.
+
+        Parameters
+        dataset : h5py dataset, optional
+            dataset to read from, e.g. a refreshed handle of the same dataset. Default is None, the dataset
+            the pyramid was computed from.
+        """
+        if dataset is not None:
+            self.dataset = dataset
+        new_length = len(self.dataset)
+        if new_length <= self.source_length:
+            return
+        if len(self.block_sizes) == 0:
+            self.source_length = new_length
+            self.compute(self.chunk_size or 2**20, self.min_level_size)
+            return
+        # first block of the finest level changed by the new points
+        first_block = self.source_length // self.factor
+        block_min, block_max = self.reduce_blocks(*[self.read(first_block*self.factor, new_length)]*2, self.factor)
+        self.replace_blocks(0, first_block, block_min, block_max)
+        for level in range(1, len(self.block_sizes)):
+            first_block = first_block // self.factor
+            start = first_block * self.factor
+            block_min, block_max = self.reduce_blocks(self.min_levels[level-1][start:],
+                                                      self.max_levels[level-1][start:], self.factor)
+            self.replace_blocks(level, first_block, block_min, block_max)
+        self.source_length = new_length
+        while len(self.min_levels[-1]) >= self.min_level_size:
+            block_min, block_max = self.reduce_blocks(self.min_levels[-1], self.max_levels[-1], self.factor)
+            self.add_level(self.block_sizes[-1] * self.factor, block_min, block_max)
+
+    def replace_blocks(self, level, first_block, block_min, block_max):
+        """ replace blocks of level from first_block on, levels are replaced whole so readers see complete arrays """
+        self.min_levels[level] = np.concatenate([self.min_levels[level][:first_block], block_min])
+        self.max_levels[level] = np.concatenate([self.max_levels[level][:first_block], block_max])
+
+    def read(self, start, stop):
+        """ read dataset[start:stop] with modifier applied """
+        values = np.asarray(self.dataset[start:stop], dtype=float)
+        if self.modifier is not None:
+            values = self.modifier(values)
+        return values
+
+    def reduce_blocks(self, min_data, max_data, block_size):
+        """
+        min of min_data and max of max_data in blocks of block_size points, the last block can be shorter.
+        NaN values are ignored, blocks of NaN values only are NaN.
+        """
+        N_full_blocks = len(min_data) // block_size
+        N_full = N_full_blocks * block_size
+        block_min = np.fmin.reduce(min_data[:N_full].reshape(N_full_blocks, block_size), axis=1)
+        block_max = np.fmax.reduce(max_data[:N_full].reshape(N_full_blocks, block_size), axis=1)
+        if N_full < len(min_data):
+            block_min = np.append(block_min, np.fmin.reduce(min_data[N_full:]))
+            block_max = np.append(block_max, np.fmax.reduce(max_data[N_full:]))
+        return block_min, block_max
+
+    def add_level(self, block_size, block_min, block_max):
+        self.block_sizes.append(block_size)
+        self.min_levels.append(block_min)
+        self.max_levels.append(block_max)
+
+    def get_data(self, start, stop, N_points):
+        """
+        Get at most about N_points points representing dataset[start:stop].
+
+        Parameters
+        start, stop : int
+            index range of dataset to represent
+        N_points : int
+            number of points to return, e.g. width of the plot in pixels
+
+        Returns
+        indices : numpy array
+            dataset index of each point
+        values : numpy array
+            dataset values, or alternating block min and max values if the range is decimated
+        """
+        start = max(start, 0)
+        stop = min(stop, self.source_length)
+        if stop <= start:
+            return np.array([], dtype=int), np.array([])
+        if (stop - start) <= N_points or len(self.block_sizes) == 0:
+            # few enough points, read dataset slice directly
+            return np.arange(start, stop), self.read(start, stop)
+        # finest level with at most N_points points (2 per block), or coarsest level
+        target_block_size = 2 * (stop - start) / N_points
+        level = len(self.block_sizes) - 1
+        for i, block_size in enumerate(self.block_sizes):
+            if block_size >= target_block_size:
+                level = i
+                break
+        block_size = self.block_sizes[level]
+        block_start = start // block_size
+        block_stop = -(-stop // block_size)
+        block_indices = np.arange(block_start, block_stop) * block_size
+        indices = np.empty(2*len(block_indices), dtype=int)
+        indices[0::2] = block_indices
+        indices[1::2] = np.minimum(block_indices + block_size//2, self.source_length - 1)
+        values = np.empty(2*len(block_indices))
+        values[0::2] = self.min_levels[level][block_start:block_stop]
+        values[1::2] = self.max_levels[level][block_start:block_stop]
+        return indices, values
+
+    def save(self, group):
+        """ store pyramid levels as datasets in group """
+        for name in list(group.keys()):
+            del group[name]
+        for level, block_size in enumerate(self.block_sizes):
+            group.create_dataset('min_{}'.format(level), data=self.min_levels[level])
+            group.create_dataset('max_{}'.format(level), data=self.max_levels[level])
+        group.attrs.create('block_sizes', self.block_sizes)
+        group.attrs.create('factor', self.factor)
+        group.attrs.create('source_length', self.source_length)
+        group.attrs.create('source_ends', self.get_source_ends(self.dataset))
+
+    @staticmethod
+    def get_source_ends(dataset):
+        """ first and last value of dataset, stored to tell if a stored pyramid is from another dataset """
+        if len(dataset) == 0:
+            return np.full(2, np.nan)
+        return np.array([dataset[0], dataset[len(dataset)-1]], dtype=float)
+
+    @classmethod
+    def load(cls, dataset, group, modifier=None):
+        """
+        load pyramid of dataset stored in group by save(), with the modifier it was computed with.
+        Returns None if group does not hold a pyramid matching the current length and end values of dataset.
+        """
+        if group.attrs.get('source_length', -1) != len(dataset):
+            return None
+        if not np.array_equal(group.attrs.get('source_ends'), cls.get_source_ends(dataset), equal_nan=True):
+            return None
+        pyramid = cls(dataset, factor=int(group.attrs['factor']), chunk_size=None, modifier=modifier)
+        for level, block_size in enumerate(group.attrs['block_sizes']):
+            pyramid.add_level(int(block_size), np.array(group['min_{}'.format(level)]),
+                              np.array(group['max_{}'.format(level)]) )
+        return pyramid
+
+
+def search_sorted_dataset(dataset, value):
+    """
+    Index where value would be inserted in a monotonic 1D dataset to keep it sorted, by bisection.
+    Reads only about log2(len(dataset)) values, so long datasets do not have to be loaded.
+    """
+    low = 0
+    high = len(dataset)
+    if high == 0:
+        return 0
+    descending = dataset[0] > dataset[high-1]
+    while low < high:
+        middle = (low + high) // 2
+        if (dataset[middle] > value) if descending else (dataset[middle] < value):
+            low = middle + 1
+        else:
+            high = middle
+    return low
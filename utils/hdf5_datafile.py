@@ -5,6 +5,8 @@ Created on Thu Jun 15 10:24:22 2023
 @author: deankos
 """
 
+import os
+import re
 import numpy as np
 import h5py
 import time
@@ -13,7 +15,13 @@ from tkinter import Tk, filedialog
 
 class hdf5_datafile(h5py.File):
     
-    def __init__(self, mode='r'):
+    # hdf5 filter options for datasets created with create_compressed_dataset.
+    # lzf is fast but only available in h5py, gzip with shuffle compresses more and is readable by any hdf5 library
+    compression_presets = {'none': {},
+                           'fast': {'compression': 'lzf', 'shuffle': True},
+                           'archive': {'compression': 'gzip', 'compression_opts': 4, 'shuffle': True} }
+    
+    def __init__(self, mode='r', swmr=False, compression='none', filename=None):
         """
         Parameters
         mode: str
@@ -22,7 +30,35 @@ class hdf5_datafile(h5py.File):
             w: create file, truncate if exists
             w- or x: Create file, fail if exists
             a: read/write if exists, create otherwise
+        swmr: bool, optional
+            enable Single-Writer-Multiple-Reader access, so that a file being written by one process can be
+            read by other processes while it grows. In write modes the file is created with the latest file
+            format, call start_swmr_write() once all groups and datasets have been created. In read mode 'r'
+            the file is opened as SWMR reader, call refresh() on datasets to read newly written data.
+            Default is False.
+        compression: str, optional
+            default compression preset for datasets created with create_compressed_dataset, one of the keys
+            of compression_presets: 'none', 'fast' or 'archive'. Default is 'none'.
+        filename: str, optional
+            file path. If not given, the file is selected in a file dialog. Default is None.
         """
+        if compression not in self.compression_presets:
+            raise ValueError('compression must be one of {}'.format(list(self.compression_presets)))
+        self.compression = compression
+        self.name_counters = {}  # next unique name counter, by (parent group name, basename)
+        if filename is None:
+            filename = self.select_filename(mode)
+        # pass file name and path to h5py library File constructor
+        if swmr and mode == 'r':
+            super().__init__(name=filename, mode=mode, libver='latest', swmr=True)
+        elif swmr:
+            super().__init__(name=filename, mode=mode, libver='latest')
+        else:
+            super().__init__(name=filename, mode=mode)
+        self.swmr = swmr
+    
+    def select_filename(self, mode):
+        """ select file in a file dialog, opening an existing file in mode 'r' """
         # hide default tk window and bring file selection window to top of window stack
         root = Tk()
         root.withdraw()
@@ -33,8 +69,7 @@ class hdf5_datafile(h5py.File):
             filename = filedialog.askopenfilename(defaultextension='.hdf5')
         else:
             filename = filedialog.asksaveasfilename(initialfile=date, defaultextension='.hdf5')
-        # pass file name and path to h5py library File constructor
-        super().__init__(name=filename, mode=mode)
+        return filename
     
     
     def get_unique_group_name(self, parent_group, basename='group', max_N=1000):
@@ -48,22 +83,13 @@ class hdf5_datafile(h5py.File):
             basename for new group name. Default is 'group'.
         max_N : int, optional
             expected maximum number of groups with same basename within parent_group. Default is 1000.
-            Automatically incremented if max_N is reached without finding unique name.
+            Names have more digits once max_N is reached.
 
         Returns
         unique_name : str
             unique group name within parent_group
         """
-        counter = 0
-        N_digits = int(np.log10(max_N))
-        while counter < max_N:
-            name_hint = '{}_{:0{}d}'.format(basename, counter, N_digits)
-            if name_hint not in parent_group:
-                unique_name = name_hint
-                return unique_name
-            counter += 1
-        else:
-            self.get_unique_group_name(parent_group, basename=basename, max_N=max_N*10)
+        return self.get_unique_name(parent_group, basename, max_N)
     
     
     def get_unique_dataset_name(self, parent_group, basename='measurement', max_N=1000):
@@ -77,22 +103,169 @@ class hdf5_datafile(h5py.File):
             basename for new dataset name. Default is 'measurement'.
         max_N : int, optional
             expected maximum number of datasets with same basename within parent_group. Default is 1000.
-            Automatically incremented if max_N is reached without finding unique name.
+            Names have more digits once max_N is reached.
 
         Returns
         unique_name : str
             unique dataset name within parent_group
         """
-        counter = 0
-        N_digits = int(np.log10(max_N))
-        while counter < max_N:
-            name_hint = '{}_{:0{}d}'.format(basename, counter, N_digits)
-            if name_hint not in parent_group:
-                unique_name = name_hint
-                return unique_name
+        return self.get_unique_name(parent_group, basename, max_N)
+    
+    def get_unique_name(self, parent_group, basename, max_N):
+        """
+        Find unique name basename_<counter> within parent_group, with counter zero-padded to log10(max_N) digits.
+        Counters are kept for each parent group and basename, so names are found in constant time.
+        The first time a basename is used in a parent group, the counter starts after the largest counter
+        of existing names.
+        """
+        counter_key = (parent_group.name, basename)
+        if counter_key not in self.name_counters:
+            self.name_counters[counter_key] = self.find_next_counter(parent_group, basename)
+        counter = self.name_counters[counter_key]
+        while True:
+            N_digits = int(np.log10(max_N))
+            while counter >= max_N:
+                # expected maximum reached, use more digits
+                max_N *= 10
+                N_digits += 1
+            unique_name = '{}_{:0{}d}'.format(basename, counter, N_digits)
             counter += 1
+            # names can also be created without this method, check that the name is free
+            if unique_name not in parent_group:
+                self.name_counters[counter_key] = counter
+                return unique_name
+    
+    def find_next_counter(self, parent_group, basename):
+        """ counter after the largest counter of names basename_<counter> in parent_group, 0 if there are none """
+        name_pattern = re.compile(r'{}_(\d+)$'.format(re.escape(basename)))
+        counters = [int(match.group(1)) for match in map(name_pattern.match, parent_group.keys()) if match]
+        return max(counters) + 1 if len(counters) > 0 else 0
+    
+    def get_filter_options(self, compression=None):
+        """
+        Parameters
+        compression : str, optional
+            compression preset, key of compression_presets. Default is None, which uses the datafile preset.
+
+        Returns
+        filter_options : dict
+            keyworded arguments for h5py create_dataset
+        """
+        if compression is None:
+            compression = self.compression
+        if compression not in self.compression_presets:
+            raise ValueError('compression must be one of {}'.format(list(self.compression_presets)))
+        return dict(self.compression_presets[compression])
+    
+    def create_compressed_dataset(self, parent_group, name, data=None, compression=None, min_size=1000, **kwargs):
+        """
+        Create dataset with the filters of a compression preset. Filters need chunked storage, which has
+        an overhead larger than the compression gain for small datasets, so fixed-size datasets with fewer
+        than min_size elements are stored without filters. Resizable datasets are always filtered.
+
+        Parameters
+        parent_group : h5py group or datafile
+            group where the dataset is created. Pass datafile if this is the root group.
+        name : str
+            dataset name
+        data : numpy array or list, optional
+            dataset data. Default is None.
+        compression : str, optional
+            compression preset, key of compression_presets. Default is None, which uses the datafile preset.
+        min_size : int, optional
+            minimum number of elements of fixed-size datasets to be filtered. Default is 1000.
+        **kwargs
+            keyworded arguments passed to h5py create_dataset, e.g. shape, dtype, chunks
+
+        Returns
+        dataset : h5py dataset
+        """
+        filter_options = self.get_filter_options(compression)
+        if data is not None:
+            data = np.asarray(data)
+            size = data.size
         else:
-            self.get_unique_dataset_name(parent_group, basename=basename, max_N=max_N*10)
+            size = int(np.prod(kwargs.get('shape', 0)))
+        if len(filter_options) > 0 and (size >= min_size or 'maxshape' in kwargs):
+            kwargs = dict(filter_options, **kwargs)
+            kwargs.setdefault('chunks', True)
+        return parent_group.create_dataset(name, data=data, **kwargs)
+    
+    def create_appendable_dataset(self, parent_group, name, dtype=float, batch_size=1000, flush_interval=None):
+        """
+        Create an empty, resizable dataset that data can be appended to during a measurement.
+
+        Parameters
+        parent_group : h5py group or datafile
+            group where the dataset is created. Pass datafile if this is the root group.
+        name : str
+            dataset name
+        dtype : numpy dtype, optional
+            data type of the dataset. Default is float.
+        batch_size : int, optional
+            number of points kept in memory before being written to the file. Default is 1000.
+        flush_interval : float, optional
+            maximum time in s that points are kept in memory, see appendable_dataset. Default is None, no limit.
+
+        Returns
+        dataset : appendable_dataset
+        """
+        return appendable_dataset(parent_group, name, dtype=dtype, batch_size=batch_size,
+                                  flush_interval=flush_interval, filter_options=self.get_filter_options())
+    
+    def get_curve_table(self, parent_group, chunk_size=1000):
+        """
+        Get table storing all curves of a sweep compactly in parent_group, see curve_table.
+        Opens the table if it already exists, otherwise the table is created when the first curve is added.
+
+        Parameters
+        parent_group : h5py group or datafile
+            sweep group holding the table. Pass datafile if this is the root group.
+        chunk_size : int, optional
+            number of rows per hdf5 chunk of the table datasets. Default is 1000.
+
+        Returns
+        table : curve_table
+        """
+        return curve_table(parent_group, chunk_size=chunk_size, filter_options=self.get_filter_options())
+    
+    def start_swmr_write(self):
+        """
+        Switch file to SWMR write mode, allowing readers in other processes to follow datasets as they grow.
+        The file must have been opened with swmr=True. In SWMR mode datasets can be written and resized,
+        but no new groups, datasets or attributes can be created, so call this after creating all of them.
+        """
+        if self.swmr and not self.swmr_mode:
+            self.swmr_mode = True
+    
+    def open_sidecar_file(self, suffix):
+        """
+        Open the sidecar hdf5 file storing data derived from this datafile, e.g. decimation pyramids or analysis
+        results cached to avoid recomputing them, so that derived data is not written into the measurement file.
+        The sidecar file is next to the datafile, with suffix added to its name, and is created if it does not
+        exist. It can be written even if the datafile is opened read only.
+
+        Parameters
+        suffix : str
+            added to the datafile name, e.g. 'decimation' for data_decimation.hdf5 next to data.hdf5
+
+        Returns
+        sidecar_file : h5py File
+            file opened for reading and writing, close it when done
+        """
+        name, extension = os.path.splitext(self.filename)
+        return h5py.File('{}_{}{}'.format(name, suffix, extension), mode='a')
+    
+    def refresh(self, item):
+        """
+        Refresh dataset metadata in SWMR read mode, so that data written since the file was opened is visible.
+        Does nothing if the file is not opened in SWMR mode or item is not a dataset.
+
+        Parameters
+        item : h5py dataset or group
+        """
+        if self.swmr_mode and isinstance(item, h5py.Dataset):
+            item.refresh()
     
     def timestamp(self):
         """
@@ -103,6 +276,195 @@ class hdf5_datafile(h5py.File):
         return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time()) )
 
 
+
+class appendable_dataset():
+    """
+    One-dimensional, chunked hdf5 dataset with unlimited maximum size, for data acquired point by point.
+    Appended points are collected in a preallocated buffer and written to the file in batches of batch_size,
+    so that memory use is bounded and data is saved regularly during long measurements. For slow measurements,
+    flush_interval also writes points kept in memory for longer than flush_interval, so that a batch does not
+    take hours to fill. Call flush() at the end of the measurement to write the remaining points.
+    """
+    
+    def __init__(self, parent_group, name, dtype=float, batch_size=1000, flush_file=True, filter_options=None,
+                 flush_interval=None):
+        """
+        Parameters
+        parent_group : h5py group or datafile
+            group where the dataset is created
+        name : str
+            dataset name
+        dtype : numpy dtype, optional
+            data type of the dataset. Default is float.
+        batch_size : int, optional
+            number of points kept in memory before being written to the file. Also used as hdf5 chunk size.
+            Default is 1000.
+        flush_file : bool, optional
+            if True, flush the file after each batch is written, so that data is not lost if the program
+            crashes. Default is True.
+        filter_options : dict, optional
+            hdf5 filter options passed to h5py create_dataset, e.g. from hdf5_datafile.get_filter_options().
+            Default is None, no filters.
+        flush_interval : float, optional
+            maximum time in s between writes to the file while points are appended. Default is None, points are
+            only written in batches of batch_size.
+        """
+        if filter_options is None:
+            filter_options = {}
+        self.dataset = parent_group.create_dataset(name, shape=(0,), maxshape=(None,), dtype=dtype,
+                                                   chunks=(batch_size,), **filter_options)
+        self.batch = np.empty(batch_size, dtype=dtype)
+        self.batch_size = batch_size
+        self.N_batch = 0  # number of points in batch not yet written to file
+        self.flush_file = flush_file
+        self.flush_interval = flush_interval
+        self.last_flush_time = time.monotonic()
+    
+    def append(self, value):
+        """ append a single value """
+        self.batch[self.N_batch] = value
+        self.N_batch += 1
+        if self.N_batch == self.batch_size or self.flush_is_due():
+            self.flush()
+    
+    def extend(self, values):
+        """ append an array or list of values """
+        values = np.asarray(values, dtype=self.batch.dtype)
+        while values.size > 0:
+            N_to_batch = min(values.size, self.batch_size - self.N_batch)
+            self.batch[self.N_batch : self.N_batch+N_to_batch] = values[:N_to_batch]
+            self.N_batch += N_to_batch
+            values = values[N_to_batch:]
+            if self.N_batch == self.batch_size:
+                self.flush()
+        if self.flush_is_due():
+            self.flush()
+    
+    def flush_is_due(self):
+        """ True if points have been kept in memory for longer than flush_interval """
+        return self.flush_interval is not None and time.monotonic() - self.last_flush_time >= self.flush_interval
+    
+    def flush(self):
+        """ write points collected in memory to the file """
+        self.last_flush_time = time.monotonic()
+        if self.N_batch == 0:
+            return
+        N_saved = self.dataset.shape[0]
+        self.dataset.resize( (N_saved + self.N_batch,) )
+        self.dataset[N_saved:] = self.batch[:self.N_batch]
+        self.N_batch = 0
+        if self.flush_file:
+            self.dataset.file.flush()
+    
+    def __len__(self):
+        return self.dataset.shape[0] + self.N_batch
+
+
+
+class curve_table():
+    """
+    Compact storage of all curves of a sweep in two compound datasets, instead of a group with one dataset
+    per column for every curve. This keeps the number of hdf5 objects independent of the number of curves.
+    'curve_data' holds one row per point, with a named field per column (e.g. 'time', 'measured_I_DS').
+    'curve_attrs' holds one row per curve, with a field per curve attribute (e.g. 'timestamp', 'V_DS'),
+    and fields 'start' and 'N_points' giving the rows of curve_data belonging to the curve.
+    Columns and attributes are taken from the first curve added, all curves must have the same ones.
+    Curves are read back as dicts with the same column and attribute names.
+    """
+    
+    def __init__(self, parent_group, chunk_size=1000, filter_options=None):
+        """
+        Parameters
+        parent_group : h5py group or datafile
+            sweep group holding the table
+        chunk_size : int, optional
+            number of rows per hdf5 chunk of the table datasets. Default is 1000.
+        filter_options : dict, optional
+            hdf5 filter options passed to h5py create_dataset when the table is created. Default is None.
+        """
+        self.parent_group = parent_group
+        self.chunk_size = chunk_size
+        self.filter_options = {} if filter_options is None else filter_options
+        if 'curve_data' in parent_group:
+            self.data = parent_group['curve_data']
+            self.attrs = parent_group['curve_attrs']
+        else:
+            self.data = None
+            self.attrs = None
+    
+    def __len__(self):
+        return 0 if self.attrs is None else self.attrs.shape[0]
+    
+    @property
+    def column_names(self):
+        return [] if self.data is None else list(self.data.dtype.names)
+    
+    @property
+    def attr_names(self):
+        return [] if self.attrs is None else [name for name in self.attrs.dtype.names
+                                              if name not in ['start', 'N_points']]
+    
+    def create_datasets(self, data, attrs):
+        """ create table datasets with fields for the columns in data and attributes in attrs """
+        data_dtype = np.dtype([(name, np.asarray(values).dtype) for name, values in data.items()])
+        attrs_fields = [('start', np.int64), ('N_points', np.int64)]
+        for name, value in attrs.items():
+            if isinstance(value, str):
+                attrs_fields.append( (name, h5py.string_dtype()) )
+            else:
+                attrs_fields.append( (name, np.asarray(value).dtype) )
+        self.data = self.parent_group.create_dataset('curve_data', shape=(0,), maxshape=(None,), dtype=data_dtype,
+                                                     chunks=(self.chunk_size,), **self.filter_options)
+        self.attrs = self.parent_group.create_dataset('curve_attrs', shape=(0,), maxshape=(None,),
+                                                      dtype=np.dtype(attrs_fields), chunks=(self.chunk_size,),
+                                                      **self.filter_options)
+    
+    def append_curve(self, data, attrs):
+        """
+        Parameters
+        data : dict
+            column name: array pairs, arrays of equal length
+        attrs : dict
+            curve attribute name: value pairs
+        """
+        if self.data is None:
+            self.create_datasets(data, attrs)
+        N_points = len(next(iter(data.values())))
+        rows = np.empty(N_points, dtype=self.data.dtype)
+        for name, values in data.items():
+            rows[name] = values
+        start = self.data.shape[0]
+        self.data.resize( (start + N_points,) )
+        self.data[start:] = rows
+        attrs_row = np.empty(1, dtype=self.attrs.dtype)
+        attrs_row['start'] = start
+        attrs_row['N_points'] = N_points
+        for name, value in attrs.items():
+            attrs_row[name] = value
+        N_curves = self.attrs.shape[0]
+        self.attrs.resize( (N_curves + 1,) )
+        self.attrs[N_curves:] = attrs_row
+    
+    def get_curve(self, index):
+        """ get data of curve index as dict of column name: array """
+        attrs_row = self.attrs[index]
+        rows = self.data[attrs_row['start'] : attrs_row['start'] + attrs_row['N_points']]
+        return {name: rows[name] for name in self.column_names}
+    
+    def get_curve_attrs(self, index):
+        """ get attributes of curve index as dict of attribute name: value """
+        attrs_row = self.attrs[index]
+        curve_attrs = {}
+        for name in self.attr_names:
+            value = attrs_row[name]
+            curve_attrs[name] = value.decode() if isinstance(value, bytes) else value
+        return curve_attrs
+    
+    def get_column(self, name):
+        """ get column name for all curves of the sweep """
+        return self.data.fields(name)[:]
+
+
 if __name__ == '__main__' :
     
     myDatafile = hdf5_datafile(mode='r')
\ No newline at end of file
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 20:11:52 2026
+
+@author: deankos
+
+Benchmark of write time and file size of hdf5_datafile compression presets, on simulated transfer curves
+and current vs time data with the same datasets as saved by the experiments.
+"""
+
+import os
+import time
+import tempfile
+import numpy as np
+from nanomol.utils.hdf5_datafile import hdf5_datafile
+
+def generate_transfer_data(N_curves=50, N_points=121, seed=0):
+    """
+    Simulated transfer curves of a p-type transistor, with the datasets saved by transistor_transfer.
+
+    Returns
+    curves : list of dict
+        dataset name: array pairs, one dict per curve
+    """
+    rng = np.random.default_rng(seed)
+    V_GS = np.linspace(20, -40, N_points)
+    curves = []
+    for V_DS in np.linspace(-1, -40, N_curves):
+        I_DS = -1e-9 * np.log1p(np.exp(-(V_GS + 5)))**2 * abs(V_DS) + rng.normal(0, 1e-12, N_points)
+        I_GS = rng.normal(0, 1e-11, N_points)
+        curves.append({'time': np.arange(N_points) * 0.05 + rng.normal(0, 1e-3, N_points),
+                       'measured_V_DS': V_DS + rng.normal(0, 1e-5, N_points),
+                       'measured_I_DS': I_DS,
+                       'measured_V_GS': V_GS + rng.normal(0, 1e-5, N_points),
+                       'measured_I_GS': I_GS,
+                       'calculated_V_DS': np.full(N_points, V_DS),
+                       'calculated_V_GS': V_GS,
+                       'compliance_V_DS': np.zeros(N_points),
+                       'compliance_V_GS': np.zeros(N_points) })
+    return curves
+
+def generate_current_vs_time_data(N_points=10**6, seed=0):
+    """
+    Simulated current vs time measurement at fixed bias, with the datasets saved by current_vs_time.
+
+    Returns
+    data : dict
+        dataset name: array pairs
+    """
+    rng = np.random.default_rng(seed)
+    time_values = np.arange(N_points) * 0.01
+    return {'time': time_values,
+            'V_GS': -20 + rng.normal(0, 1e-5, N_points),
+            'I_GS': rng.normal(0, 1e-11, N_points),
+            'V_DS': -10 + rng.normal(0, 1e-5, N_points),
+            'I_DS': -1e-6 * np.exp(-time_values/3000) + rng.normal(0, 1e-10, N_points) }
+
+def write_transfer_data(datafile, curves):
+    sweep_group = datafile.create_group('sweep_000')
+    for curve_index, curve in enumerate(curves):
+        curve_group = sweep_group.create_group('curve_{:04d}'.format(curve_index))
+        for dataset_name, data in curve.items():
+            datafile.create_compressed_dataset(curve_group, dataset_name, data=data)
+
+def write_current_vs_time_data(datafile, data, batch_size=1000):
+    group = datafile.create_group('measurement_000')
+    datasets = {name: datafile.create_appendable_dataset(group, name, batch_size=batch_size) for name in data}
+    # append in batches, as during a measurement
+    for start in range(0, len(data['time']), batch_size):
+        for name, dataset in datasets.items():
+            dataset.extend(data[name][start:start+batch_size])
+    for dataset in datasets.values():
+        dataset.flush()
+
+def benchmark_compression(presets=None, N_repeats=3):
+    """
+    Time writing simulated data with each compression preset and measure the resulting file sizes.
+
+    Parameters
+    ----------
+    presets : list of str, optional
+        compression presets to compare. The default is None, all presets in hdf5_datafile.compression_presets.
+    N_repeats : int, optional
+        number of writes timed for each preset. The default is 3.
+
+    Returns
+    -------
+    results : dict
+        for each preset, dict with mean write time in s and file size in bytes for each data type,
+        keys 'transfer_time', 'transfer_size', 'current_vs_time_time', 'current_vs_time_size'.
+    """
+    if presets is None:
+        presets = list(hdf5_datafile.compression_presets)
+    data = {'transfer': (write_transfer_data, generate_transfer_data()),
+            'current_vs_time': (write_current_vs_time_data, generate_current_vs_time_data()) }
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for preset in presets:
+            results[preset] = {}
+            for data_type, (write_function, data_values) in data.items():
+                filename = os.path.join(directory, '{}_{}.hdf5'.format(preset, data_type))
+                times = []
+                for i in range(N_repeats):
+                    t0 = time.perf_counter()
+                    datafile = hdf5_datafile(mode='w', compression=preset, filename=filename)
+                    write_function(datafile, data_values)
+                    datafile.close()
+                    times.append(time.perf_counter() - t0)
+                results[preset]['{}_time'.format(data_type)] = np.mean(times)
+                results[preset]['{}_size'.format(data_type)] = os.path.getsize(filename)
+    return results
+
+
+if __name__ == '__main__' :
+
+    results = benchmark_compression()
+    for preset, result in results.items():
+        print('{}:'.format(preset))
+        for data_type in ['transfer', 'current_vs_time']:
+            print('    {}: {:.0f} ms, {:.2f} MB'.format(data_type, result['{}_time'.format(data_type)]*1e3,
+                                                      result['{}_size'.format(data_type)]/1e6) )
@@ -7,17 +7,55 @@ Created on Thu Jun 15 10:39:21 2023
 
 import numpy as np
 import os
+import threading
+import functools
 import h5py
 import pyqtgraph as pg
 from PyQt5 import QtWidgets, uic
+from PyQt5.QtCore import QTimer, Qt, pyqtSignal
 from PyQt5.QtGui import QStandardItemModel, QStandardItem
 from nanomol.utils.interactive_ui import interactive_ui
+from nanomol.utils.decimation_pyramid import decimation_pyramid, search_sorted_dataset
+from nanomol.utils.data_cache import data_cache
 
 class hdf5_viewer(interactive_ui):
     
-    def __init__(self, datafile):
+    # emitted by data loading thread with the number of the load request it completed
+    data_loaded_signal = pyqtSignal(int)
+    # item data role marking whether the children of a group tree item have been loaded from the datafile
+    loaded_role = Qt.UserRole + 1
+    # 1D datasets longer than this are plotted from min/max decimation pyramids
+    decimation_min_points = 10000
+    
+    def __init__(self, datafile, follow_interval=None, store_decimation=False, cache_size=256e6):
+        """
+        datafile : hdf5_datafile
+            datafile to display
+        follow_interval : float, optional
+            if given, re-read the selected datasets every follow_interval seconds, e.g. to follow datasets
+            growing in a file opened in SWMR read mode while another process writes it. The default is None.
+        store_decimation : bool, optional
+            if True, store decimation pyramids of long datasets in a sidecar file next to the datafile, see
+            hdf5_datafile.open_sidecar_file, so that they are not computed again next time the datafile is viewed.
+            The datafile itself is not modified. The default is False.
+        cache_size : float, optional
+            maximum size in bytes of loaded datasets kept in memory, least recently used datasets are removed
+            from memory first. The default is 256e6.
+        """
         super().__init__()
         self.datafile = datafile
+        self.store_decimation = store_decimation
+        self.decimation_file = None     # sidecar file storing decimation pyramids, opened when first needed
+        self.decimation_pyramids = {}   # pyramids computed for datasets, by (dataset name, modifier)
+        # pyramids are computed on load threads, one at a time so that the sidecar file is written by one thread
+        self.decimation_lock = threading.Lock()
+        # loaded data by (dataset name, modifier). Datasets are loaded on a worker thread, numbered load requests
+        # make sure that only data for the latest selection is plotted
+        self.data_cache = data_cache(cache_size)
+        self.load_request = 0
+        self.data_loaded_signal.connect(self.load_completed)
+        self.Y_selection = []   # (dataset name, plot label) of datasets selected for Y axis
+        self.X_selection = None # dataset name selected for X axis
         ui_file_path = os.path.join(os.path.dirname(__file__), 'hdf5_viewer.ui')
         uic.loadUi(ui_file_path, self)
         self.initialise_plot()
@@ -25,10 +63,60 @@ class hdf5_viewer(interactive_ui):
         self.reload_datafile_pushbutton.clicked.connect(self.reload_datafile)
         self.modifier_X_comboBox.currentTextChanged.connect(self.update_data_toPlot_X)
         self.modifier_Y_comboBox.currentTextChanged.connect(self.update_data_toPlot_Y)
-        self.reload_datafile()
+        self.load_datafile_tree()
+        self.datafile_treeview_Y.selectionModel().selectionChanged.connect(self.update_data_toPlot_Y)
+        self.datafile_treeview_X.selectionModel().selectionChanged.connect(self.update_data_toPlot_X)
+        self.datafile_treeview_X.expanded.connect(self.expand_tree_item)
+        self.datafile_treeview_Y.expanded.connect(self.expand_tree_item)
         self.data_Y_toPlot = []
         self.data_X_toPlot = []
         self.data_plot_labels = []
+        if follow_interval is not None:
+            self.follow_timer = QTimer()
+            self.follow_timer.timeout.connect(self.follow_datasets)
+            self.follow_timer.start(int(follow_interval*1000))
+    
+    def follow_datasets(self):
+        """
+        read points appended to the selected datasets since they were loaded, refreshing them first if the
+        datafile is in SWMR mode. Only new points are read, on a worker thread, then the selection is plotted.
+        """
+        self.load_request += 1
+        keys = [(name, self.modifier_Y, True) for name, _ in self.Y_selection]
+        if self.X_selection is not None:
+            # long X datasets are read directly from the datafile when plotting, they are not decimated
+            keys.append( (self.X_selection, self.modifier_X, False) )
+        follow_thread = threading.Thread(target=self.follow_data_thread, args=(self.load_request, keys), daemon=True)
+        follow_thread.start()
+    
+    def follow_data_thread(self, load_request, keys):
+        for key in keys:
+            if load_request != self.load_request:
+                return
+            try:
+                self.extend_cached_data(*key)
+            except Exception as exception:
+                print('Exception: {}'.format(exception) )
+        self.data_loaded_signal.emit(load_request)
+    
+    def extend_cached_data(self, name, modifier, decimate):
+        """
+        append points added to dataset name since it was loaded to its cached data, or load it if not cached.
+        Long datasets are decimated if decimate is True, extending their pyramid with the new points.
+        """
+        dataset = self.datafile[name]
+        self.datafile.refresh(dataset)
+        if self.use_decimation(dataset):
+            if decimate:
+                # pyramid is extended in place, put again so that the cache accounts for its new size
+                self.data_cache.put( (name, modifier), self.get_decimation_pyramid(dataset, modifier) )
+            return
+        cached_data = self.data_cache.get( (name, modifier) )
+        if cached_data is None or len(cached_data) > len(dataset):
+            self.data_cache.put( (name, modifier), self.load_dataset(name, modifier) )
+        elif len(dataset) > len(cached_data):
+            new_data = self.apply_data_modifier(np.array(dataset[len(cached_data):]), modifier)
+            self.data_cache.put( (name, modifier), np.concatenate([cached_data, new_data]) )
         
     def initialise_plot(self):
         self.data_plot = pg.PlotWidget()
@@ -37,9 +125,18 @@ class hdf5_viewer(interactive_ui):
         self.plot_format = {'symbol':'o',
                             'symbolSize':3}
         self.data_plot.addLegend()
+        # decimated curves are updated with finer data when the plot is zoomed, once the view range settles
+        self.decimated_curves = []
+        self.decimation_timer = QTimer()
+        self.decimation_timer.setSingleShot(True)
+        self.decimation_timer.timeout.connect(self.update_decimated_curves)
+        self.data_plot.getViewBox().sigXRangeChanged.connect(self.schedule_decimation_update)
         
     def load_datafile_tree(self):
-        """ make QTreeView from hdf5 dataset. The name of each dataset or group is a QStandardItem """
+        """
+        make QTreeView from hdf5 dataset. The name of each dataset or group is a QStandardItem.
+        Only the top level of the datafile is loaded, the children of a group are loaded when its item is expanded.
+        """
         self.datafile_tree_model = QStandardItemModel()
         self.datafile_treeview_X.setModel(self.datafile_tree_model)
         self.treeview_root = self.datafile_tree_model.invisibleRootItem()  # get root item
@@ -47,12 +144,73 @@ class hdf5_viewer(interactive_ui):
         self.datafile_treeview_Y.setModel(self.datafile_treeview_X.model()) # copy tree for Y axis
         
     def load_datafile_branch(self, datafile_group, tree_item):
-        """ populate branch with datasets and recursively build sub-branches """
+        """ populate branch with the datasets and groups in datafile_group, without loading sub-branches """
         for row_counter, key in enumerate(datafile_group.keys()):
-            tree_item.insertRow(row_counter, QStandardItem(key))
-            if isinstance(datafile_group[key], h5py.Group):
-                """ recursively build a tree branch for each datafile group """
-                self.load_datafile_branch(datafile_group[key], tree_item.child(row_counter))
+            tree_item.insertRow(row_counter, self.make_tree_item(datafile_group, key))
+        tree_item.setData(True, self.loaded_role)
+    
+    def make_tree_item(self, datafile_group, key):
+        """
+        make tree item for datafile_group[key]. Group items get a placeholder row, so that they can be expanded,
+        and are loaded when expanded.
+        """
+        tree_item = QStandardItem(key)
+        # get class of item without opening it
+        if datafile_group.get(key, getclass=True) is h5py.Group:
+            self.unload_tree_item(tree_item)
+        return tree_item
+    
+    def unload_tree_item(self, tree_item):
+        """ remove children of tree_item and replace them with a placeholder row """
+        tree_item.removeRows(0, tree_item.rowCount())
+        placeholder_item = QStandardItem('')
+        placeholder_item.setSelectable(False)
+        placeholder_item.setEditable(False)
+        tree_item.appendRow(placeholder_item)
+        tree_item.setData(False, self.loaded_role)
+    
+    def expand_tree_item(self, item_index):
+        """ load children of a group tree item when it is expanded for the first time """
+        tree_item = self.datafile_tree_model.itemFromIndex(item_index)
+        if tree_item is not None and tree_item.data(self.loaded_role) is False:
+            tree_item.removeRows(0, tree_item.rowCount())    # remove placeholder
+            self.load_datafile_branch(self.get_datafile_item(tree_item), tree_item)
+    
+    def get_datafile_item(self, tree_item):
+        """ get datafile item (group or dataset) corresponding to tree_item """
+        datafile_directory = [tree_item.text()]
+        parent_item = tree_item.parent()
+        while parent_item is not None:
+            datafile_directory.insert(0, parent_item.text() )
+            parent_item = parent_item.parent()
+        return self.datafile['/'.join(datafile_directory)]
+    
+    def is_tree_item_expanded(self, tree_item):
+        """ check if tree_item is expanded in the X or Y treeview """
+        item_index = tree_item.index()
+        return self.datafile_treeview_X.isExpanded(item_index) or self.datafile_treeview_Y.isExpanded(item_index)
+    
+    def refresh_datafile_branch(self, datafile_group, tree_item):
+        """
+        update loaded branch to match the keys of datafile_group. Expanded sub-branches are refreshed recursively,
+        collapsed sub-branches are unloaded and loaded again when next expanded.
+        """
+        keys = list(datafile_group.keys())
+        key_set = set(keys)
+        # remove items no longer in datafile
+        for row in reversed(range(tree_item.rowCount())):
+            if tree_item.child(row).text() not in key_set:
+                tree_item.removeRow(row)
+        # insert new items, in datafile order
+        for row_counter, key in enumerate(keys):
+            child_item = tree_item.child(row_counter)
+            if child_item is None or child_item.text() != key:
+                tree_item.insertRow(row_counter, self.make_tree_item(datafile_group, key))
+            elif child_item.data(self.loaded_role):
+                if self.is_tree_item_expanded(child_item):
+                    self.refresh_datafile_branch(datafile_group[key], child_item)
+                else:
+                    self.unload_tree_item(child_item)
     
     def load_attributes(self, datafile_item):
         """ display hdf5 attributes of datafile_item in QTableView widget """
@@ -69,65 +227,98 @@ class hdf5_viewer(interactive_ui):
     
     def update_data_toPlot_Y(self):
         """ update data for plotting from treeView selection """
-        self.data_Y_toPlot = []
-        self.data_plot_labels = []
+        self.Y_selection = []
         # get selected treeview items for Y axis of plot
         selected_indices = self.datafile_treeview_Y.selectionModel().selectedIndexes()
         for i, item_index in enumerate(selected_indices):
-            # convert QModelIndex objects into hdf5 datafile paths
-            tree_item = self.datafile_treeview_Y.model().itemFromIndex(item_index)
-            item_label = tree_item.text()
-            data_label = item_label
-            datafile_directory = [item_label]
-            parent_item = tree_item.parent()
-            while parent_item is not None:
-                # itereate through parent items to get full path from root
-                datafile_directory.insert(0, parent_item.text() )
-                parent_item = parent_item.parent()
-            
-            datafile_item = self.datafile[datafile_directory.pop(0)]
             # get actual datafile item (group or dataset) corresponding to selected item
-            for datafile_key in datafile_directory:
-                datafile_item = datafile_item[datafile_key]
+            tree_item = self.datafile_treeview_Y.model().itemFromIndex(item_index)
+            datafile_item = self.get_datafile_item(tree_item)
             if isinstance(datafile_item, h5py.Dataset):
-                # only append to data for plotting if datafile item is a dataset
-                data_to_plot = self.apply_data_modifier(np.array(datafile_item), self.modifier_Y)
-                self.data_Y_toPlot.append(data_to_plot)
-                self.data_plot_labels.append(data_label)
+                # only plot datafile item if it is a dataset
+                self.Y_selection.append( (datafile_item.name, tree_item.text()) )
             if i==(len(selected_indices)-1):
                 # show dataset/group attributes for last selected item
                 self.item_for_attrs_view = datafile_item
                 self.load_attributes(self.item_for_attrs_view)
-        self.update_plot()
+        self.load_selected_data()
         
     def update_data_toPlot_X(self):
-        self.data_X_toPlot = []
+        self.X_selection = None
         # get selected treeview item for X axis
         # selection limited to 1 item from treeview selectionMode property in .ui file
         selected_index = self.datafile_treeview_X.selectionModel().selectedIndexes()
         if len(selected_index)>0:   # check if an item is selected
-            selected_index = selected_index[0]
-            tree_item = self.datafile_treeview_X.model().itemFromIndex(selected_index)
-            item_label = tree_item.text()
-            datafile_directory = [item_label]
-            parent_item = tree_item.parent()
-            while parent_item is not None:
-                datafile_directory.insert(0, parent_item.text() )
-                parent_item = parent_item.parent()
-            datafile_item = self.datafile[datafile_directory.pop(0)]
-            for datafile_key in datafile_directory:
-                datafile_item = datafile_item[datafile_key]
+            tree_item = self.datafile_treeview_X.model().itemFromIndex(selected_index[0])
+            datafile_item = self.get_datafile_item(tree_item)
             if isinstance(datafile_item, h5py.Dataset):
-                # only append to data for plotting if datafile item is a dataset
-                data_to_plot = self.apply_data_modifier(np.array(datafile_item), self.modifier_X)
-                self.data_X_toPlot.append(data_to_plot)
+                self.X_selection = datafile_item.name
             self.item_for_attrs_view = datafile_item
             self.load_attributes(self.item_for_attrs_view)
-            self.update_plot()
+            self.load_selected_data()
+    
+    def load_selected_data(self):
+        """ plot selected datasets from cache, loading datasets not in cache on a worker thread first """
+        self.load_request += 1
+        required_keys = [(name, self.modifier_Y) for name, _ in self.Y_selection]
+        if self.X_selection is not None and not self.use_decimation(self.datafile[self.X_selection]):
+            required_keys.append( (self.X_selection, self.modifier_X) )
+        missing_keys = [key for key in required_keys if key not in self.data_cache]
+        if len(missing_keys) > 0:
+            load_thread = threading.Thread(target=self.load_data_thread, args=(self.load_request, missing_keys),
+                                           daemon=True)
+            load_thread.start()
+        else:
+            self.load_completed(self.load_request)
+    
+    def load_data_thread(self, load_request, keys):
+        for key in keys:
+            if load_request != self.load_request:
+                # selection changed, data loaded so far stays in cache
+                return
+            try:
+                self.data_cache.put(key, self.load_dataset(*key))
+            except Exception as exception:
+                print('Exception: {}'.format(exception) )
+        self.data_loaded_signal.emit(load_request)
+    
+    def load_dataset(self, name, modifier):
+        """
+        load dataset with modifier applied. Long datasets are loaded as decimation pyramids of the modified data.
+        """
+        dataset = self.datafile[name]
+        self.datafile.refresh(dataset)
+        if self.use_decimation(dataset):
+            return self.get_decimation_pyramid(dataset, modifier)
+        return self.apply_data_modifier(np.array(dataset), modifier)
+    
+    def load_completed(self, load_request):
+        """ plot cached data for selection, unless the selection changed since load_request """
+        if load_request != self.load_request:
+            return
+        self.data_Y_toPlot = []
+        self.data_plot_labels = []
+        for name, label in self.Y_selection:
+            data_to_plot = self.data_cache.get( (name, self.modifier_Y) )
+            if data_to_plot is not None:
+                self.data_Y_toPlot.append(data_to_plot)
+                self.data_plot_labels.append(label)
+        self.data_X_toPlot = []
+        if self.X_selection is not None:
+            X_dataset = self.datafile[self.X_selection]
+            if self.use_decimation(X_dataset):
+                # long X datasets are not loaded, only points plotted against decimated data are read
+                data_to_plot = X_dataset
+            else:
+                data_to_plot = self.data_cache.get( (self.X_selection, self.modifier_X) )
+            if data_to_plot is not None:
+                self.data_X_toPlot.append(data_to_plot)
+        self.update_plot()
                     
     def update_plot(self):
         """ plot currently selected data """
         self.data_plot.clear()
+        self.decimated_curves = []
         N_lines = len(self.data_Y_toPlot)
         for (data_Y, label, color_index) in zip(self.data_Y_toPlot, self.data_plot_labels, range(N_lines)):
             # set line and marker colours
@@ -135,7 +326,16 @@ class hdf5_viewer(interactive_ui):
             pen = pg.mkPen(color=color, width=1)
             self.plot_format.update({'symbolPen': pen,
                                      'symbolBrush': pg.mkBrush(color=color) })
-            if self.data_X_Y_are_plot_compatible():
+            if isinstance(data_Y, decimation_pyramid):
+                # plot decimated data for whole dataset, without symbols
+                plot_X = self.data_X_Y_are_plot_compatible()
+                try:
+                    curve = self.data_plot.plot(*self.get_decimated_data(data_Y, plot_X), name=label, pen=pen)
+                    self.decimated_curves.append( (curve, data_Y, plot_X) )
+                    self.data_plot.setLabel('bottom', '' if plot_X else 'index')
+                except Exception as exception:
+                    print('Exception: {}'.format(exception) )
+            elif self.data_X_Y_are_plot_compatible():
                 try:    
                     self.data_plot.plot(self.data_X_toPlot[0], data_Y, name=label, pen=pen, **self.plot_format)
                     self.data_plot.setLabel('bottom', '')
@@ -148,6 +348,88 @@ class hdf5_viewer(interactive_ui):
                 except Exception as exception:
                     print('Exception: {}'.format(exception) )
                          
+    def use_decimation(self, dataset):
+        return dataset.ndim == 1 and dataset.shape[0] > self.decimation_min_points
+    
+    def get_decimation_pyramid(self, dataset, modifier):
+        """
+        get decimation pyramid of dataset with modifier applied before decimation, so that the min/max envelope
+        is that of the modified data. The pyramid is computed if not already computed or stored in the sidecar file.
+        Holds decimation_lock, so that concurrent load threads do not compute or save the same pyramid twice.
+        """
+        with self.decimation_lock:
+            pyramid = self.decimation_pyramids.get( (dataset.name, modifier) )
+            if pyramid is not None and len(pyramid) <= len(dataset):
+                # datasets only grow while followed, decimate the new points only
+                pyramid.extend(dataset)
+                return pyramid
+            pyramid = None
+            modifier_function = None
+            if modifier != 'none':
+                modifier_function = functools.partial(self.apply_data_modifier, modifier=modifier)
+            decimation_file = self.get_decimation_file()
+            stored_path = '{}/{}'.format(dataset.name, modifier)
+            if decimation_file is not None and stored_path in decimation_file:
+                # stored pyramid is None if the dataset changed since it was stored
+                pyramid = decimation_pyramid.load(dataset, decimation_file[stored_path], modifier=modifier_function)
+            if pyramid is None:
+                pyramid = decimation_pyramid(dataset, modifier=modifier_function)
+                if decimation_file is not None:
+                    pyramid.save(decimation_file.require_group(stored_path))
+                    decimation_file.flush()
+            self.decimation_pyramids[(dataset.name, modifier)] = pyramid
+            return pyramid
+    
+    def get_decimation_file(self):
+        """ sidecar file storing decimation pyramids, or None if they are not stored """
+        if self.store_decimation and self.decimation_file is None:
+            try:
+                self.decimation_file = self.datafile.open_sidecar_file('decimation')
+            except OSError as exception:
+                print('Decimation pyramids not stored, cannot open sidecar file: {}'.format(exception) )
+                self.store_decimation = False
+        return self.decimation_file
+    
+    def get_decimated_data(self, pyramid, plot_X, x_range=None):
+        """
+        get X and Y data for plotting pyramid within x_range, with about as many points as the plot width in pixels.
+        If x_range is None, get data for the whole dataset.
+        """
+        N_points = max(self.data_plot.width(), 100)
+        data_X = self.data_X_toPlot[0] if plot_X else None
+        if x_range is None or (plot_X and self.modifier_X != 'none'):
+            start, stop = 0, len(pyramid)
+        elif plot_X:
+            # find index range from X dataset, assumed monotonic. One point margin on each side of the view
+            start, stop = sorted([search_sorted_dataset(data_X, x_range[0]),
+                                  search_sorted_dataset(data_X, x_range[1])])
+            start, stop = start - 1, stop + 1
+        else:
+            start, stop = int(np.floor(x_range[0])) - 1, int(np.ceil(x_range[1])) + 2
+        # pyramid values are already modified
+        indices, values = pyramid.get_data(start, stop, N_points)
+        if not plot_X:
+            return indices, values
+        if len(indices) == 0:
+            return np.array([]), values
+        # read X values at plotted indices only, h5py requires increasing unique indices
+        unique_indices, inverse_indices = np.unique(indices, return_inverse=True)
+        X_values = np.asarray(data_X[unique_indices], dtype=float)[inverse_indices]
+        return self.apply_data_modifier(X_values, self.modifier_X), values
+    
+    def schedule_decimation_update(self):
+        if len(self.decimated_curves) > 0:
+            self.decimation_timer.start(100)
+    
+    def update_decimated_curves(self):
+        """ re-read decimated curves at the level of detail of the current view range """
+        x_range = self.data_plot.getViewBox().viewRange()[0]
+        for curve, pyramid, plot_X in self.decimated_curves:
+            try:
+                curve.setData(*self.get_decimated_data(pyramid, plot_X, x_range))
+            except Exception as exception:
+                print('Exception: {}'.format(exception) )
+    
     def data_X_Y_are_plot_compatible(self):
         """ check if current X and Y data exist and are size compatible for plotting """
         if len(self.data_Y_toPlot)>0 and len(self.data_X_toPlot)>0:
@@ -173,18 +455,28 @@ class hdf5_viewer(interactive_ui):
             return np.log10(abs(dataset))
         
     def reload_datafile(self):
-        self.load_datafile_tree()
-        self.datafile_treeview_Y.selectionModel().selectionChanged.connect(self.update_data_toPlot_Y)
-        self.datafile_treeview_X.selectionModel().selectionChanged.connect(self.update_data_toPlot_X)
+        """
+        update tree with changes in datafile, only expanded branches are read again.
+        Loaded data and decimation pyramids may be out of date, they are discarded and the selection is re-read.
+        """
+        self.refresh_datafile_branch(self.datafile, self.treeview_root)
+        self.data_cache.clear()
+        with self.decimation_lock:
+            self.decimation_pyramids = {}
+        self.load_selected_data()
         
 if __name__ == '__main__' :
     
     from nanomol.utils.hdf5_datafile import hdf5_datafile
     
-    myDatafile = hdf5_datafile(mode='r')
+    # to follow a measurement while another process writes it, e.g. current_vs_time from a launcher with
+    # swmr=True, set follow_interval to the update interval in s. The datafile is then opened as SWMR reader
+    # and the selected datasets are extended with new points every follow_interval.
+    follow_interval = None
+    myDatafile = hdf5_datafile(mode='r', swmr=follow_interval is not None)
     
     myViewer_app = QtWidgets.QApplication([])
-    myViewer = hdf5_viewer(myDatafile)
+    myViewer = hdf5_viewer(myDatafile, follow_interval=follow_interval)
     myViewer.show()
     myViewer_app.exec()
     
\ No newline at end of file
@@ -0,0 +1,138 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 15:02:11 2026
+
+@author: deankos
+"""
+
+import queue
+import threading
+import numpy as np
+
+class hdf5_writer():
+    """
+    Write data to an hdf5 datafile from a background thread, so that measurements can continue acquiring
+    while data is saved. Jobs are executed in the order they are submitted.
+    The job queue is bounded: if the writer falls behind, submitting a job blocks until there is space.
+    Groups can be created by the calling thread, or queued with create_group(). Jobs accept either h5py groups
+    or hdf5 paths as targets, so that items of queued groups can be written before the groups exist.
+    Call drain() to wait until all submitted jobs are written, and close() when done with the writer.
+    """
+
+    def __init__(self, datafile, max_queue_size=100):
+        """
+        Parameters
+        datafile : hdf5_datafile
+            datafile where data is written
+        max_queue_size : int, optional
+            maximum number of jobs waiting to be written. Default is 100.
+        """
+        self.datafile = datafile
+        self.job_queue = queue.Queue(maxsize=max_queue_size)
+        self.exception = None  # exception raised by a job, re-raised on the calling thread
+        self.writer_thread = threading.Thread(target=self.run_writer, daemon=True)
+        self.writer_thread.start()
+
+    def run_writer(self):
+        """ execute jobs from the queue until a None job is received """
+        while True:
+            job = self.job_queue.get()
+            try:
+                if job is None:
+                    return
+                function, args, kwargs = job
+                function(*args, **kwargs)
+            except Exception as exception:
+                self.exception = exception
+            finally:
+                self.job_queue.task_done()
+
+    def submit(self, function, *args, **kwargs):
+        """
+        Queue function(*args, **kwargs) to be executed by the writer thread.
+        Blocks if the queue is full. Raises any exception from previously executed jobs.
+        """
+        self.raise_exception()
+        self.job_queue.put( (function, args, kwargs) )
+
+    def create_dataset(self, group, name, data, copy=True, **kwargs):
+        """
+        Parameters
+        group : h5py group or datafile
+            group where the dataset is created, with the compression preset of the datafile
+        name : str
+            dataset name
+        data : numpy array or list
+            dataset data. Copied when the job is submitted, so it can be modified afterwards.
+        copy : bool, optional
+            if False, numpy arrays are not copied and must not be modified until written. Default is True.
+        **kwargs
+            keyworded arguments passed to hdf5_datafile.create_compressed_dataset, e.g. compression preset
+        """
+        data = np.array(data) if copy else np.asarray(data)
+        self.submit(self.write_dataset, group, name, data, **kwargs)
+
+    def write_dataset(self, group, name, data, **kwargs):
+        self.datafile.create_compressed_dataset(self.get_item(group), name, data=data, **kwargs)
+
+    def create_group(self, parent_group, name):
+        """
+        Queue creation of a group, e.g. with a name from hdf5_datafile.get_unique_group_name.
+
+        Parameters
+        parent_group : h5py group, datafile or str
+            group where the group is created, or its hdf5 path
+        name : str
+            group name
+
+        Returns
+        path : str
+            hdf5 path of the group, to use as target of later jobs
+        """
+        parent_path = parent_group if isinstance(parent_group, str) else parent_group.name
+        self.submit(self.write_group, parent_path, name)
+        return '{}/{}'.format(parent_path.rstrip('/'), name)
+
+    def write_group(self, parent_group, name):
+        self.get_item(parent_group).create_group(name)
+
+    def set_attrs(self, item, attrs):
+        """
+        Parameters
+        item : h5py group or dataset, or str
+            item where attributes are created, or its hdf5 path
+        attrs : dict
+            attribute name: value pairs
+        """
+        self.submit(self.write_attrs, item, dict(attrs) )
+
+    def write_attrs(self, item, attrs):
+        item = self.get_item(item)
+        for attr_name, attr_value in attrs.items():
+            item.attrs.create(attr_name, attr_value)
+
+    def get_item(self, item):
+        """ item of the datafile at hdf5 path item, or item itself if not a path """
+        return self.datafile[item] if isinstance(item, str) else item
+
+    def flush(self):
+        """ queue a flush of the datafile """
+        self.submit(self.datafile.flush)
+
+    def drain(self):
+        """ wait until all submitted jobs are written. Raises any exception raised by a job. """
+        self.job_queue.join()
+        self.raise_exception()
+
+    def raise_exception(self):
+        if self.exception is not None:
+            exception = self.exception
+            self.exception = None
+            raise exception
+
+    def close(self):
+        """ write all submitted jobs and stop the writer thread """
+        self.job_queue.join()
+        self.job_queue.put(None)
+        self.writer_thread.join()
+        self.raise_exception()
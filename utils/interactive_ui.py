@@ -58,4 +58,17 @@ class interactive_ui(QtWidgets.QWidget):
         elif isinstance(sending_widget, QtWidgets.QComboBox):
             attr_value = sending_widget.currentText()
         setattr(self, attr_name, attr_value)
-            
\ No newline at end of file
+                
+    def check_datafile_accepts_measurements(self, datafile):
+        """
+        Return True if new measurement groups can be created in datafile. A file opened with swmr=True switches
+        to SWMR write mode once its first measurement starts, and then accepts no new groups: warn that a new
+        datafile is needed and return False, rather than failing in the measurement thread.
+        """
+        if getattr(datafile, 'swmr_mode', False):
+            QtWidgets.QMessageBox.warning(self, 'datafile in SWMR mode',
+                                          'The datafile {} was switched to SWMR mode for other processes to follow '
+                                          'a measurement, so no new measurements can be added to it. Open a new '
+                                          'datafile to measure again.'.format(datafile.filename) )
+            return False
+        return True
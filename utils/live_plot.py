@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+"""
+Created on Sun Oct 18 18:42:13 2026
+
+@author: deankos
+"""
+
+import threading
+import time
+import numpy as np
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+
+class live_plot(QObject):
+    """
+    Redraw plot lines while a measurement runs, at most max_frame_rate times per second.
+    The measurement thread adds data to lines and calls request_update(). Requests made while a redraw is
+    already pending are dropped, since the pending redraw will show their data, so the cost of plotting does
+    not depend on how fast data is acquired. Redraws run on the thread where live_plot was created,
+    which should be the Qt GUI thread.
+    """
+
+    redraw_signal = pyqtSignal()
+
+    def __init__(self, max_frame_rate=20):
+        """
+        Parameters
+        max_frame_rate : float, optional
+            maximum number of redraws per second. Default is 20.
+        """
+        super().__init__()
+        self.min_frame_interval = 1/max_frame_rate
+        self.lines = []
+        self.redraw_pending = False
+        self.last_redraw_time = 0
+        self.redraw_timer = QTimer()
+        self.redraw_timer.setSingleShot(True)
+        self.redraw_timer.timeout.connect(self.redraw)
+        self.redraw_signal.connect(self.schedule_redraw)
+
+    def add_line(self, plot_widget, **plot_kwargs):
+        """
+        Create a new empty line in plot_widget and return it as a live_plot_line.
+        plot_kwargs are passed to plot_widget.plot(), e.g. pen, name.
+        """
+        line = live_plot_line(plot_widget.plot([], [], **plot_kwargs) )
+        self.lines.append(line)
+        return line
+
+    def clear(self):
+        """ stop redrawing lines added so far """
+        self.lines = []
+
+    def request_update(self):
+        """ request a redraw of the lines, can be called from any thread """
+        if not self.redraw_pending:
+            self.redraw_pending = True
+            self.redraw_signal.emit()
+
+    def schedule_redraw(self):
+        """ redraw now, or when min_frame_interval has passed since the last redraw """
+        delay = self.last_redraw_time + self.min_frame_interval - time.perf_counter()
+        self.redraw_timer.start(max(0, int(delay*1000)) )
+
+    def redraw(self):
+        # clear pending flag first, data added during the redraw requests a new redraw
+        self.redraw_pending = False
+        self.last_redraw_time = time.perf_counter()
+        for line in self.lines:
+            line.redraw()
+
+
+class live_plot_line():
+    """
+    Line of a live_plot. Data added with append or extend is stored in numpy arrays that double in size when
+    full, so adding a point does not copy the data, and redraws pass views of the arrays to the plot.
+    Alternatively, data stored elsewhere can be plotted with set_data.
+    """
+
+    def __init__(self, plot_data_item, capacity=1000):
+        self.plot_data_item = plot_data_item
+        self.x = np.empty(capacity)
+        self.y = np.empty(capacity)
+        self.N_points = 0
+        self.changed = False
+        self.lock = threading.Lock()
+
+    def __len__(self):
+        return self.N_points
+
+    def append(self, x, y):
+        """ add a single point """
+        self.extend([x], [y])
+
+    def extend(self, x, y):
+        """ add points from sequences x and y of equal length """
+        N_new_points = len(x)
+        with self.lock:
+            N_required = self.N_points + N_new_points
+            if N_required > self.x.size:
+                capacity = max(2*self.x.size, N_required)
+                self.x = np.concatenate( (self.x[:self.N_points], np.empty(capacity - self.N_points)) )
+                self.y = np.concatenate( (self.y[:self.N_points], np.empty(capacity - self.N_points)) )
+            self.x[self.N_points:N_required] = x
+            self.y[self.N_points:N_required] = y
+            self.N_points = N_required
+            self.changed = True
+
+    def set_data(self, x, y):
+        """
+        plot arrays x and y, e.g. views of an acquisition_buffer, without copying them.
+        The arrays must not be modified afterwards, set_data should be called again when data is added.
+        """
+        with self.lock:
+            self.x, self.y = x, y
+            self.N_points = len(x)
+            self.changed = True
+
+    def redraw(self):
+        """ update plot with current data, if data was added since the last redraw """
+        with self.lock:
+            if not self.changed:
+                return
+            self.changed = False
+            x, y = self.x[:self.N_points], self.y[:self.N_points]
+        # points before N_points are never modified, so views can be plotted outside the lock
+        self.plot_data_item.setData(x, y)